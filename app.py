@@ -1,27 +1,43 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response
 from openai import OpenAI
 from flask_cors import CORS
 from dotenv import load_dotenv
 from phase_2_queries import *
 from elevenlabsQueries import *
+from state_emitter import StateEmitter
+from memory_consolidation import ConsolidationBatcher
+from memory_retention import start_retention_thread
+from shared_backend import get_backend, socketio_options, MemoryBackend
+from telemetry import start_turn, span, render_metrics, recent_traces, register_gauges
+from storage_codec import codec_stats
+from structured_log import get_logger, log_stats
+import prompt_assembly
 import openAIqueries
-import os, uuid
+from structured_output import json_stats
+from hedged_requests import hedge_stats
+from circuit_breaker import CircuitOpen, breaker_stats
+from llm_scheduler import scheduler_stats
+from ollama_provider import ollama_stats
+from threading import Thread
+import os, uuid, time
 from flask_socketio import SocketIO, join_room
 import base64
 import hashlib
 import logging
 #------------------------------------------------------------------
-from threading import Thread
-from threading import Lock
-#------------------------------------------------------------------
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
+logger = get_logger("app")
 
 AUDIO_DIR = "./tts_cache"
 os.makedirs(AUDIO_DIR, exist_ok=True)
-speechOn = False  # set to false to save 11 lab tokens
+speechOn = os.getenv("SPEECH_ON", "0") == "1"  # off by default to save 11 lab tokens
 
-memory_worker_lock = Lock()
+# tts_cache may be per node: with a shared backend, clips up to
+# TTS_SHARED_MAX_BYTES are also stored there so other nodes reuse them
+TTS_LOCK_TTL_S = float(os.getenv("TTS_LOCK_TTL_S", "30"))
+TTS_SHARED_MAX_BYTES = int(os.getenv("TTS_SHARED_MAX_BYTES", "524288"))
+TTS_SHARED_TTL_S = int(os.getenv("TTS_SHARED_TTL_S", "86400"))
 #------------------------------------------------------------------
 # we need to have this API sit between Unreal and MYSQL Database
 #------------------------------------------------------------------
@@ -29,19 +45,64 @@ load_dotenv()
 camo = Flask(__name__)
 CORS(camo)                      # allow anything to access this API
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-socketio = SocketIO(camo, cors_allowed_origins="*")
+shared = get_backend()
+socketio = SocketIO(camo, cors_allowed_origins="*", **socketio_options(shared))
+state_emitter = StateEmitter(socketio)
+consolidator = ConsolidationBatcher()
+consolidator.start()       # re-enqueue work left behind by a restart
+
+# archive processed buffer rows / old logs (0 = run memory_retention.py from cron instead)
+RETENTION_INTERVAL_MIN = float(os.getenv("RETENTION_INTERVAL_MIN", "0"))
+if RETENTION_INTERVAL_MIN > 0:
+    start_retention_thread(RETENTION_INTERVAL_MIN * 60)
+
+register_gauges("consolidation", lambda: {k: v for k, v in consolidator.stats().items() if k != "backlog"})
+register_gauges("storage_codec", codec_stats)
+register_gauges("prompt_cache", prompt_assembly.cache_stats)
+register_gauges("log", log_stats)
+register_gauges("llm_json", json_stats)
+register_gauges("llm_hedge", hedge_stats)
+register_gauges("breaker", breaker_stats)
+register_gauges("llm_scheduler", scheduler_stats)
+register_gauges("ollama", ollama_stats)
+
+# locally served stages: load their models now, not on the first turn
+Thread(target=openAIqueries.warm_local_models, daemon=True, name="ollama-warm-up").start()
+#------------------------------------------------------------------
+# metrics / traces
+#------------------------------------------------------------------
+@camo.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+@camo.route("/traces", methods=["GET"])
+def traces():
+    return jsonify(recent_traces(
+        idUser=request.args.get("idUser"),
+        limit=int(request.args.get("limit", 20))
+    ))
 #------------------------------------------------------------------
 # socket events
 #------------------------------------------------------------------
 @socketio.on("connect")
 def onConnect():
-    print("player connected")
+    logger.debug("player connected", sid=request.sid)
 
 @socketio.on("register_user")
 def register_user(data):
-    print('registering user')
     idUser = data["idUser"]
+    logger.info("registering user", idUser=idUser)
     join_room(f"user:{idUser}")
+
+    # a (re)connecting client has no base state: next emit is a full snapshot
+    reset_npc_state(idUser)
+    if data.get("idNPC") is not None:
+        emit_npc_state(idUser, data["idNPC"], socketio, full=True)
+
+@socketio.on("request_npc_state")
+def request_npc_state(data):
+    # client lost track of versions (gap / resync) -> full snapshot
+    emit_npc_state(data["idUser"], data["idNPC"], socketio, full=True)
 #------------------------------------------------------------------
 # cache for 11 labs
 #------------------------------------------------------------------
@@ -50,34 +111,101 @@ def tts_cache_key(text, voice_id, emotion):
     raw = f"{voice_id}|{emotion}|{text}".encode("utf-8")
     return hashlib.sha256(raw).hexdigest()
 #------------------------------------------------------------------
+def write_atomic(path, data):
+    # readers in other workers never see a half-written file
+    tmp = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+#------------------------------------------------------------------
+def stream_file(path):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(32_768)  # 32KB
+            if not chunk:
+                break
+            yield chunk
+#------------------------------------------------------------------
+def fetch_shared_audio(key, path):
+    if isinstance(shared, MemoryBackend):
+        return False
+    audio = shared.get(f"tts:audio:{key}")
+    if not audio:
+        return False
+    write_atomic(path, audio)
+    return True
+#------------------------------------------------------------------
 def tts_cached(text, voice_id, emotion):
+    with span("tts", "tts", metric="tts_seconds", chars=len(text)) as attrs:
+        yield from _tts_cached(text, voice_id, emotion, attrs)
+
+def _tts_cached(text, voice_id, emotion, attrs):
     key = tts_cache_key(text, voice_id, emotion)
     path = f"{AUDIO_DIR}/{key}.mp3"
 
-    if os.path.exists(path):
-        with open(path, "rb") as f:
-            while True:
-                chunk = f.read(32_768)  # 32KB
-                if not chunk:
-                    break
-                print("USING CACHE!")
-                yield chunk
+    if os.path.exists(path) or fetch_shared_audio(key, path):
+        logger.debug("tts cache hit", key=key)
+        attrs["cached"] = True
+        yield from stream_file(path)
         return
 
-    audio_chunks = []
-    for chunk in tts(text, voice_id, emotion):
-        audio_chunks.append(chunk)
-        yield chunk
+    # provider down: don't wait on the lock for a clip nobody can make
+    if tts_breaker.is_open():
+        raise CircuitOpen(tts_breaker.name)
 
-    with open(path, "wb") as f:
-        f.write(b"".join(audio_chunks))
+    # only one worker calls ElevenLabs for a given clip; the others wait
+    # for it (and generate anyway if the holder takes longer than the ttl)
+    token = shared.acquire(f"tts:{key}", ttl_s=TTS_LOCK_TTL_S, wait_s=TTS_LOCK_TTL_S)
+    try:
+        if os.path.exists(path) or fetch_shared_audio(key, path):
+            logger.debug("tts cache hit", key=key)
+            attrs["cached"] = True
+            yield from stream_file(path)
+            return
+
+        attrs["cached"] = False
+
+        audio_chunks = []
+        for chunk in tts(text, voice_id, emotion):
+            audio_chunks.append(chunk)
+            yield chunk
+
+        audio = b"".join(audio_chunks)
+        write_atomic(path, audio)
+        shared.set_json(f"tts:meta:{key}", {
+            "voice": voice_id,
+            "emotion": emotion,
+            "bytes": len(audio),
+            "createdAt": time.time()
+        }, ttl_s=TTS_SHARED_TTL_S)
+        if not isinstance(shared, MemoryBackend) and len(audio) <= TTS_SHARED_MAX_BYTES:
+            shared.set(f"tts:audio:{key}", audio, ttl_s=TTS_SHARED_TTL_S)
+    finally:
+        shared.release(f"tts:{key}", token)
+def emit_speech(text, voice_id, emotion, idUser) -> bool:
+    """
+    Sends the clip for one sentence. False when TTS is unavailable;
+    the rest of the turn is then text-only.
+    """
+    try:
+        for audio_chunk in tts_cached(text, voice_id, emotion):
+            payload = base64.b64encode(audio_chunk).decode("utf-8")
+            socketio.emit(
+                "npc_audio_chunk",
+                {"audio_b64": payload},
+                room=f"user:{idUser}"
+            )
+            socketio.sleep(0)
+    except Exception as e:
+        logger.warning("TTS unavailable, turn continues text-only", idUser=idUser, error=str(e))
+        return False
+    return True
 #------------------------------------------------------------------
 def saveAudio(audio):
     audio = b"".join(audio)
     audio_id = str(uuid.uuid4())
     path = f"{AUDIO_DIR}/{audio_id}.mp3"
-    with open(path, "wb") as f:
-        f.write(audio)
+    write_atomic(path, audio)
     return {"audio_id": audio_id}, 200
 
 #------------------------------------------------------------------
@@ -86,6 +214,7 @@ def saveAudio(audio):
 @camo.route("/npc_interact", methods=["POST"])
 def npc_interact():
     SENTENCE_END = {".", "?", "!"}
+    trace = None
 
     try:
         data     = request.json
@@ -96,17 +225,27 @@ def npc_interact():
         idVoice  = data["idVoice"]
         pText    = data["playerText"]
 
-        print(f"\nDATA: {data}\n")
+        trace = start_turn(idUser, idNPC)
+        logger.info("npc_interact", idUser=idUser, idNPC=idNPC, chars=len(pText))
+        logger.payload("request", "npc_interact request", data)
+
+        # ----------------------------------------------------------
+        # 0. Backpressure: let memory consolidation catch up
+        # ----------------------------------------------------------
+        trace.stage("backpressure")
+        consolidator.wait_for_capacity(idNPC, idUser)
 
         # ----------------------------------------------------------
         # 1. Decay existing emotions
         # ----------------------------------------------------------
+        trace.stage("decay")
         decay_rate = get_emotion_decay_rate(idNPC)
         decay_npc_emotions(idNPC=idNPC, decay=decay_rate)
 
         # ----------------------------------------------------------
         # 2. Classify player input
         # ----------------------------------------------------------
+        trace.stage("classify")
         raw_mem = get_mem(idNPC=idNPC, idUser=idUser)
 
         classification = openAIqueries.classify_player_input(
@@ -123,6 +262,7 @@ def npc_interact():
         # ----------------------------------------------------------
         # 3. Update trust
         # ----------------------------------------------------------
+        trace.stage("trust")
         update_trust(idUser, idNPC, trust_delta)
 
         if offensive:
@@ -131,6 +271,7 @@ def npc_interact():
         # ----------------------------------------------------------
         # 4. Extract beliefs about player
         # ----------------------------------------------------------
+        trace.stage("beliefs")
         beliefs = openAIqueries.extract_persona_clues(
             player_text=pText,
             recent_context=raw_mem,
@@ -146,6 +287,7 @@ def npc_interact():
         )
 
         # Insert player turn immediately so prompt can see it
+        trace.stage("buffer_insert_player")
 
         #should include extracted beliefs about player int this update, oops
         insert_memory_buffer(
@@ -163,15 +305,21 @@ def npc_interact():
         # ----------------------------------------------------------
         # 6. Build prompt using updated memory - NPC OUTPUT
         # ----------------------------------------------------------
-        prompt = build_prompt(idUser=idUser, idNPC=idNPC)
+        trace.stage("prompt_build")
+        prompt, prompt_report = build_prompt(
+            idUser=idUser, idNPC=idNPC, with_report=True,
+            query_text=f"{pText}\n{curScene}"
+        )
 
         # ----------------------------------------------------------
         # 6a. Stream Output w/ audio (get emotion for flavor)
         # ----------------------------------------------------------
+        trace.stage("stream")
 
         full_text = []
         sentence_buffer = ""
         speaking_emitted = False
+        speak = speechOn
 
         db = connect()
         cursor = db.cursor(dictionary=True)
@@ -191,7 +339,8 @@ def npc_interact():
 
 
         for token in openAIqueries.getResponseStream(
-            prompt, curScene, pName, client
+            prompt, curScene, pName, client,
+            prefix_tokens=prompt_report["cacheable_prefix_tokens"]
         ):
             full_text.append(token)
             sentence_buffer += token
@@ -204,7 +353,7 @@ def npc_interact():
             socketio.sleep(0)
 
             if (
-                speechOn
+                speak
                 and sentence_buffer.strip()
                 and sentence_buffer.strip()[-1] in SENTENCE_END
             ):
@@ -216,21 +365,11 @@ def npc_interact():
                     )
                     speaking_emitted = True
 
-                for audio_chunk in tts_cached(
-                    sentence_buffer, idVoice, dominant
-                ):
-                    payload = base64.b64encode(audio_chunk).decode("utf-8")
-                    socketio.emit(
-                        "npc_audio_chunk",
-                        {"audio_b64": payload},
-                        room=f"user:{idUser}"
-                    )
-                    socketio.sleep(0)
-
+                speak = emit_speech(sentence_buffer, idVoice, dominant, idUser)
                 sentence_buffer = ""
 
         # Flush remaining audio
-        if speechOn and sentence_buffer.strip():
+        if speak and sentence_buffer.strip():
             if not speaking_emitted:
                 socketio.emit(
                     "npc_speaking",
@@ -238,26 +377,18 @@ def npc_interact():
                     room=f"user:{idUser}"
                 )
 
-            for audio_chunk in tts_cached(
-                sentence_buffer, idVoice, dominant
-            ):
-                payload = base64.b64encode(audio_chunk).decode("utf-8")
-                socketio.emit(
-                    "npc_audio_chunk",
-                    {"audio_b64": payload},
-                    room=f"user:{idUser}"
-                )
-                socketio.sleep(0)
+            emit_speech(sentence_buffer, idVoice, dominant, idUser)
 
         # ----------------------------------------------------------
         # 8. Final NPC response text
         # ----------------------------------------------------------
         npc_text = "".join(full_text)
-        print(f"\nNPC RESPONSE: {npc_text}\n")
+        logger.payload("response", "npc response", npc_text, idUser=idUser, idNPC=idNPC)
 
         # ----------------------------------------------------------
         # 9. Classify NPC emotional reaction
         # ----------------------------------------------------------
+        trace.stage("reaction")
         emotion_data = openAIqueries.classify_npc_reaction(
             pText,
             npc_text,
@@ -275,6 +406,7 @@ def npc_interact():
         # ----------------------------------------------------------
         # 10. Extract and merge self beliefs
         # ----------------------------------------------------------
+        trace.stage("self_beliefs")
         raw_mem = get_mem(idUser=idUser, idNPC=idNPC)
         latest_scene = openAIqueries.get_most_recent_scene(raw_mem)
         recent_convo = get_buffered_convo(idUser=idUser, idNPC=idNPC)
@@ -298,6 +430,7 @@ def npc_interact():
         # ----------------------------------------------------------
         # 11. UPDATE MEMORY WITH NPC TURN (SECOND PHASE)
         # ----------------------------------------------------------
+        trace.stage("buffer_insert_npc")
         insert_memory_buffer(
             idNPC=idNPC,
             idUser=idUser,
@@ -308,139 +441,34 @@ def npc_interact():
             selfBeliefs=self_beliefs.get("beliefs")
         )
         # Trigger structured memory consolidation asynchronously
-        Thread(
-            target=background_update_structured_kbtext,
-            args=(idNPC, idUser),
-            daemon=True
-        ).start()
+        consolidator.schedule(idNPC, idUser)
 
         # ----------------------------------------------------------
-        # 12. Emit final state
+        # 12. Emit final state (debounced, off the request thread)
         # ----------------------------------------------------------
+        trace.stage("state_emit")
         socketio.emit("npc_text_done", {}, room=f"user:{idUser}")
         socketio.emit("npc_audio_done", {}, room=f"user:{idUser}")
-        emit_npc_state(idUser, idNPC, socketio)
+        state_emitter.schedule(idUser, idNPC)
+        trace.end("ok")
 
         return jsonify({"success": True}), 200
 
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("npc_interact failed", error=str(e))
+        if trace:
+            trace.end("error")
         return jsonify({"success": False, "error": str(e)}), 500
 
-#------------------------------------------------------------------
-def background_update_structured_kbtext(idNPC: int, idUser: int):
-    """
-    Continuously processes unprocessed exchanges
-    until none remain.
-    """
-
-    # Prevent multiple workers running simultaneously
-    if not memory_worker_lock.acquire(blocking=False):
-        return  # Another worker is already running
-
-    try:
-        while True:
-            processed = process_one_exchange(idNPC, idUser)
-            if not processed:
-                break  # No more exchanges left
-    finally:
-        memory_worker_lock.release()
-#------------------------------------------------------------------
-def process_one_exchange(idNPC: int, idUser: int) -> bool:
-    print(f"\n[MEMORY WORKER] Updating memory for NPC {idNPC}, User {idUser}")
-
-    db = connect()
-    cursor = db.cursor(dictionary=True)
-
-    cursor.execute("""
-        SELECT *
-        FROM npc_user_memory_buffer
-        WHERE idNPC = %s
-          AND idUser = %s
-          AND processed = 0
-        ORDER BY createdAt ASC
-    """, (idNPC, idUser))
-
-    rows = cursor.fetchall()
-
-    if not rows:
-        cursor.close()
-        db.close()
-        return False  # nothing to process
-
-    exchanges = []
-    buffer_ids = []
-
-    pending_player = None
-    pending_player_id = None
-
-    for r in rows:
-
-        if r.get("playerText"):
-            pending_player = r["playerText"]
-            pending_player_id = r["idBuffer"]
-            continue
-
-        if r.get("npcText") and pending_player:
-
-            exchanges.append({
-                "player_text": pending_player,
-                "npc_text": r["npcText"],
-                "npc_emotion": r.get("npcEmotion"),
-                "npc_intensity": r.get("npcIntensity")
-            })
-
-            buffer_ids.extend([pending_player_id, r["idBuffer"]])
-
-            pending_player = None
-            pending_player_id = None
-
-    # require at least one complete player → npc exchange
-    if len(exchanges) < 1:
-        cursor.close()
-        db.close()
-        return False
-
-    kbtext_current = get_mem(idNPC=idNPC, idUser=idUser)
-
-    relevant_self_beliefs = get_self_beliefs_snapshot(idNPC)
-    relevant_player_beliefs = get_player_beliefs_snapshot(idNPC, idUser)
-
-    updated_kb = openAIqueries.update_structured_kbtext(
-        client=None,
-        idUser=idUser,
-        idNPC=idNPC,
-        kbtext_current=kbtext_current,
-        exchanges=exchanges,
-        relevant_self_beliefs=relevant_self_beliefs,
-        relevant_player_beliefs=relevant_player_beliefs,
-    )
-
-    overwrite_NPC_user_memory(
-        idNPC=idNPC,
-        idUser=idUser,
-        kbText=updated_kb
-    )
-
-    placeholders = ",".join(["%s"] * len(buffer_ids))
-
-    cursor.execute(f"""
-        UPDATE npc_user_memory_buffer
-        SET processed = 1,
-            processedAt = NOW()
-        WHERE idBuffer IN ({placeholders})
-    """, tuple(buffer_ids))
-
-    db.commit()
-    cursor.close()
-    db.close()
-
-    print(f"[MEMORY WORKER] Processed {len(exchanges)} exchanges")
-
-    return True  # successfully processed
-
-
 if __name__ == "__main__":
-
-    socketio.run(camo, host="0.0.0.0", port=5001, debug=False, use_reloader=True)
\ No newline at end of file
+    # launcher.py sets PORT / WORKER_INDEX for each worker process
+    worker = os.getenv("WORKER_INDEX") is not None
+    socketio.run(
+        camo,
+        host="127.0.0.1" if worker else "0.0.0.0",
+        port=int(os.getenv("PORT", "5001")),
+        debug=False,
+        use_reloader=not worker,
+        # Werkzeug is a dev server; opt in explicitly (launcher --dev-server)
+        allow_unsafe_werkzeug=os.getenv("ALLOW_UNSAFE_WERKZEUG", "0") == "1"
+    )
\ No newline at end of file
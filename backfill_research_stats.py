@@ -0,0 +1,20 @@
+import sys
+from dotenv import load_dotenv
+from phase_2_queries import backfill_classification_stats
+#------------------------------------------------------------------
+# Rebuild player_input_classification_stats from the existing
+# player_input_classification_log rows (and its archive).
+#
+#   python backfill_research_stats.py                 # everything
+#   python backfill_research_stats.py <idUser>        # one player
+#   python backfill_research_stats.py <idUser> <idNPC>
+#------------------------------------------------------------------
+load_dotenv()
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    idUser = args[0] if len(args) > 0 else None
+    idNPC  = args[1] if len(args) > 1 else None
+
+    rows = backfill_classification_stats(idUser=idUser, idNPC=idNPC)
+    print(f"[BACKFILL] research stats rebuilt, {rows} aggregate rows")
@@ -0,0 +1,249 @@
+import os
+import re
+import zlib
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+import numpy as np
+#------------------------------------------------------------------
+# Belief similarity index
+#
+# npc_user_belief / npc_self_belief are keyed by the exact beliefValue
+# string, so "brave", "Brave " and "courageous" used to become three
+# rows. Values are now
+#   1. canonicalized (hedges stripped; personality traits also
+#      snake_cased with synonyms folded)
+#   2. embedded as hashed character n-gram vectors (no model download)
+#   3. merged into an existing value of the same type when the cosine
+#      similarity is above BELIEF_MERGE_THRESHOLD -- unless the two
+#      differ by a negation ("trustworthy" / "not trustworthy",
+#      "comfortable" / "uncomfortable"), which n-grams score as close
+# The same vectors rank beliefs against the current turn so prompts
+# carry only the relevant ones.
+#------------------------------------------------------------------
+VECTOR_DIM = 1024
+BELIEF_MERGE_THRESHOLD = float(os.getenv("BELIEF_MERGE_THRESHOLD", "0.82"))
+BELIEF_PROMPT_TOP_K = int(os.getenv("BELIEF_PROMPT_TOP_K", "12"))
+# scopes kept in memory, least recently used dropped first; sync()
+# rebuilds a dropped scope from the db rows
+BELIEF_INDEX_MAX_SCOPES = int(os.getenv("BELIEF_INDEX_MAX_SCOPES", "5000"))
+
+HEDGE_PREFIXES = (
+    "has experience being a ",
+    "has experience as a ",
+    "is comfortable with ",
+    "likely has ",
+    "seems to be ",
+    "appears to be ",
+    "probably ",
+    "possibly ",
+    "is ",
+)
+
+PHRASE_REPLACEMENTS = {
+    "has lived in this town their whole life": "local_resident",
+}
+
+# folded onto the first word of each group
+BELIEF_SYNONYMS = {
+    "courageous": "brave", "fearless": "brave", "bold": "brave",
+    "kindhearted": "kind", "kind_hearted": "kind", "compassionate": "kind",
+    "nice": "friendly", "amiable": "friendly", "sociable": "friendly",
+    "smart": "intelligent", "clever": "intelligent", "bright": "intelligent",
+    "funny": "humorous", "witty": "humorous",
+    "honest": "truthful", "sincere": "truthful",
+    "shy": "reserved", "introverted": "reserved",
+    "outgoing": "extroverted",
+    "mean": "unkind", "cruel": "unkind",
+    "angry": "hostile", "aggressive": "hostile",
+    "sad": "melancholy", "unhappy": "melancholy",
+    "curious": "inquisitive",
+    "scared": "afraid", "frightened": "afraid", "fearful": "afraid",
+}
+
+# only these types are short labels; goals, secrets, likes ... are
+# phrases and keep their wording
+SNAKE_CASE_TYPES = {"personality_trait", "personality_traits"}
+
+NEGATORS = {"not", "no", "never", "non", "without", "nothing", "none", "nobody", "neither", "nor"}
+NEGATING_PREFIXES = ("un", "in", "dis", "im", "ir", "non")
+
+_SEP_RE = re.compile(r"[\s\-]+")
+_EDGE_PUNCT_RE = re.compile(r"^[^\w]+|[^\w]+$")
+_SPACE_RE = re.compile(r"\s+")
+_TOKEN_RE = re.compile(r"[a-z']+")
+
+def canonicalize(value: str, belief_type: str = "personality_trait") -> str:
+    """
+    Normalized belief value. Short personality traits (<= 5 words)
+    become snake_case with synonyms folded; other types and longer free
+    text (life stories) are returned as written, whitespace collapsed.
+    """
+    original = _SPACE_RE.sub(" ", (value or "").strip())
+    if belief_type not in SNAKE_CASE_TYPES:
+        return original
+
+    value = original.lower()
+
+    for phrase, replacement in PHRASE_REPLACEMENTS.items():
+        value = value.replace(phrase, replacement)
+
+    for prefix in HEDGE_PREFIXES:
+        if value.startswith(prefix):
+            value = value[len(prefix):]
+
+    value = _EDGE_PUNCT_RE.sub("", value).strip()
+
+    if len(value.split()) > 5:
+        # free text: keep names / places as written
+        return original
+
+    value = _SEP_RE.sub("_", value)
+    return BELIEF_SYNONYMS.get(value, value)
+
+def _tokens(value: str) -> list:
+    return _TOKEN_RE.findall((value or "").lower().replace("_", " ").replace("-", " "))
+
+def _negated(token: str) -> bool:
+    return token in NEGATORS or token.endswith("n't")
+
+def contradicts(a: str, b: str) -> bool:
+    """
+    True when a and b differ by a negator ("not afraid" / "afraid") or
+    a negating prefix ("uncomfortable" / "comfortable").
+    """
+    ta, tb = _tokens(a), _tokens(b)
+    if sum(map(_negated, ta)) % 2 != sum(map(_negated, tb)) % 2:
+        return True
+
+    only_a = set(ta) - set(tb)
+    only_b = set(tb) - set(ta)
+    for x in only_a:
+        for y in only_b:
+            longer, shorter = (x, y) if len(x) > len(y) else (y, x)
+            for prefix in NEGATING_PREFIXES:
+                if longer == prefix + shorter:
+                    return True
+    return False
+#------------------------------------------------------------------
+@lru_cache(maxsize=8192)
+def _vector(text: str) -> np.ndarray:
+    """
+    L2-normalized hashed bag of character 3-grams + whole words.
+    """
+    vec = np.zeros(VECTOR_DIM, dtype=np.float32)
+    text = canonicalize(text).replace("_", " ")
+    padded = f" {text} "
+
+    for i in range(len(padded) - 2):
+        vec[zlib.crc32(padded[i:i + 3].encode("utf-8")) % VECTOR_DIM] += 1.0
+    for word in text.split():
+        vec[zlib.crc32(("w:" + word).encode("utf-8")) % VECTOR_DIM] += 2.0
+
+    norm = np.linalg.norm(vec)
+    if norm:
+        vec /= norm
+    vec.setflags(write=False)
+    return vec
+
+def similarity(a: str, b: str) -> float:
+    return float(_vector(a) @ _vector(b))
+#------------------------------------------------------------------
+class BeliefIndex:
+    """
+    scope -> beliefType -> (values, matrix). A scope is
+    ("self", idNPC) or ("user", idNPC, idUser).
+    """
+    def __init__(self, max_scopes=BELIEF_INDEX_MAX_SCOPES):
+        self.max_scopes = max_scopes
+        self._scopes = OrderedDict()
+        self._lock = Lock()
+
+    def _types(self, scope) -> dict:
+        # caller holds the lock
+        types = self._scopes.get(scope)
+        if types is None:
+            types = self._scopes[scope] = {}
+            while len(self._scopes) > self.max_scopes:
+                self._scopes.popitem(last=False)
+        else:
+            self._scopes.move_to_end(scope)
+        return types
+
+    def sync(self, scope, rows):
+        """
+        rows: [{"beliefType", "beliefValue"}, ...] currently stored.
+        Rebuilds only types whose value set changed.
+        """
+        grouped = {}
+        for r in rows:
+            grouped.setdefault(r["beliefType"], []).append(r["beliefValue"])
+
+        with self._lock:
+            types = self._types(scope)
+            for btype, values in grouped.items():
+                current = types.get(btype)
+                if current and set(current[0]) == set(values):
+                    continue
+                types[btype] = (values, np.vstack([_vector(v) for v in values]))
+
+    def add(self, scope, btype, value):
+        with self._lock:
+            types = self._types(scope)
+            values, matrix = types.get(btype, ([], None))
+            if value in values:
+                return
+            row = _vector(value)[None, :]
+            matrix = row if matrix is None else np.vstack([matrix, row])
+            types[btype] = (values + [value], matrix)
+
+    def nearest(self, scope, btype, value):
+        """
+        (stored_value, cosine) of the closest value of the same type
+        that does not contradict value, or (None, 0.0).
+        """
+        with self._lock:
+            values, matrix = self._types(scope).get(btype, ([], None))
+            if matrix is None:
+                return None, 0.0
+            scores = matrix @ _vector(value)
+
+        for i in np.argsort(-scores, kind="stable").tolist():
+            if not contradicts(values[i], value):
+                return values[i], float(scores[i])
+        return None, 0.0
+
+    def resolve(self, scope, btype, value, threshold=BELIEF_MERGE_THRESHOLD):
+        """
+        Value to store: the canonical form, or an existing near-duplicate.
+        """
+        value = canonicalize(value, btype)
+        match, score = self.nearest(scope, btype, value)
+        if match is not None and (match == value or score >= threshold):
+            return match
+        self.add(scope, btype, value)
+        return value
+
+belief_index = BeliefIndex()
+#------------------------------------------------------------------
+def relevant_beliefs(rows, query: str, top_k: int = BELIEF_PROMPT_TOP_K, weight: float = 0.6):
+    """
+    Top-k belief rows for this turn, scored
+    weight * cosine(query, value) + (1 - weight) * confidence.
+    Order of the input rows is preserved in the result.
+    """
+    if len(rows) <= top_k:
+        return list(rows)
+    if not rows:
+        return []
+
+    q = _vector(query or "")
+    matrix = np.vstack([
+        _vector(f"{r['beliefType']} {r['beliefValue']}") for r in rows
+    ])
+    conf = np.array([float(r["confidence"]) for r in rows], dtype=np.float32)
+    scores = weight * (matrix @ q) + (1 - weight) * conf
+
+    # stable: ties keep the earlier row
+    keep = sorted(np.argsort(-scores, kind="stable")[:top_k].tolist())
+    return [rows[i] for i in keep]
@@ -0,0 +1,332 @@
+import argparse
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+#------------------------------------------------------------------
+# Local (Ollama) vs hosted LLM benchmark
+#
+#   python bench_local.py --turns 6 --npcs 2
+#   python bench_local.py --targets ollama --layouts prefix,volatile_first
+#   python bench_local.py --concurrency 1,2,4 --seconds 60
+#
+# Replays turns for a few synthetic NPCs through every stage prompt
+# (classifiers + streamed npc_response) built like the app builds them:
+# the real rule blocks, the persona rendered the same way, per-turn
+# trust / beliefs / dialogue that change every turn. No db needed.
+#
+#   cold        first turn of an NPC (nothing of its prompt cached)
+#   warm        later turns: the rules + persona prefix can be reused
+#   prompt_ms   Ollama's prompt eval time -- what prefix reuse saves
+#   cache_hit   hosted: share of prompt tokens the provider reported
+#               as prefix cache hits
+#
+# --layouts volatile_first puts the per-turn block at the START of the
+# system prompt, the control for prefix reuse. --concurrency runs N
+# callers for --seconds per level and reports requests/s and tokens/s.
+# Calls go through telemetry.chat_completion, so the scheduler limit
+# for the local host (OLLAMA_MAX_CONCURRENT) applies as in the app.
+#
+# On a CPU-only box set OLLAMA_NUM_PARALLEL on the server to match
+# OLLAMA_MAX_CONCURRENT. The models are loaded before the first pass;
+# with --no-warm-up the load shows up in the cold numbers instead.
+#------------------------------------------------------------------
+STAGES = ["classify_player", "persona_clues", "npc_reaction", "self_beliefs", "npc_response"]
+LAYOUTS = ["prefix", "volatile_first"]
+
+_NAMES = ["Mara", "Tobias", "Ilse", "Corwin", "Nadia", "Eli"]
+_ROLES = ["harbor master", "clock tower keeper", "station clerk", "night nurse", "radio operator"]
+_TRAITS = ["guarded", "curious", "warm", "sarcastic", "patient", "anxious", "proud", "honest"]
+_BELIEFS = ["trustworthy", "hiding_something", "lonely", "brave", "reckless", "kind", "from_the_city"]
+_EMOTIONS = ["calm", "happy", "afraid", "angry", "sad", "excited"]
+
+_PLAYER_LINES = [
+    "Do you remember the harbor at midnight?",
+    "Tell me about the broken clock in the tower.",
+    "Why did you keep the letter from my mother?",
+    "I found the map near the station, what does it mean?",
+    "Are you afraid of the stranger with the tape recorder?",
+    "You lied to me yesterday and I want to know why.",
+]
+_NPC_LINES = [
+    "I remember more than I let on. Keep your voice down.",
+    "The clock stopped the night the signal came, I was there.",
+    "Your mother asked me to keep it, and I keep my promises.",
+    "That map is older than this town. Where exactly did you find it?",
+]
+#------------------------------------------------------------------
+# synthetic prompts
+#------------------------------------------------------------------
+def synthetic_npc(i: int) -> dict:
+    rng = random.Random(100 + i)
+    return {
+        "idNPC": i + 1,
+        "nameFirst": _NAMES[i % len(_NAMES)],
+        "nameLast": None,
+        "age": rng.randint(19, 70),
+        "gender": rng.choice(["female", "male"]),
+        "role": rng.choice(_ROLES),
+        "personality_traits": ", ".join(rng.sample(_TRAITS, 3)),
+        "emotional_tendencies": ", ".join(rng.sample(_EMOTIONS, 2)),
+        "moral_alignment": rng.choice(["lawful good", "neutral", "chaotic good"]),
+        "speech_style": "short sentences, dry humor",
+        "BGcontent": " ".join(rng.choice(_NPC_LINES) for _ in range(6)),
+        "emotion_reactivity": round(rng.uniform(0.2, 0.9), 2),
+    }
+
+def _turn_state(npc: dict, turn: int, rng) -> str:
+    beliefs = "\n".join(
+        f"- personality_trait: {rng.choice(_BELIEFS)} (confidence {rng.uniform(0.3, 0.95):.2f})"
+        for _ in range(rng.randint(4, 10))
+    )
+    dialogue = "\n".join(
+        f"Player: {rng.choice(_PLAYER_LINES)}\nYou: {rng.choice(_NPC_LINES)}"
+        for _ in range(min(turn + 1, 6))
+    )
+    return (
+        f"Current dominant emotion: {rng.choice(_EMOTIONS)}\n"
+        f"Trust toward player: {rng.randint(20, 80)}\n\n"
+        f"Current beliefs about the player:\n{beliefs}\n\n"
+        f"Recent interaction summary:\n{dialogue}"
+    )
+
+def build_messages(stage: str, npc: dict, turn: int, layout: str) -> list:
+    import openAIqueries
+    import prompt_assembly
+    from phase_2_queries import STATIC_NPC_RULES, render_npc_identity
+
+    rng = random.Random(f"{npc['idNPC']}|{turn}|{stage}")
+    player_text = rng.choice(_PLAYER_LINES)
+
+    rules, persona = {
+        "classify_player": (openAIqueries.CLASSIFY_PLAYER_RULES, openAIqueries.render_classifier_persona),
+        "persona_clues": (openAIqueries.PERSONA_CLUES_RULES, openAIqueries.render_npc_profile),
+        "self_beliefs": (openAIqueries.SELF_BELIEF_RULES, openAIqueries.render_npc_profile),
+        "npc_reaction": (openAIqueries.NPC_REACTION_RULES, openAIqueries.render_classifier_persona),
+        "npc_response": (STATIC_NPC_RULES, render_npc_identity),
+    }[stage]
+
+    sections = [
+        prompt_assembly.section("rules", "static", rules),
+        prompt_assembly.section("persona", "npc", persona(npc)),
+        prompt_assembly.section("state", "turn", _turn_state(npc, turn, rng)),
+    ]
+    if layout == "volatile_first":
+        system = "\n\n".join(s["text"] for s in sections[2:] + sections[:2])
+    else:
+        system, _ = prompt_assembly.assemble_prompt(sections)
+
+    if stage == "npc_response":
+        user = "CURRENT SCENE FOR REFERENCE ONLY\n-------------\nThe harbor at dusk.\n\nPLAYER NAME\n-----------\nAlex"
+    elif stage == "npc_reaction":
+        user = f'Player said:\n"""{player_text}"""\n\nNPC responded:\n"""{rng.choice(_NPC_LINES)}"""\n\nDetermine the NPC\'s actual emotional state.'
+    elif stage == "self_beliefs":
+        user = f'NPC spoken text:\n"""{rng.choice(_NPC_LINES)}"""\n\nEvaluate the beliefs about itself this text expresses. Return ONLY valid JSON.'
+    else:
+        user = f'Player text:\n"""{player_text}"""\n\nReturn JSON ONLY.'
+
+    return [{"role": "system", "content": system}, {"role": "user", "content": user}]
+#------------------------------------------------------------------
+# calls
+#------------------------------------------------------------------
+def run_call(client, model: str, stage: str, messages: list) -> dict:
+    from telemetry import chat_completion
+    from structured_output import json_mode
+
+    started = time.perf_counter()
+    out = {"stage": stage, "error": None, "ttft_ms": None, "usage": None, "chars": 0}
+    try:
+        if stage == "npc_response":
+            for chunk in chat_completion(
+                client, stage, model=model, temperature=0.85, top_p=0.9, stream=True,
+                stream_options={"include_usage": True}, messages=messages
+            ):
+                if chunk.choices and getattr(chunk.choices[0].delta, "content", None):
+                    if out["ttft_ms"] is None:
+                        out["ttft_ms"] = (time.perf_counter() - started) * 1000
+                    out["chars"] += len(chunk.choices[0].delta.content)
+                if getattr(chunk, "usage", None):
+                    out["usage"] = chunk.usage
+        else:
+            resp = chat_completion(
+                client, stage, model=model, temperature=0.0, messages=messages,
+                **json_mode(stage, model)
+            )
+            out["usage"] = getattr(resp, "usage", None)
+            out["chars"] = len(resp.choices[0].message.content or "")
+    except Exception as e:
+        out["error"] = f"{type(e).__name__}: {e}"
+    out["ms"] = (time.perf_counter() - started) * 1000
+    return out
+
+def _usage_fields(r: dict) -> dict:
+    usage = r["usage"]
+    if usage is None:
+        return {}
+    prompt = getattr(usage, "prompt_tokens", 0) or 0
+    hit = getattr(usage, "prompt_cache_hit_tokens", None)
+    if hit is None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        hit = getattr(details, "cached_tokens", None) if details else None
+    return {
+        "prompt_tokens": prompt,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+        "prompt_ms": getattr(usage, "prompt_eval_ms", None),
+        "cache_hit": hit / prompt if hit is not None and prompt else None,
+    }
+
+def percentiles(values) -> dict:
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return {}
+    pick = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+    return {"p50": pick(0.50), "p95": pick(0.95), "n": len(values)}
+
+def _fmt(p: dict, key="p50", unit="") -> str:
+    return f"{p[key]:8.0f}{unit}" if p else f"{'-':>8s}{unit}"
+#------------------------------------------------------------------
+# passes
+#------------------------------------------------------------------
+def replay(client, models: dict, npcs: list, turns: int, layout: str, stages: list) -> list:
+    rows = []
+    for turn in range(turns):
+        for npc in npcs:
+            for stage in stages:
+                messages = build_messages(stage, npc, turn, layout)
+                r = run_call(client, models[stage], stage, messages)
+                r.update(_usage_fields(r), turn=turn, idNPC=npc["idNPC"])
+                rows.append(r)
+                if r["error"]:
+                    print(f"  ! {stage} npc {npc['idNPC']} turn {turn}: {r['error']}")
+    return rows
+
+def report_replay(label: str, rows: list, stages: list) -> dict:
+    print(f"\n{label}")
+    print(f"{'stage':16s} {'cold p50':>9s} {'warm p50':>9s} {'warm p95':>9s} "
+          f"{'prompt_ms cold':>15s} {'warm':>8s} {'ttft p50':>9s} {'cache_hit':>9s} {'errors':>6s}")
+    summary = {}
+    for stage in stages:
+        ok = [r for r in rows if r["stage"] == stage and not r["error"]]
+        cold = [r for r in ok if r["turn"] == 0]
+        warm = [r for r in ok if r["turn"] > 0]
+        hits = [r["cache_hit"] for r in warm if r.get("cache_hit") is not None]
+        s = {
+            "cold_ms": percentiles(r["ms"] for r in cold),
+            "warm_ms": percentiles(r["ms"] for r in warm),
+            "cold_prompt_ms": percentiles(r.get("prompt_ms") for r in cold),
+            "warm_prompt_ms": percentiles(r.get("prompt_ms") for r in warm),
+            "ttft_ms": percentiles(r["ttft_ms"] for r in warm),
+            "cache_hit": sum(hits) / len(hits) if hits else None,
+            "errors": sum(1 for r in rows if r["stage"] == stage and r["error"]),
+        }
+        summary[stage] = s
+        hit = f"{s['cache_hit'] * 100:.0f}%" if s["cache_hit"] is not None else "-"
+        print(
+            f"{stage:16s} {_fmt(s['cold_ms'])} ms{_fmt(s['warm_ms'])} ms{_fmt(s['warm_ms'], 'p95')} ms"
+            f"{_fmt(s['cold_prompt_ms'])} ms    {_fmt(s['warm_prompt_ms'])} ms{_fmt(s['ttft_ms'])} ms"
+            f"{hit:>9s} {s['errors']:6d}"
+        )
+    return summary
+
+def throughput(client, models: dict, npcs: list, stages: list, concurrency: int, seconds: float) -> dict:
+    stop = Event()
+    rows = []
+
+    def worker(n):
+        rng = random.Random(n)
+        turn = 1
+        while not stop.is_set():
+            stage = rng.choice(stages)
+            messages = build_messages(stage, rng.choice(npcs), turn, "prefix")
+            r = run_call(client, models[stage], stage, messages)
+            r.update(_usage_fields(r))
+            rows.append(r)
+            turn += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for n in range(concurrency):
+            pool.submit(worker, n)
+        time.sleep(seconds)
+        stop.set()
+    elapsed = time.perf_counter() - started      # includes the calls still in flight at the end
+
+    ok = [r for r in rows if not r["error"]]
+    tokens = sum(r.get("completion_tokens", 0) for r in ok)
+    result = {
+        "concurrency": concurrency,
+        "requests": len(ok),
+        "errors": len(rows) - len(ok),
+        "requests_per_s": len(ok) / elapsed,
+        "completion_tokens_per_s": tokens / elapsed,
+        "latency_ms": percentiles(r["ms"] for r in ok),
+    }
+    lat = result["latency_ms"]
+    print(
+        f"  concurrency {concurrency:3d}: {result['requests_per_s']:6.2f} req/s "
+        f"{result['completion_tokens_per_s']:8.1f} tok/s  "
+        f"p50 {lat.get('p50', 0):7.0f} ms  p95 {lat.get('p95', 0):7.0f} ms  errors {result['errors']}"
+    )
+    return result
+#------------------------------------------------------------------
+def make_target(name: str, args):
+    """
+    (client, {stage: model}) for "ollama" or a hosted LLM_PROVIDER name.
+    """
+    if name == "ollama":
+        from ollama_provider import OllamaClient, OLLAMA_BASE_URL, local_model
+        client = OllamaClient(args.ollama_url or OLLAMA_BASE_URL)
+        return client, {stage: args.ollama_model or local_model(stage) for stage in STAGES}
+    from openAIqueries import get_llm_client
+    return get_llm_client(name), {stage: args.hosted_model for stage in STAGES}
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="local Ollama vs hosted provider, per stage")
+    parser.add_argument("--targets", default="ollama,deepseek", help="ollama and/or LLM_PROVIDER names")
+    parser.add_argument("--stages", default=",".join(STAGES))
+    parser.add_argument("--layouts", default="prefix", help=f"comma list of {', '.join(LAYOUTS)}")
+    parser.add_argument("--npcs", type=int, default=2)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--concurrency", default="", help="e.g. 1,2,4 for the throughput pass")
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--ollama-url", help="default OLLAMA_BASE_URL")
+    parser.add_argument("--ollama-model", help="one model for every stage (default OLLAMA_MODEL[_<STAGE>])")
+    parser.add_argument("--hosted-model", default="deepseek-chat")
+    parser.add_argument("--no-warm-up", action="store_true", help="let the cold pass include the model load")
+    parser.add_argument("--out", help="write the results as JSON")
+    args = parser.parse_args()
+
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    layouts = [l.strip() for l in args.layouts.split(",") if l.strip()]
+    npcs = [synthetic_npc(i) for i in range(args.npcs)]
+    results = {}
+
+    for name in [t.strip() for t in args.targets.split(",") if t.strip()]:
+        client, models = make_target(name, args)
+        print(f"\n=== {name} ({', '.join(sorted({models[s] for s in stages}))})")
+        if name == "ollama" and not args.no_warm_up:
+            for model, ms in client.warm_up(sorted({models[s] for s in stages})).items():
+                print(f"  warm-up {model}: {ms} ms")
+
+        results[name] = {"models": {s: models[s] for s in stages}, "replay": {}, "throughput": []}
+        for layout in layouts:
+            rows = replay(client, models, npcs, args.turns, layout, stages)
+            results[name]["replay"][layout] = report_replay(
+                f"{name} / {layout}: {args.npcs} NPCs x {args.turns} turns", rows, stages
+            )
+
+        levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+        if levels:
+            print(f"\n{name} throughput ({args.seconds:.0f} s per level)")
+            for c in levels:
+                results[name]["throughput"].append(throughput(client, models, npcs, stages, c, args.seconds))
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nresults -> {args.out}")
@@ -0,0 +1,128 @@
+import argparse
+import json
+import random
+import time
+from storage_codec import encode_bytes, decode_bytes, zstandard
+#------------------------------------------------------------------
+# Storage codec benchmark
+#
+#   python bench_storage.py          # synthetic relationships
+#   python bench_storage.py --db     # + the real tables (uses .env)
+#
+# kbText is generated in the MEMORY_SCHEMA_INSTRUCTIONS format at
+# typical relationship sizes. "stored" is what sits in the LONGBLOB
+# and what a SELECT sends over the wire (plus protocol framing).
+#------------------------------------------------------------------
+SIZES_KB = [10, 50, 150, 350]
+
+_WORDS = (
+    "archive river glitch pattern notebook coffee tower station letter "
+    "mother school Boston Denver harbor window promise secret trust fear "
+    "midnight signal record tape broken clock pattern map stranger"
+).split()
+_EMOTIONS = ["calm", "curious", "suspicious", "happy", "afraid", "angry"]
+
+def _sentence(rng) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(rng.randint(6, 22))).capitalize() + "."
+
+def synthetic_kbtext(size_kb: int, seed: int = 7) -> str:
+    rng = random.Random(seed)
+    scenes = []
+    total = 0
+    s = 0
+    while total < size_kb * 1024:
+        s += 1
+        lines = [
+            f"=== SCENE: scene_{s} ===",
+            f"Where: {_sentence(rng)}",
+            f"When: {_sentence(rng)}",
+            f"How we got here: {_sentence(rng)}",
+            f"NPC lens: {_sentence(rng)}",
+            "",
+            "EPISODES (compressed)",
+        ]
+        lines += [f"- {_sentence(rng)}" for _ in range(rng.randint(2, 6))]
+        lines += ["", "EPISODES (in order)"]
+        for n in range(1, 6):
+            speaker = "player" if n % 2 else "npc"
+            lines += [
+                f"[{n}]",
+                f"Speaker: {speaker}",
+                f'Said: "{_sentence(rng)} {_sentence(rng)}"',
+                f"Responding to: {'none' if n == 1 else f'[{n - 1}]'}",
+                f"Intensity: {rng.random():.2f}",
+                f"Notes (my bias): {_sentence(rng)}",
+                "",
+            ]
+        lines += [f"Scene peak intensity: {rng.random():.2f}", "--- END SCENE ---"]
+        scene = "\n".join(lines)
+        scenes.append(scene)
+        total += len(scene) + 2
+    return "\n\n".join(scenes)[: size_kb * 1024]
+
+def synthetic_buffer_json(seed: int = 7) -> bytes:
+    rng = random.Random(seed)
+    beliefs = {
+        key: [{"value": rng.choice(_WORDS), "confidence": round(rng.random(), 2)} for _ in range(4)]
+        for key in ("personality_traits", "likes", "dislikes", "goals", "secrets")
+    }
+    return json.dumps(beliefs).encode("utf-8")
+#------------------------------------------------------------------
+def bench(raw: bytes, codec: str, repeat: int = 20) -> dict:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        stored = encode_bytes(raw, codec)
+    enc_ms = (time.perf_counter() - start) * 1000 / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        decode_bytes(stored)
+    dec_ms = (time.perf_counter() - start) * 1000 / repeat
+
+    assert decode_bytes(stored) == raw
+    return {"stored": len(stored), "ratio": len(stored) / len(raw), "enc_ms": enc_ms, "dec_ms": dec_ms}
+
+def print_row(label, raw_len, codec, r):
+    print(
+        f"{label:18s} {codec:5s} {raw_len:>10,d} B -> {r['stored']:>10,d} B "
+        f"({r['ratio']:.2f})  enc {r['enc_ms']:7.2f} ms  dec {r['dec_ms']:6.2f} ms"
+    )
+
+def bench_db():
+    from dotenv import load_dotenv
+    from phase_2_queries import connect
+    from storage_codec import decode_text
+    load_dotenv()
+
+    db = connect()
+    cursor = db.cursor()
+    cursor.execute("SELECT kbText FROM npc_user_memory WHERE kbText IS NOT NULL")
+    stored = raw = rows = 0
+    for (value,) in cursor.fetchall():
+        rows += 1
+        stored += len(value) if isinstance(value, (bytes, bytearray)) else len(value.encode("utf-8"))
+        raw += len(decode_text(value).encode("utf-8"))
+    cursor.close()
+    db.close()
+    print(f"\n[DB] npc_user_memory: {rows} rows, {raw:,d} B text, {stored:,d} B stored "
+          f"({stored / raw if raw else 1:.2f})")
+#------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", action="store_true", help="also measure the live tables")
+    args = parser.parse_args()
+
+    codecs = ["none", "zlib"] + (["zstd"] if zstandard else [])
+    print(f"codecs: {', '.join(codecs)}" + ("" if zstandard else "  (pip install zstandard for zstd)"))
+
+    for size in SIZES_KB:
+        raw = synthetic_kbtext(size).encode("utf-8")
+        for codec in codecs:
+            print_row(f"kbText {size}KB", len(raw), codec, bench(raw, codec))
+
+    raw = synthetic_buffer_json()
+    for codec in codecs:
+        print_row("buffer json", len(raw), codec, bench(raw, codec, repeat=200))
+
+    if args.db:
+        bench_db()
@@ -0,0 +1,164 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+from launcher import Launcher
+#------------------------------------------------------------------
+# Worker scaling benchmark
+#
+#   python bench_workers.py --max-workers 4 --clients 16 --seconds 10
+#
+# Runs launcher.py with 1, 2, 4 ... workers and drives POST
+# /npc_interact through the sticky router. Workers are synthetic
+# (bench_workers.py --worker): each turn runs the local CPU work of a
+# real turn -- BM25 scene retrieval over a long kbText and belief
+# ranking -- with LLM / TTS / MySQL left out, so the numbers show how
+# the CPU-bound part scales with processes. Also checks that every
+# idUser was always answered by the same worker.
+#
+# Use --app "app.py" to drive the real app instead (needs the db and
+# an LLM provider).
+#------------------------------------------------------------------
+BENCH_PORT = 5201
+BENCH_BASE_PORT = 5301
+USERS = 64
+
+_PLAYER_LINES = [
+    "Do you remember the harbor at midnight?",
+    "Tell me about the broken clock in the tower.",
+    "Why did you keep the letter from my mother?",
+    "I found the map near the station, what does it mean?",
+    "Are you afraid of the stranger with the tape recorder?",
+]
+#------------------------------------------------------------------
+# synthetic worker
+#------------------------------------------------------------------
+def _synthetic_state():
+    from bench_storage import synthetic_kbtext
+    kbtext = synthetic_kbtext(150)
+    rng = random.Random(3)
+    words = "brave kind curious reserved hostile truthful afraid local_resident inquisitive".split()
+    beliefs = [
+        {"beliefType": f"trait_{i % 7}", "beliefValue": f"{rng.choice(words)} {rng.choice(words)}",
+         "confidence": rng.random()}
+        for i in range(80)
+    ]
+    return kbtext, beliefs
+
+
+def serve_synthetic_worker():
+    from memory_retrieval import retrieve_memory
+    from belief_index import relevant_beliefs
+
+    kbtext, beliefs = _synthetic_state()
+    index = os.getenv("WORKER_INDEX", "0")
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            data = json.loads(body)
+            memory, report = retrieve_memory(1, data["idUser"], kbtext, data["playerText"])
+            relevant_beliefs(beliefs, data["playerText"])
+            out = json.dumps({"success": True, "worker": index, "scenes": report["scenes_selected"]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+        def log_message(self, *args):
+            pass
+
+    ThreadingHTTPServer(("127.0.0.1", int(os.getenv("PORT", "5001"))), Handler).serve_forever()
+#------------------------------------------------------------------
+# load generator
+#------------------------------------------------------------------
+def drive(port, clients, seconds):
+    latencies = []
+    seen = {}           # idUser -> set of workers
+    errors = [0]
+    lock = Lock()
+    deadline = time.monotonic() + seconds
+
+    def client(c):
+        rng = random.Random(c)
+        mine = []
+        while time.monotonic() < deadline:
+            idUser = rng.randrange(USERS)
+            body = json.dumps({
+                "idUser": idUser, "idNPC": 1, "idVoice": "bench", "playerName": "bench",
+                "currentScene": "bench", "playerText": rng.choice(_PLAYER_LINES)
+            })
+            started = time.perf_counter()
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+                conn.request("POST", "/npc_interact", body, {"Content-Type": "application/json"})
+                resp = conn.getresponse()
+                data = json.loads(resp.read())
+                conn.close()
+            except (OSError, ValueError, http.client.HTTPException):
+                with lock:
+                    errors[0] += 1
+                continue
+            mine.append(time.perf_counter() - started)
+            with lock:
+                seen.setdefault(idUser, set()).add(data.get("worker"))
+        with lock:
+            latencies.extend(mine)
+
+    threads = [Thread(target=client, args=(c,)) for c in range(clients)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    pct = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000 if latencies else 0.0
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "rps": len(latencies) / elapsed,
+        "p50_ms": pct(0.50),
+        "p95_ms": pct(0.95),
+        "sticky": all(len(w) == 1 for w in seen.values()),
+    }
+#------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="throughput vs number of worker processes")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--app", default=None, help="worker command (default: synthetic worker)")
+    args = parser.parse_args()
+
+    if args.worker:
+        serve_synthetic_worker()
+        raise SystemExit
+
+    app_cmd = args.app.split() if args.app else [os.path.abspath(__file__), "--worker"]
+    counts = sorted({1, args.max_workers} | {2 ** k for k in range(8) if 2 ** k < args.max_workers})
+
+    print(f"cores={os.cpu_count()} clients={args.clients} seconds={args.seconds}")
+    print(f"{'workers':>7} {'req/s':>9} {'speedup':>8} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7} sticky")
+    base = None
+    for n in counts:
+        launcher = Launcher(n, app_cmd, BENCH_PORT, BENCH_BASE_PORT)
+        launcher.start()
+        try:
+            drive(BENCH_PORT, args.clients, 1.0)     # warm-up: index build per user
+            r = drive(BENCH_PORT, args.clients, args.seconds)
+        finally:
+            launcher.stop()
+            launcher.proxy.server_close()
+        base = base or r["rps"]
+        print(
+            f"{n:>7} {r['rps']:>9.1f} {r['rps'] / base:>7.2f}x "
+            f"{r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['errors']:>7} {r['sticky']}"
+        )
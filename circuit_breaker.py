@@ -0,0 +1,152 @@
+import os
+import time
+from threading import Lock
+from urllib.parse import urlparse
+from structured_log import get_logger
+#------------------------------------------------------------------
+# Circuit breakers per provider endpoint
+#
+#   llm:<host>:<model>     every chat_completion (telemetry.py)
+#   tts:elevenlabs         elevenlabsQueries.tts
+#
+# closed     calls go through; BREAKER_FAILURES provider failures in a
+#            row open the breaker
+# open       calls fail at once with CircuitOpen for BREAKER_OPEN_S;
+#            callers degrade (text-only turn, fallback model, canned
+#            line, classifier fallback dicts)
+# half_open  after that, BREAKER_PROBES calls are let through as
+#            probes: a success closes the breaker, a failure opens it
+#            again
+#
+# Only provider-side errors count: timeouts, connection errors, 5xx,
+# 408 and 429. A 4xx for a bad request says nothing about the vendor.
+# State is exported as breaker_* gauges on /metrics.
+#------------------------------------------------------------------
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_OPEN_S = float(os.getenv("BREAKER_OPEN_S", "30"))
+BREAKER_PROBES = int(os.getenv("BREAKER_PROBES", "1"))
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+_breakers = {}
+_breakers_lock = Lock()
+
+logger = get_logger("breaker")
+
+
+class CircuitOpen(RuntimeError):
+    pass
+#------------------------------------------------------------------
+def is_provider_failure(e: Exception) -> bool:
+    status = getattr(e, "status_code", None)
+    if status is None:
+        return not isinstance(e, CircuitOpen)
+    return status >= 500 or status in (408, 429)
+
+
+class CircuitBreaker:
+    def __init__(self, name, failures=BREAKER_FAILURES, open_s=BREAKER_OPEN_S, probes=BREAKER_PROBES):
+        self.name = name
+        self.failure_threshold = failures
+        self.open_s = open_s
+        self.probes = probes
+
+        self.state = CLOSED
+        self.failures = 0           # in a row
+        self.opened_at = 0.0
+        self.probing = []           # start times of probes in flight
+        self.stats = {"opened": 0, "rejected": 0, "failures_total": 0}
+        self._lock = Lock()
+
+    def _transition(self, state):
+        if state != self.state:
+            log = logger.warning if state == OPEN else logger.info
+            log("breaker state", breaker=self.name, previous=self.state, state=state, failures=self.failures)
+            self.state = state
+
+    def is_open(self) -> bool:
+        """
+        True while calls would be rejected (does not take a probe slot).
+        """
+        with self._lock:
+            return self.state == OPEN and time.monotonic() < self.opened_at + self.open_s
+
+    def allow(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN:
+                if now < self.opened_at + self.open_s:
+                    self.stats["rejected"] += 1
+                    return False
+                self._transition(HALF_OPEN)
+                self.probing = []
+
+            if self.state == HALF_OPEN:
+                # a probe that never reported back frees its slot after open_s
+                self.probing = [t for t in self.probing if now - t < self.open_s]
+                if len(self.probing) >= self.probes:
+                    self.stats["rejected"] += 1
+                    return False
+                self.probing.append(now)
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            if self.state == HALF_OPEN:
+                self.probing = []
+                self._transition(CLOSED)
+
+    def failure(self, e: Exception | None = None):
+        if e is not None and not is_provider_failure(e):
+            self.success()      # the provider answered
+            return
+        with self._lock:
+            self.failures += 1
+            self.stats["failures_total"] += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self.probing = []
+                self.stats["opened"] += 1
+                self._transition(OPEN)
+
+    def check(self):
+        """
+        allow() or raise CircuitOpen.
+        """
+        if not self.allow():
+            raise CircuitOpen(self.name)
+
+    def reject_if_open(self):
+        """
+        Raises CircuitOpen while open, without taking a probe slot
+        (a fast fail before queueing for the call).
+        """
+        with self._lock:
+            if self.state == OPEN and time.monotonic() < self.opened_at + self.open_s:
+                self.stats["rejected"] += 1
+                raise CircuitOpen(self.name)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"state": STATE_CODES[self.state], "failures": self.failures, **self.stats}
+#------------------------------------------------------------------
+def get_breaker(name: str) -> CircuitBreaker:
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name)
+        return breaker
+
+def provider_name(client) -> str:
+    base_url = getattr(client, "base_url", None)
+    return urlparse(str(base_url)).hostname if base_url else type(client).__name__
+
+def llm_breaker(client, model: str) -> CircuitBreaker:
+    return get_breaker(f"llm:{provider_name(client)}:{model}")
+
+def breaker_stats() -> dict:
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {b.name: b.snapshot() for b in breakers}
@@ -260,7 +260,11 @@ ENGINE = InnoDB;
 CREATE TABLE IF NOT EXISTS `camodb`.`npc_user_memory` (
   `idNPC` INT NOT NULL,
   `idUser` INT NOT NULL,
-  `kbText` LONGTEXT NULL DEFAULT NULL,
+  -- <codec header byte><payload>, see storage_codec.py
+  `kbText` LONGBLOB NULL DEFAULT NULL,
+  -- bumped on every write; background writers compare-and-swap on it
+  -- existing db: ALTER TABLE npc_user_memory ADD COLUMN version INT NOT NULL DEFAULT 1 AFTER kbText;
+  `version` INT NOT NULL DEFAULT 1,
   `updatedAt` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
   PRIMARY KEY (`idNPC`, `idUser`),
   INDEX `fk_KB_user1_idx` (`idUser` ASC) VISIBLE,
@@ -292,19 +296,21 @@ CREATE TABLE IF NOT EXISTS `camodb`.`npc_user_memory_buffer` (
   `npcEmotion` VARCHAR(64) NULL,
   `npcIntensity` FLOAT NULL,
 
-  `selfBeliefsJson` JSON NULL,   -- optional, store extracted self-beliefs
-  `playerBeliefsJson` JSON NULL,   -- optional, store extracted player-beliefs
-  `playerOutputClassifiedAsJson` JSON NULL,   -- optional, store extracted player output classifiction
+  -- JSON, compressed with storage_codec (header byte + payload)
+  `selfBeliefsJson` LONGBLOB NULL,   -- optional, store extracted self-beliefs
+  `playerBeliefsJson` LONGBLOB NULL,   -- optional, store extracted player-beliefs
+  `playerOutputClassifiedAsJson` LONGBLOB NULL,   -- optional, store extracted player output classifiction
   
   `metaJson` JSON NULL,          -- optional, any extra (scene tag, model, etc.)
 
   `createdAt` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
   `processedAt` DATETIME NULL,
-  `processed` TINYINT(1) NOT NULL DEFAULT 0,
+  `processed` TINYINT(1) NOT NULL DEFAULT 0,   -- 0 pending, 1 consolidated, 2 orphaned (player turn without NPC reply, or the reverse)
 
   PRIMARY KEY (`idBuffer`),
 
   INDEX `idx_mem_buf_npc_user_processed_created` (`idNPC`, `idUser`, `processed`, `createdAt`),
+  INDEX `idx_mem_buf_processed_at` (`processed`, `processedAt`),   -- retention scans
 
   CONSTRAINT `fk_mem_buf_npc`
     FOREIGN KEY (`idNPC`)
@@ -593,6 +599,32 @@ CREATE TABLE player_input_classification_log (
     INDEX idx_created (createdAt)
 );
 
+-- -----------------------------------------------------
+-- Running aggregates over player_input_classification_log
+-- one row per (user, npc, dimension, label), kept in step
+-- with the log by record_classification_stats.
+-- statKey 'total' holds the overall count / intensity sum /
+-- offensive count, the others hold per-label counts.
+-- rebuild with: python backfill_research_stats.py
+-- -----------------------------------------------------
+CREATE TABLE player_input_classification_stats (
+    idUser INT NOT NULL,
+    idNPC INT NOT NULL,
+
+    statKey ENUM('total', 'sentiment', 'emotion', 'target') NOT NULL,
+    statValue VARCHAR(100) NOT NULL DEFAULT '',
+
+    count INT NOT NULL DEFAULT 0,
+    intensitySum DOUBLE NOT NULL DEFAULT 0,
+    offensiveCount INT NOT NULL DEFAULT 0,
+
+    updatedAt DATETIME NOT NULL
+      DEFAULT CURRENT_TIMESTAMP
+      ON UPDATE CURRENT_TIMESTAMP,
+
+    PRIMARY KEY (idUser, idNPC, statKey, statValue)
+);
+
 CREATE TABLE npc_self_belief (
   idNPC INT NOT NULL,
 
@@ -622,6 +654,98 @@ CREATE TABLE npc_self_belief (
     ON DELETE CASCADE
 );
 
+-- -----------------------------------------------------
+-- Archives (memory_retention.py)
+-- processed buffer rows and old classification logs are moved
+-- here in batches. Monthly RANGE partitions on createdAt are added
+-- by the retention run (split off pmax) and old months can be
+-- dropped whole. Partitioned tables take no foreign keys.
+-- -----------------------------------------------------
+CREATE TABLE npc_user_memory_buffer_archive (
+  idBuffer BIGINT NOT NULL,
+  idNPC INT NOT NULL,
+  idUser INT NOT NULL,
+
+  playerText LONGTEXT NULL,
+  npcText LONGTEXT NULL,
+  npcEmotion VARCHAR(64) NULL,
+  npcIntensity FLOAT NULL,
+
+  selfBeliefsJson LONGBLOB NULL,
+  playerBeliefsJson LONGBLOB NULL,
+  playerOutputClassifiedAsJson LONGBLOB NULL,
+  metaJson JSON NULL,
+
+  createdAt DATETIME NOT NULL,
+  processedAt DATETIME NULL,
+  processed TINYINT(1) NOT NULL,
+  archivedAt DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+  PRIMARY KEY (idBuffer, createdAt),
+  INDEX idx_buf_archive_pair (idNPC, idUser, createdAt)
+)
+PARTITION BY RANGE COLUMNS(createdAt) (
+  PARTITION pmax VALUES LESS THAN (MAXVALUE)
+);
+
+CREATE TABLE player_input_classification_log_archive (
+  idLog INT NOT NULL,
+  idUser INT NOT NULL,
+  idNPC INT NOT NULL,
+
+  playerText LONGTEXT NOT NULL,
+  sentiment VARCHAR(50),
+  intensity FLOAT DEFAULT 0.0,
+  offensive TINYINT(1) DEFAULT 0,
+  emotion VARCHAR(100),
+  target VARCHAR(100),
+  trust_delta INT DEFAULT 0,
+  modelUsed VARCHAR(100),
+  temperature FLOAT DEFAULT 0.0,
+
+  createdAt DATETIME NOT NULL,
+  archivedAt DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+  PRIMARY KEY (idLog, createdAt),
+  INDEX idx_log_archive_pair (idUser, idNPC)
+)
+PARTITION BY RANGE COLUMNS(createdAt) (
+  PARTITION pmax VALUES LESS THAN (MAXVALUE)
+);
+
+-- -----------------------------------------------------
+-- Durable kbText consolidation queue
+-- one job per (npc, user) pair with unconsolidated buffer rows.
+-- enqueue bumps `generation`; a worker leases the job, drains the
+-- buffer, and deletes the job only if no enqueue happened meanwhile.
+-- expired leases are picked up again (at-least-once), failures are
+-- retried with backoff until `attempts` reaches the limit ('dead').
+-- -----------------------------------------------------
+CREATE TABLE memory_consolidation_job (
+  idNPC INT NOT NULL,
+  idUser INT NOT NULL,
+
+  status ENUM('pending', 'leased', 'dead') NOT NULL DEFAULT 'pending',
+  generation INT NOT NULL DEFAULT 1,
+  attempts INT NOT NULL DEFAULT 0,
+
+  leaseOwner VARCHAR(64) NULL,
+  leaseUntil DATETIME NULL,
+  availableAt DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+  lastError TEXT NULL,
+
+  createdAt DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  updatedAt DATETIME NOT NULL
+    DEFAULT CURRENT_TIMESTAMP
+    ON UPDATE CURRENT_TIMESTAMP,
+
+  PRIMARY KEY (idNPC, idUser),
+
+  INDEX idx_job_due (status, availableAt),
+  INDEX idx_job_lease (status, leaseUntil)
+);
+
 
 
 -- -----------------------------------------------------
@@ -1,8 +1,20 @@
 import os
 from elevenlabs.client import ElevenLabs
 from dotenv import load_dotenv
+from mock_provider import mock_tts
+from structured_log import get_logger
+from circuit_breaker import get_breaker
 load_dotenv(".env")
 
+logger = get_logger("tts")
+
+# "elevenlabs" | "mock" (synthetic MP3, see mock_provider.py)
+TTS_PROVIDER = os.getenv("TTS_PROVIDER", "elevenlabs").lower()
+TTS_TIMEOUT_S = float(os.getenv("TTS_TIMEOUT_S", "20"))
+
+# open -> tts() raises CircuitOpen at once and the turn goes text-only
+tts_breaker = get_breaker(f"tts:{TTS_PROVIDER}")
+
 # ----------------------------------------------------------------
 # SPEECH TO TEXT (for human input)
 # ----------------------------------------------------------------
@@ -22,7 +34,14 @@ def speech_to_text(wav_path: str) -> str:
 # ----------------------------------------------------------------
 def tts(text, voice_id, emotion):
 
-    client = ElevenLabs(api_key=os.getenv("ELEVENLABS_API_KEY"))
+    tts_breaker.check()
+
+    if TTS_PROVIDER == "mock":
+        yield from mock_tts(text, voice_id, emotion)
+        tts_breaker.success()
+        return
+
+    client = ElevenLabs(api_key=os.getenv("ELEVENLABS_API_KEY"), timeout=TTS_TIMEOUT_S)
 
     EMOTION_CUES = {
         # core
@@ -53,12 +72,14 @@ def tts(text, voice_id, emotion):
             ]
         )
 
-        if isinstance(audio, (bytes, bytearray)):
-            yield audio
-        else:
+        if not isinstance(audio, (bytes, bytearray)):
             # some SDKs return iterable chunks even without stream=True
-            yield b"".join(audio)
+            audio = b"".join(audio)
 
     except Exception as e:
-        print("ERROR ElevenLabs TTS:", e)
-        raise
\ No newline at end of file
+        tts_breaker.failure(e)
+        logger.error("ElevenLabs TTS failed", voice_id=voice_id, error=str(e))
+        raise
+
+    tts_breaker.success()
+    yield audio
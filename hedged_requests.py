@@ -0,0 +1,168 @@
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Lock
+from telemetry import chat_completion, current_trace, use_trace, inc
+from circuit_breaker import is_provider_failure, CircuitOpen
+from structured_log import get_logger
+#------------------------------------------------------------------
+# Deadlines + hedged requests for the JSON classifier calls
+#
+# Each stage has a deadline (env LLM_DEADLINE_<STAGE>_MS overrides).
+# The request goes out on a pool thread; if it has not answered after
+# the stage's hedge delay -- the p90 of its recent latencies -- a
+# second request goes to the hedge client (LLM_HEDGE_PROVIDER, same
+# provider by default) and whichever answers first wins. A request
+# that fails with a provider error (circuit_breaker.is_provider_failure)
+# before the hedge delay is hedged right away; any other failure, e.g.
+# a 400 for a bad request, would fail the hedge the same way and is
+# raised without one.
+#
+# At the deadline DeadlineExceeded is raised and the caller uses its
+# fallback. Both requests carry timeout=<time left> so the HTTP calls
+# are abandoned at the deadline too.
+#
+# The losing request is abandoned, not cancelled: the SDK call cannot
+# be interrupted, so it keeps its pool thread and scheduler slot, is
+# billed by the provider and reports to the breaker until it answers
+# or its timeout runs out. LLM_HEDGE_MAX_RATE bounds that cost.
+#
+#   LLM_HEDGE=1               0 = deadline only, no second request
+#   LLM_HEDGE_MIN_MS=300      never hedge earlier than this
+#   LLM_HEDGE_MAX_RATE=0.2    at most this share of calls is hedged
+#------------------------------------------------------------------
+STAGE_DEADLINES_MS = {
+    "classify_player":  4000,
+    "persona_clues":    6000,
+    "self_beliefs":     8000,
+    "npc_reaction":     4000,
+}
+
+LLM_HEDGE = os.getenv("LLM_HEDGE", "1") == "1"
+HEDGE_MIN_S = float(os.getenv("LLM_HEDGE_MIN_MS", "300")) / 1000
+HEDGE_MAX_RATE = float(os.getenv("LLM_HEDGE_MAX_RATE", "0.2"))
+HEDGE_QUANTILE = 0.9
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 200
+HEDGE_WORKERS = int(os.getenv("LLM_HEDGE_WORKERS", "32"))
+
+_pool = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="llm-hedge")
+
+_latencies = {}     # stage -> deque of seconds
+_stats = {}         # stage -> Counter
+_lock = Lock()
+
+logger = get_logger("hedge")
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+#------------------------------------------------------------------
+def stage_deadline(stage: str) -> float:
+    override = os.getenv(f"LLM_DEADLINE_{stage.upper()}_MS")
+    if override:
+        return float(override) / 1000
+    return STAGE_DEADLINES_MS.get(stage, 8000) / 1000
+
+def hedge_delay(stage: str, deadline: float) -> float:
+    """
+    p90 of the stage's recent latencies; half the deadline until there
+    are enough samples.
+    """
+    with _lock:
+        samples = sorted(_latencies.get(stage, ()))
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        delay = deadline / 2
+    else:
+        delay = samples[min(len(samples) - 1, int(HEDGE_QUANTILE * len(samples)))]
+    return max(HEDGE_MIN_S, min(delay, deadline * 0.8))
+
+def _record(stage: str, event: str, latency: float | None = None):
+    with _lock:
+        _stats.setdefault(stage, Counter())[event] += 1
+        if latency is not None:
+            _latencies.setdefault(stage, deque(maxlen=HEDGE_WINDOW)).append(latency)
+    inc("llm_hedge_total", stage=stage, event=event)
+
+def _hedge_allowed(stage: str) -> bool:
+    with _lock:
+        c = _stats.get(stage)
+        return not c or c["hedged"] < HEDGE_MAX_RATE * c["call"] + 1
+
+def hedge_stats() -> dict:
+    with _lock:
+        return {
+            stage: {
+                **dict(c),
+                "hedge_rate": round(c["hedged"] / c["call"], 4) if c["call"] else 0.0,
+                "p90_ms": round(1000 * sorted(_latencies[stage])[int(HEDGE_QUANTILE * (len(_latencies[stage]) - 1))])
+                          if _latencies.get(stage) else None,
+            }
+            for stage, c in _stats.items()
+        }
+#------------------------------------------------------------------
+def hedged_completion(client, stage: str, hedge_client=None, hedge_model=None, **kwargs):
+    """
+    chat_completion(client, stage, **kwargs) under the stage deadline,
+    hedged as described above. hedge_client is a client or a callable
+    returning one (built only if the hedge fires). Raises
+    DeadlineExceeded, or the first error when every request failed.
+    The loser of a hedge is left to finish on its own.
+    """
+    deadline = stage_deadline(stage)
+    started = time.monotonic()
+    end = started + deadline
+    trace = current_trace()
+    _record(stage, "call")
+
+    def call(c, overrides):
+        call_started = time.monotonic()
+        remaining = end - call_started
+        if remaining <= 0:
+            raise DeadlineExceeded(stage)
+        if hasattr(c, "with_options"):
+            c = c.with_options(max_retries=0)
+        with use_trace(trace):
+            resp = chat_completion(c, stage, **{**kwargs, **overrides, "timeout": remaining})
+        return resp, time.monotonic() - call_started
+
+    pending = {_pool.submit(call, client, {}): "primary"}
+    hedge_at = started + hedge_delay(stage, deadline) if LLM_HEDGE else None
+    first_error = None
+
+    while pending:
+        until = min(end, hedge_at) if hedge_at is not None else end
+        done, _ = wait(list(pending), timeout=max(0.0, until - time.monotonic()), return_when=FIRST_COMPLETED)
+
+        for future in done:
+            role = pending.pop(future)
+            try:
+                resp, seconds = future.result()
+            except Exception as e:
+                first_error = first_error or e
+                logger.warning("classifier request failed", stage=stage, role=role, error=str(e))
+                if not is_provider_failure(e) and not isinstance(e, CircuitOpen):
+                    # the request itself is bad; a hedge would fail too
+                    hedge_at = None
+                continue
+            _record(stage, "hedge_won" if role == "hedge" else "primary_won", seconds)
+            return resp
+
+        now = time.monotonic()
+        if now >= end:
+            break
+        if hedge_at is not None and (now >= hedge_at or not pending):
+            hedge_at = None
+            if _hedge_allowed(stage):
+                target = hedge_client() if callable(hedge_client) else (hedge_client or client)
+                pending[_pool.submit(call, target, {"model": hedge_model} if hedge_model else {})] = "hedge"
+                _record(stage, "hedged")
+
+    if pending or time.monotonic() >= end:
+        for future in pending:
+            future.cancel()
+        _record(stage, "deadline", deadline)
+        logger.warning("classifier deadline exceeded, using fallback", stage=stage, deadline_ms=round(deadline * 1000))
+        raise DeadlineExceeded(stage)
+    raise first_error
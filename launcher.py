@@ -0,0 +1,301 @@
+import argparse
+import json
+import os
+import shlex
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import time
+import zlib
+from threading import Thread
+from urllib.parse import urlsplit, parse_qs
+from dotenv import load_dotenv
+#------------------------------------------------------------------
+# Multi-process launcher with sticky routing by idUser
+#
+# A player's turn state (delta-state versions, BM25 index, belief
+# vectors, prompt-prefix cache) lives in the process that serves it,
+# so every connection for the same idUser has to land on the same
+# worker. The launcher
+#   - starts N copies of app.py on WORKER_BASE_PORT + i
+#   - listens on PORT and routes each TCP connection to
+#       crc32(idUser) % N
+#     idUser is taken from the query string (Socket.IO clients connect
+#     with ?idUser=...) or from the JSON body of POST /npc_interact;
+#     connections without one are routed by client address
+#   - restarts workers that exit
+#
+# Workers share one backend (shared_backend.py) for the TTS cache
+# locks / clip metadata; if SHARED_BACKEND_URL is not set the launcher
+# serves its in-memory RESP stand-in on SHARED_BACKEND_PORT.
+#
+# Socket.IO emits are fanned out through that backend (SOCKETIO_FANOUT=1)
+# by default: a socket that connects without ?idUser= is routed by client
+# address, so it can sit on another worker than the /npc_interact that
+# emits to its room. Only when EVERY client connects with
+#     http://host:PORT?idUser=<idUser>
+# (npc_cli_test.py, load_test.py) does --sticky-sockets (SOCKETIO_FANOUT=0)
+# keep the emits local.
+#
+# npc_state_update deltas are versioned per process (phase_2_queries).
+# With fan-out and more than one worker, register_user / request_npc_state
+# and the turn's state emitter can run on different workers, which would
+# send the room two interleaved version sequences diffed against
+# different snapshots. The launcher therefore runs those workers with
+# NPC_STATE_MODE=full; deltas are only kept with --sticky-sockets (or a
+# single worker), where every event of a user reaches the same process.
+#
+# Workers serve through eventlet / gevent when installed. The Werkzeug
+# dev server is refused by Flask-SocketIO outside debug; --dev-server
+# (ALLOW_UNSAFE_WERKZEUG=1) allows it for local testing only.
+#
+# LLM limits (llm_scheduler.py) are per process; LLM_WORKERS=N makes
+# each worker enforce 1/N of LLM_RATE_RPS / LLM_RATE_TPM /
+# LLM_MAX_CONCURRENT so the deployment as a whole stays within them.
+#
+# Routing is per connection: a keep-alive connection stays on the
+# worker chosen by its first request.
+#
+#   python launcher.py --workers 4
+#------------------------------------------------------------------
+load_dotenv()
+
+PORT = int(os.getenv("PORT", "5001"))
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", "5101"))
+SHARED_BACKEND_PORT = int(os.getenv("SHARED_BACKEND_PORT", "6390"))
+MAX_HEAD_BYTES = 64 * 1024
+MAX_ROUTE_BODY_BYTES = 1024 * 1024
+PIPE_CHUNK = 64 * 1024
+RESTART_DELAY_S = 1.0
+#------------------------------------------------------------------
+def worker_for(idUser, n_workers: int) -> int:
+    # crc32, not hash(): must be stable across restarts and processes
+    return zlib.crc32(str(idUser).encode("utf-8")) % n_workers
+
+def _parse_head(head: bytes):
+    """
+    (method, path, headers) of an HTTP request head.
+    """
+    lines = head.decode("latin-1").split("\r\n")
+    parts = lines[0].split(" ")
+    method, path = (parts[0], parts[1]) if len(parts) >= 2 else ("", "/")
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+    return method, path, headers
+
+def route_key(head: bytes, body: bytes):
+    """
+    idUser for this request, or None.
+    """
+    method, path, _ = _parse_head(head)
+    url = urlsplit(path)
+    values = parse_qs(url.query).get("idUser")
+    if values:
+        return values[0]
+    if method == "POST" and body:
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return None
+        if isinstance(data, dict) and data.get("idUser") is not None:
+            return data["idUser"]
+    return None
+#------------------------------------------------------------------
+# proxy
+#------------------------------------------------------------------
+def _pipe(src, dst):
+    try:
+        while True:
+            chunk = src.recv(PIPE_CHUNK)
+            if not chunk:
+                break
+            dst.sendall(chunk)
+    except OSError:
+        pass
+    finally:
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+class _ProxyHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        client = self.request
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        data = b""
+        while b"\r\n\r\n" not in data:
+            chunk = client.recv(PIPE_CHUNK)
+            if not chunk:
+                return
+            data += chunk
+            if len(data) > MAX_HEAD_BYTES:
+                return
+        head, _, body = data.partition(b"\r\n\r\n")
+
+        # the routing key of POST /npc_interact is in the body
+        method, path, headers = _parse_head(head)
+        if method == "POST" and urlsplit(path).path.startswith("/npc_interact"):
+            length = int(headers.get("content-length", "0") or 0)
+            while len(body) < min(length, MAX_ROUTE_BODY_BYTES):
+                chunk = client.recv(PIPE_CHUNK)
+                if not chunk:
+                    break
+                body += chunk
+
+        key = route_key(head, body)
+        if key is None:
+            key = self.client_address[0]
+        index = worker_for(key, len(self.server.ports))
+
+        try:
+            upstream = socket.create_connection(("127.0.0.1", self.server.ports[index]), timeout=5)
+        except OSError as e:
+            print(f"[LAUNCHER] worker {index} unreachable: {e}")
+            client.sendall(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            return
+        upstream.settimeout(None)
+        upstream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        try:
+            upstream.sendall(head + b"\r\n\r\n" + body)
+            back = Thread(target=_pipe, args=(upstream, client), daemon=True)
+            back.start()
+            _pipe(client, upstream)
+            back.join()
+        finally:
+            upstream.close()
+
+
+class StickyProxy(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256
+
+    def __init__(self, address, ports):
+        super().__init__(address, _ProxyHandler)
+        self.ports = ports
+#------------------------------------------------------------------
+# workers
+#------------------------------------------------------------------
+def _wait_for_port(port, timeout_s):
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+class Launcher:
+    def __init__(self, n_workers, app_cmd, port=PORT, base_port=WORKER_BASE_PORT, sticky_sockets=False,
+                 dev_server=False):
+        self.n_workers = n_workers
+        self.app_cmd = app_cmd
+        self.port = port
+        self.ports = [base_port + i for i in range(n_workers)]
+        self.procs = [None] * n_workers
+        self.stopping = False
+        self.proxy = None
+        self.backend_server = None
+        self.env = dict(os.environ)
+        if sticky_sockets:
+            self.env["SOCKETIO_FANOUT"] = "0"
+        elif n_workers > 1:
+            # per-process delta versions would interleave in a room
+            self.env["NPC_STATE_MODE"] = "full"
+        if dev_server:
+            self.env["ALLOW_UNSAFE_WERKZEUG"] = "1"
+        # LLM rate / concurrency limits are split across the workers
+        self.env["LLM_WORKERS"] = str(n_workers)
+
+    def _start_backend(self):
+        if self.env.get("SHARED_BACKEND_URL"):
+            return
+        from shared_backend import StandInServer
+        server = self.backend_server = StandInServer(("127.0.0.1", SHARED_BACKEND_PORT))
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.env["SHARED_BACKEND_URL"] = f"redis://127.0.0.1:{SHARED_BACKEND_PORT}"
+        print(f"[LAUNCHER] shared backend stand-in on :{SHARED_BACKEND_PORT}")
+
+    def _spawn(self, i):
+        env = dict(self.env)
+        env["PORT"] = str(self.ports[i])
+        env["WORKER_INDEX"] = str(i)
+        if i > 0:
+            # one retention sweeper is enough
+            env["RETENTION_INTERVAL_MIN"] = "0"
+        self.procs[i] = subprocess.Popen(
+            [sys.executable] + self.app_cmd,
+            env=env,
+            stdin=subprocess.DEVNULL
+        )
+        print(f"[LAUNCHER] worker {i} pid={self.procs[i].pid} port={self.ports[i]}")
+
+    def start(self, ready_timeout_s=60):
+        self._start_backend()
+        for i in range(self.n_workers):
+            self._spawn(i)
+        for i, port in enumerate(self.ports):
+            if not _wait_for_port(port, ready_timeout_s):
+                print(f"[LAUNCHER] worker {i} not listening after {ready_timeout_s}s")
+
+        self.proxy = StickyProxy(("0.0.0.0", self.port), self.ports)
+        Thread(target=self.proxy.serve_forever, daemon=True).start()
+        print(f"[LAUNCHER] routing :{self.port} -> {self.n_workers} workers")
+
+    def watch(self):
+        while not self.stopping:
+            for i, proc in enumerate(self.procs):
+                code = proc.poll()
+                if code is not None and not self.stopping:
+                    print(f"[LAUNCHER] worker {i} exited ({code}), restarting")
+                    time.sleep(RESTART_DELAY_S)
+                    self._spawn(i)
+            time.sleep(0.5)
+
+    def stop(self, *_):
+        self.stopping = True
+        if self.proxy:
+            self.proxy.shutdown()
+        for proc in self.procs:
+            if proc and proc.poll() is None:
+                proc.terminate()
+        for proc in self.procs:
+            if proc:
+                try:
+                    proc.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+        if self.backend_server:
+            self.backend_server.shutdown()
+            self.backend_server.server_close()
+#------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run N app workers behind a sticky idUser router")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--base-port", type=int, default=WORKER_BASE_PORT)
+    parser.add_argument("--app", default="app.py", help="worker command (script + args)")
+    parser.add_argument("--sticky-sockets", action="store_true",
+                        help="no Socket.IO fan-out (keeps state deltas); every client must connect with ?idUser=")
+    parser.add_argument("--dev-server", action="store_true",
+                        help="let workers run on the Werkzeug dev server (local testing only)")
+    args = parser.parse_args()
+
+    launcher = Launcher(args.workers, shlex.split(args.app), args.port, args.base_port,
+                        args.sticky_sockets, args.dev_server)
+    signal.signal(signal.SIGTERM, launcher.stop)
+    launcher.start()
+    try:
+        launcher.watch()
+    except KeyboardInterrupt:
+        launcher.stop()
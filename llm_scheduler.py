@@ -0,0 +1,299 @@
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from threading import Condition, Lock, local
+from structured_log import get_logger
+#------------------------------------------------------------------
+# Fair, prioritised admission of LLM calls (one scheduler per provider)
+#
+# Every chat_completion waits here for a grant before it goes out.
+# Priority classes, best first:
+#
+#   interactive     npc_response stream
+#   pre_response    classifiers the response waits for
+#   post_turn       npc_reaction, self_beliefs (after the response)
+#   consolidation   kb_rewrite / kb_patch (deepseek-reasoner, background)
+#
+# The best class with a waiter is served first; inside a class the
+# users take turns (round robin on idUser), so one chatty player or
+# one long consolidation backlog does not block everyone else. Limits:
+#
+#   LLM_RATE_RPS / LLM_RATE_BURST   request token bucket (0 = off)
+#   LLM_RATE_TPM                    prompt-token bucket per minute (0 = off)
+#   LLM_MAX_CONCURRENT              calls in flight (streams until done)
+#   LLM_BACKGROUND_SHARE            share of those slots post_turn and
+#                                   consolidation may hold, the rest is
+#                                   kept for the turn's critical path
+#   LLM_SCHED_AGING_S               a background waiter moves up one
+#                                   class per this many seconds waited,
+#                                   never above pre_response
+#
+# The buckets and slots live in this process only; they are not
+# coordinated through shared_backend. The limits above (and a client's
+# scheduler_limits) are for the whole deployment: with LLM_WORKERS
+# processes (the launcher sets it to --workers) each process enforces
+# 1/LLM_WORKERS of them, with at least one slot per process.
+#------------------------------------------------------------------
+PRIORITIES = ("interactive", "pre_response", "post_turn", "consolidation")
+
+STAGE_PRIORITY = {
+    "npc_response":     0,
+    "classify_player":  1,
+    "persona_clues":    1,
+    "npc_reaction":     2,
+    "self_beliefs":     2,
+    "kb_rewrite":       3,
+    "kb_patch":         3,
+}
+BACKGROUND = 2          # classes from here on share the background slots
+
+LLM_RATE_RPS = float(os.getenv("LLM_RATE_RPS", "0"))
+LLM_RATE_BURST = float(os.getenv("LLM_RATE_BURST", "0")) or max(1.0, LLM_RATE_RPS * 2)
+LLM_RATE_TPM = float(os.getenv("LLM_RATE_TPM", "0"))
+LLM_MAX_CONCURRENT = int(os.getenv("LLM_MAX_CONCURRENT", "64"))
+LLM_BACKGROUND_SHARE = float(os.getenv("LLM_BACKGROUND_SHARE", "0.5"))
+LLM_SCHED_AGING_S = float(os.getenv("LLM_SCHED_AGING_S", "30"))
+LLM_WORKERS = max(1, int(os.getenv("LLM_WORKERS", "1")))
+
+_schedulers = {}
+_schedulers_lock = Lock()
+_local = local()
+
+logger = get_logger("scheduler")
+
+
+class QueueTimeout(TimeoutError):
+    pass
+#------------------------------------------------------------------
+def stage_priority(stage: str) -> int:
+    return STAGE_PRIORITY.get(stage, BACKGROUND)
+
+@contextmanager
+def for_user(idUser):
+    """
+    LLM calls made in this block (background work with no turn trace)
+    are queued as this user's.
+    """
+    previous = getattr(_local, "user", None)
+    _local.user = idUser
+    try:
+        yield
+    finally:
+        _local.user = previous
+
+def current_user():
+    return getattr(_local, "user", None)
+
+def estimate_prompt_tokens(messages) -> int:
+    return sum(len(str(m.get("content") or "")) for m in messages or ()) // 4
+
+
+class TokenBucket:
+    def __init__(self, rate_per_s: float, burst: float):
+        self.rate = rate_per_s
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost: float, now: float) -> float:
+        """
+        Seconds until `cost` is available (0 = now).
+        """
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        cost = min(cost, self.burst)
+        return 0.0 if self.tokens >= cost else (cost - self.tokens) / self.rate
+
+    def take(self, cost: float):
+        if self.rate > 0:
+            self.tokens -= min(cost, self.burst)
+
+
+class _Waiter:
+    __slots__ = ("priority", "user", "tokens", "enqueued", "granted_at")
+
+    def __init__(self, priority, user, tokens):
+        self.priority = priority
+        self.user = user
+        self.tokens = tokens
+        self.enqueued = time.monotonic()
+        self.granted_at = None
+
+
+class Grant:
+    def __init__(self, scheduler, waiter):
+        self.scheduler = scheduler
+        self.priority = waiter.priority
+        self.queued_s = waiter.granted_at - waiter.enqueued
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.scheduler._release(self.priority)
+#------------------------------------------------------------------
+class LLMScheduler:
+    def __init__(self, name, rps=LLM_RATE_RPS, burst=LLM_RATE_BURST, tpm=LLM_RATE_TPM,
+                 max_concurrent=LLM_MAX_CONCURRENT, background_share=LLM_BACKGROUND_SHARE,
+                 workers=LLM_WORKERS):
+        # this process's share of the deployment-wide limits
+        rps, burst, tpm = rps / workers, max(1.0, burst / workers), tpm / workers
+        max_concurrent = max(1, max_concurrent // workers)
+
+        self.name = name
+        self.requests = TokenBucket(rps, burst)
+        self.prompt_tokens = TokenBucket(tpm / 60, tpm)
+        self.max_concurrent = max_concurrent
+        self.background_slots = max(1, int(max_concurrent * background_share))
+
+        self.queues = [OrderedDict() for _ in PRIORITIES]     # user -> deque of waiters
+        self.in_flight = 0
+        self.background_in_flight = 0
+        self.stats = {p: {"granted": 0, "timeouts": 0, "queued_s": 0.0, "max_queued_s": 0.0} for p in PRIORITIES}
+        self._cond = Condition()
+
+    # --------------------------------------------------
+    def _effective(self, priority, waiter, now):
+        if priority < BACKGROUND or LLM_SCHED_AGING_S <= 0:
+            return priority
+        return max(1, priority - int((now - waiter.enqueued) / LLM_SCHED_AGING_S))
+
+    def _next(self, now):
+        """
+        (priority, user, waiter) to serve next, or None.
+        """
+        best = None
+        for priority, users in enumerate(self.queues):
+            if not users:
+                continue
+            if priority >= BACKGROUND and self.background_in_flight >= self.background_slots:
+                continue
+            user, waiters = next(iter(users.items()))
+            rank = (self._effective(priority, waiters[0], now), priority)
+            if best is None or rank < best[0]:
+                best = (rank, priority, user, waiters[0])
+        return best[1:] if best else None
+
+    def _dispatch(self) -> float | None:
+        """
+        Grants as many waiters as the limits allow. Returns how long
+        until a bucket refills enough for the next one (None: blocked on
+        concurrency or nobody waiting).
+        """
+        now = time.monotonic()
+        granted = False
+        wait = None
+        while self.in_flight < self.max_concurrent:
+            pick = self._next(now)
+            if pick is None:
+                break
+            priority, user, waiter = pick
+            wait = max(self.requests.wait_time(1, now), self.prompt_tokens.wait_time(waiter.tokens, now))
+            if wait > 0:
+                break           # the head waits, nobody jumps the queue
+            wait = None
+            self.requests.take(1)
+            self.prompt_tokens.take(waiter.tokens)
+
+            users = self.queues[priority]
+            users[user].popleft()
+            if users[user]:
+                users.move_to_end(user)     # round robin
+            else:
+                del users[user]
+
+            waiter.granted_at = now
+            self.in_flight += 1
+            if priority >= BACKGROUND:
+                self.background_in_flight += 1
+            s = self.stats[PRIORITIES[priority]]
+            s["granted"] += 1
+            s["queued_s"] += now - waiter.enqueued
+            s["max_queued_s"] = max(s["max_queued_s"], now - waiter.enqueued)
+            granted = True
+        if granted:
+            self._cond.notify_all()
+        return wait
+
+    def _remove(self, waiter):
+        users = self.queues[waiter.priority]
+        waiters = users.get(waiter.user)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del users[waiter.user]
+
+    def _release(self, priority):
+        with self._cond:
+            self.in_flight -= 1
+            if priority >= BACKGROUND:
+                self.background_in_flight -= 1
+            self._dispatch()
+            self._cond.notify_all()
+
+    # --------------------------------------------------
+    def acquire(self, stage: str, user=None, prompt_tokens: int = 0, timeout: float | None = None) -> Grant:
+        """
+        Blocks until the call may go out. Raises QueueTimeout after
+        `timeout` seconds in the queue.
+        """
+        priority = stage_priority(stage)
+        waiter = _Waiter(priority, "background" if user is None else str(user), prompt_tokens)
+        deadline = None if timeout is None else waiter.enqueued + timeout
+
+        with self._cond:
+            self.queues[priority].setdefault(waiter.user, deque()).append(waiter)
+            while True:
+                refill_in = self._dispatch()
+                if waiter.granted_at is not None:
+                    return Grant(self, waiter)
+                wait = refill_in
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._remove(waiter)
+                        self.stats[PRIORITIES[priority]]["timeouts"] += 1
+                        logger.warning("LLM call timed out in queue", scheduler=self.name, stage=stage, user=waiter.user)
+                        raise QueueTimeout(stage)
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._cond.wait(timeout=wait)
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            out = {
+                "in_flight": self.in_flight,
+                "background_in_flight": self.background_in_flight,
+            }
+            for priority, name in enumerate(PRIORITIES):
+                s = self.stats[name]
+                out[name] = {
+                    "waiting": sum(len(w) for w in self.queues[priority].values()),
+                    "granted": s["granted"],
+                    "timeouts": s["timeouts"],
+                    "avg_queued_ms": round(1000 * s["queued_s"] / s["granted"], 1) if s["granted"] else 0.0,
+                    "max_queued_ms": round(1000 * s["max_queued_s"], 1),
+                }
+            return out
+#------------------------------------------------------------------
+def get_scheduler(provider: str, **limits) -> LLMScheduler:
+    """
+    limits (LLMScheduler kwargs) only apply when the scheduler is
+    created, e.g. a local server that runs few requests at once.
+    """
+    with _schedulers_lock:
+        scheduler = _schedulers.get(provider)
+        if scheduler is None:
+            scheduler = _schedulers[provider] = LLMScheduler(provider, **limits)
+        return scheduler
+
+def scheduler_stats() -> dict:
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    return {s.name: s.snapshot() for s in schedulers}
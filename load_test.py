@@ -0,0 +1,357 @@
+import argparse
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+from threading import Event, Lock, Thread
+import requests # type: ignore
+import socketio # type: ignore
+try:
+    import websocket # type: ignore  (websocket-client)
+    TRANSPORTS = ["polling", "websocket"]
+except ImportError:
+    TRANSPORTS = ["polling"]
+#------------------------------------------------------------------
+# Headless load test for npc_interact
+#
+# Simulates --players concurrent players. Each one opens its own
+# Socket.IO connection (?idUser=..., so launcher.py routes it),
+# sends register_user, then replays a scripted dialogue turn by turn:
+#
+#   ttft_ms          POST sent -> first npc_text_token
+#   ttfa_ms          POST sent -> first npc_audio_chunk (speech on)
+#   turn_ms          POST sent -> response returned and npc_text_done
+#   http_ms          POST round trip only
+#   consolidation_s  buffer row createdAt -> processedAt (from the db)
+#
+# Results (percentiles per stage, error counts, config, git rev) go
+# to --out as JSON. error_rate is failed turns / attempted turns (a
+# player whose socket never connects fails all of its turns); a turn
+# that completes without any npc_text_token is counted under
+# "warnings", not as an error. --baseline compares p95s against an
+# earlier run and exits 1 on a regression.
+#
+#   LLM_PROVIDER=mock TTS_PROVIDER=mock SPEECH_ON=1 python app.py
+#   python load_test.py --players 200 --turns 5 --out results.json
+#
+# idUser values --user-base .. --user-base + players - 1 (and --npc)
+# must exist in the test database.
+#------------------------------------------------------------------
+DEFAULT_SERVER = "http://localhost:5001"
+TURN_TIMEOUT_S = 120
+STAGES = ["ttft_ms", "ttfa_ms", "turn_ms", "http_ms", "consolidation_s"]
+
+DIALOGUES = [
+    {
+        "currentScene": "The player finds the NPC alone at the harbor at dusk.",
+        "lines": [
+            "<<<player has just arrived or returned, check your memory>>>",
+            "[player responded to you] Hey, I didn't expect to see you out here.",
+            "[player responded to you] I keep thinking about the letter you showed me.",
+            "[player responded to you] Do you trust the stranger from the station?",
+            "[player responded to you] My mother used to bring me here when I was ten.",
+            "[player responded to you] I should go before the clock tower rings.",
+        ]
+    },
+    {
+        "currentScene": "Lunch at school; the player sits down next to the NPC.",
+        "lines": [
+            "<<<player has just arrived or returned, check your memory>>>",
+            "[player responded to you] Is this seat taken?",
+            "[player responded to you] I'm new here, I moved from Denver last week.",
+            "[player responded to you] What do people do for fun around here?",
+            "[player responded to you] You seem nervous, is everything okay?",
+            "[player responded to you] Thanks for letting me sit with you.",
+        ]
+    },
+]
+#------------------------------------------------------------------
+class Results:
+    def __init__(self):
+        self.samples = {stage: [] for stage in STAGES}
+        self.errors = {}        # kind -> failed turns
+        self.warnings = {}      # kind -> completed turns with something missing
+        self.turns = 0
+        self.lock = Lock()
+
+    def add(self, stage, value):
+        with self.lock:
+            self.samples[stage].append(value)
+
+    def error(self, kind, turns=1):
+        with self.lock:
+            self.errors[kind] = self.errors.get(kind, 0) + turns
+
+    def warn(self, kind):
+        with self.lock:
+            self.warnings[kind] = self.warnings.get(kind, 0) + 1
+
+    def turn(self):
+        with self.lock:
+            self.turns += 1
+
+
+def percentiles(values) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 2),
+        "p50": round(pick(0.50), 2),
+        "p90": round(pick(0.90), 2),
+        "p95": round(pick(0.95), 2),
+        "p99": round(pick(0.99), 2),
+        "max": round(values[-1], 2),
+    }
+#------------------------------------------------------------------
+# one simulated player
+#------------------------------------------------------------------
+class Player:
+    def __init__(self, args, idUser, dialogue, results):
+        self.args = args
+        self.idUser = idUser
+        self.dialogue = dialogue
+        self.results = results
+        self.rng = random.Random(idUser)
+
+        self.sent_at = 0.0
+        self.first_token = None
+        self.first_audio = None
+        self.text_done = Event()
+
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on("npc_text_token", self._on_token)
+        self.sio.on("npc_audio_chunk", self._on_audio)
+        self.sio.on("npc_text_done", self._on_done)
+
+    def _on_token(self, data):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+
+    def _on_audio(self, data):
+        if self.first_audio is None:
+            self.first_audio = time.perf_counter()
+            base64.b64decode(data["audio_b64"])
+
+    def _on_done(self, _data=None):
+        self.text_done.set()
+
+    def run(self):
+        try:
+            self.sio.connect(
+                f"{self.args.server}?idUser={self.idUser}",
+                transports=TRANSPORTS,
+                wait_timeout=30
+            )
+            self.sio.emit("register_user", {"idUser": self.idUser, "idNPC": self.args.npc})
+        except Exception as e:
+            print(f"[LOAD] user {self.idUser} socket failed: {e}")
+            self.results.error("socket_connect", self.args.turns)
+            return
+
+        try:
+            for i in range(self.args.turns):
+                line = self.dialogue["lines"][i % len(self.dialogue["lines"])]
+                self.turn(line)
+                if i < self.args.turns - 1:
+                    time.sleep(self.args.think_ms * (0.5 + self.rng.random()) / 1000)
+        finally:
+            self.sio.disconnect()
+
+    def turn(self, player_text):
+        self.first_token = None
+        self.first_audio = None
+        self.text_done.clear()
+
+        payload = {
+            "idUser": self.idUser,
+            "idNPC": self.args.npc,
+            "currentScene": self.dialogue["currentScene"],
+            "playerName": f"load_{self.idUser}",
+            "idVoice": self.args.voice,
+            "playerText": player_text
+        }
+
+        self.sent_at = time.perf_counter()
+        try:
+            r = requests.post(f"{self.args.server}/npc_interact", json=payload, timeout=TURN_TIMEOUT_S)
+        except requests.RequestException as e:
+            self.results.error(type(e).__name__)
+            return
+        http_done = time.perf_counter()
+
+        if not r.ok:
+            self.results.error(f"http_{r.status_code}")
+            return
+        if not self.text_done.wait(TURN_TIMEOUT_S):
+            self.results.error("no_text_done")
+            return
+        done = time.perf_counter()
+
+        self.results.turn()
+        self.results.add("http_ms", (http_done - self.sent_at) * 1000)
+        self.results.add("turn_ms", (done - self.sent_at) * 1000)
+        if self.first_token is not None:
+            self.results.add("ttft_ms", (self.first_token - self.sent_at) * 1000)
+        else:
+            self.results.warn("no_tokens")
+        if self.first_audio is not None:
+            self.results.add("ttfa_ms", (self.first_audio - self.sent_at) * 1000)
+#------------------------------------------------------------------
+# consolidation lag, read back from the buffer table
+#------------------------------------------------------------------
+def consolidation_lag(args, started_at, results):
+    try:
+        from phase_2_queries import connect
+        db = connect()
+    except Exception as e:
+        print(f"[LOAD] no db, consolidation lag skipped: {e}")
+        return None
+
+    users = (args.user_base, args.user_base + args.players - 1)
+    cursor = db.cursor()
+    try:
+        deadline = time.monotonic() + args.drain_s
+        pending = None
+        while time.monotonic() < deadline:
+            cursor.execute("""
+                SELECT COUNT(*) FROM npc_user_memory_buffer
+                WHERE processed = 0 AND idNPC = %s AND idUser BETWEEN %s AND %s AND createdAt >= %s
+            """, (args.npc, *users, started_at))
+            pending = cursor.fetchone()[0]
+            db.commit()     # fresh snapshot on the next read
+            if not pending:
+                break
+            time.sleep(1)
+
+        cursor.execute("""
+            SELECT TIMESTAMPDIFF(SECOND, createdAt, processedAt)
+            FROM npc_user_memory_buffer
+            WHERE processed = 1 AND idNPC = %s AND idUser BETWEEN %s AND %s AND createdAt >= %s
+        """, (args.npc, *users, started_at))
+        for (lag,) in cursor.fetchall():
+            results.add("consolidation_s", float(lag))
+        return pending
+    finally:
+        cursor.close()
+        db.close()
+#------------------------------------------------------------------
+def git_rev():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(report, baseline_path, max_regression):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    regressions = []
+    for stage in STAGES:
+        new = report["stages"].get(stage, {}).get("p95")
+        old = baseline.get("stages", {}).get(stage, {}).get("p95")
+        if new is None or not old:
+            continue
+        change = (new - old) / old
+        flag = "REGRESSION" if change > max_regression else ""
+        print(f"  {stage:>16} p95 {old:>9.1f} -> {new:>9.1f} ({change:+.0%}) {flag}")
+        if flag:
+            regressions.append(stage)
+
+    if report["error_rate"] > baseline.get("error_rate", 0) + 0.01:
+        print(f"  error rate {baseline.get('error_rate', 0):.2%} -> {report['error_rate']:.2%} REGRESSION")
+        regressions.append("error_rate")
+    return regressions
+#------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="concurrent players against npc_interact")
+    parser.add_argument("--server", default=DEFAULT_SERVER)
+    parser.add_argument("--players", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--ramp-s", type=float, default=10, help="spread player starts over this many seconds")
+    parser.add_argument("--think-ms", type=float, default=2000)
+    parser.add_argument("--user-base", type=int, default=1)
+    parser.add_argument("--npc", type=int, default=2)
+    parser.add_argument("--voice", default="SOYHLrjzK2X1ezoPC6cr")
+    parser.add_argument("--dialogues", help="JSON file: [{currentScene, lines: [...]}, ...]")
+    parser.add_argument("--drain-s", type=float, default=120, help="wait this long for consolidation")
+    parser.add_argument("--no-db", action="store_true", help="skip consolidation lag")
+    parser.add_argument("--out", default="load_test_results.json")
+    parser.add_argument("--baseline", help="earlier results JSON to compare p95s against")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+
+    dialogues = DIALOGUES
+    if args.dialogues:
+        with open(args.dialogues) as f:
+            dialogues = json.load(f)
+
+    results = Results()
+    started_at = datetime.now().replace(microsecond=0)
+    started = time.perf_counter()
+
+    players = [
+        Player(args, args.user_base + i, dialogues[i % len(dialogues)], results)
+        for i in range(args.players)
+    ]
+    threads = []
+    for i, player in enumerate(players):
+        t = Thread(target=player.run, daemon=True)
+        threads.append(t)
+        t.start()
+        if args.players > 1:
+            time.sleep(args.ramp_s / (args.players - 1))
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    pending = None if args.no_db else consolidation_lag(args, started_at, results)
+
+    attempted = args.players * args.turns
+    failed = sum(results.errors.values())
+    report = {
+        "build": git_rev(),
+        "startedAt": started_at.isoformat(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("baseline",)},
+        "elapsed_s": round(elapsed, 2),
+        "turns": results.turns,
+        "turns_per_s": round(results.turns / elapsed, 2) if elapsed else 0.0,
+        "error_rate": round(failed / attempted, 4) if attempted else 0.0,
+        "errors": results.errors,
+        "warnings": results.warnings,
+        "consolidation_pending": pending,
+        "stages": {stage: percentiles(results.samples[stage]) for stage in STAGES},
+    }
+
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\n[LOAD] {results.turns}/{attempted} turns in {elapsed:.1f}s "
+          f"({report['turns_per_s']} turns/s), error rate {report['error_rate']:.2%}")
+    for stage, p in report["stages"].items():
+        if p["count"]:
+            print(f"  {stage:>16} n={p['count']:<5} p50={p['p50']:<9} p95={p['p95']:<9} p99={p['p99']:<9} max={p['max']}")
+    if results.errors:
+        print(f"  errors: {results.errors}")
+    if results.warnings:
+        print(f"  warnings: {results.warnings}")
+    print(f"[LOAD] wrote {args.out}")
+
+    if args.baseline:
+        print(f"\n[LOAD] vs {args.baseline}")
+        if compare(report, args.baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
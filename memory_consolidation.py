@@ -0,0 +1,583 @@
+import os
+import socket
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Thread, Condition, Event
+from phase_2_queries import (
+    connect, get_mem_versioned, commit_NPC_user_memory, memory_write_stats,
+    get_self_beliefs_snapshot, get_player_beliefs_snapshot
+)
+from memory_retrieval import update_index
+from token_budget import estimate_tokens
+import openAIqueries
+from structured_log import get_logger
+from llm_scheduler import for_user
+#------------------------------------------------------------------
+# Batched kbText consolidation
+#
+# Every finished turn calls schedule(idNPC, idUser). One worker per
+# (NPC, user) pair drains the buffer in batches:
+#   - at most CONSOLIDATION_MAX_EXCHANGES exchanges per LLM call
+#   - at most CONSOLIDATION_EXCHANGE_TOKENS of exchange text per call
+#     (always at least one exchange)
+# Pairs consolidate in parallel; a pair never runs two workers, and a
+# schedule() that lands while its worker is busy makes it go round
+# again instead of being dropped.
+#
+# Backpressure: wait_for_capacity() blocks the next turn of a pair
+# while more than CONSOLIDATION_BACKLOG_LIMIT exchanges are waiting,
+# up to CONSOLIDATION_BACKPRESSURE_WAIT_MS.
+#
+# Durability: the work itself lives in memory_consolidation_job (see
+# camodb.sql). Threads are only the executors: a worker must hold the
+# job's lease and retries with backoff on failure. The lease is renewed
+# after every batch and, while a batch runs, every CONSOLIDATION_LEASE_S/3
+# (the reasoner call queues behind turns with no deadline, so it can
+# outlast a single lease). start() sweeps the table on boot and then
+# periodically, so pairs left behind by a restart or crash are picked up
+# without waiting for that player's next turn.
+#
+# A kbText rewritten underneath a batch (CAS conflict on
+# npc_user_memory.version) is not a failure: the batch is redone at
+# once from the fresh text, up to CONSOLIDATION_CONFLICT_RETRIES times,
+# without touching the job's attempts or backoff.
+#------------------------------------------------------------------
+MAX_EXCHANGES_PER_CALL = int(os.getenv("CONSOLIDATION_MAX_EXCHANGES", "6"))
+EXCHANGE_TOKENS_PER_CALL = int(os.getenv("CONSOLIDATION_EXCHANGE_TOKENS", "4000"))
+BACKLOG_LIMIT = int(os.getenv("CONSOLIDATION_BACKLOG_LIMIT", "12"))
+BACKPRESSURE_WAIT_S = float(os.getenv("CONSOLIDATION_BACKPRESSURE_WAIT_MS", "5000")) / 1000
+
+JOB_LEASE_S = int(os.getenv("CONSOLIDATION_LEASE_S", "300"))
+JOB_MAX_ATTEMPTS = int(os.getenv("CONSOLIDATION_MAX_ATTEMPTS", "5"))
+JOB_RETRY_BASE_S = int(os.getenv("CONSOLIDATION_RETRY_BASE_S", "15"))
+LEASE_RENEW_S = JOB_LEASE_S / 3
+CONFLICT_RETRIES = int(os.getenv("CONSOLIDATION_CONFLICT_RETRIES", "3"))
+SWEEP_INTERVAL_S = float(os.getenv("CONSOLIDATION_SWEEP_S", "30"))
+# a player row with no NPC reply after this long is an abandoned turn
+ORPHAN_AFTER_S = float(os.getenv("CONSOLIDATION_ORPHAN_AFTER_S", "600"))
+
+LAG_SAMPLES = 500
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+logger = get_logger("consolidation")
+
+
+class MemoryConflict(RuntimeError):
+    pass
+
+#------------------------------------------------------------------
+# Job table
+#------------------------------------------------------------------
+def enqueue_job(cursor, idNPC, idUser):
+    # column order matters: MySQL evaluates the updates left to right
+    cursor.execute("""
+        INSERT INTO memory_consolidation_job (idNPC, idUser)
+        VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE
+            generation  = generation + 1,
+            attempts    = IF(status = 'dead', 0, attempts),
+            availableAt = IF(status = 'leased', availableAt, NOW()),
+            status      = IF(status = 'dead', 'pending', status)
+    """, (idNPC, idUser))
+
+def claim_job(cursor, idNPC, idUser, owner, lease_s=JOB_LEASE_S):
+    """
+    Lease the pair's job if it is due (or its lease expired).
+    Returns the job generation, or None if not claimable.
+    """
+    cursor.execute("""
+        UPDATE memory_consolidation_job
+        SET status = 'leased',
+            leaseOwner = %s,
+            leaseUntil = NOW() + INTERVAL %s SECOND,
+            attempts = attempts + 1
+        WHERE idNPC = %s AND idUser = %s
+          AND ((status = 'pending' AND availableAt <= NOW())
+            OR (status = 'leased' AND leaseUntil < NOW()))
+    """, (owner, lease_s, idNPC, idUser))
+
+    if cursor.rowcount != 1:
+        return None
+
+    cursor.execute("""
+        SELECT generation
+        FROM memory_consolidation_job
+        WHERE idNPC = %s AND idUser = %s
+    """, (idNPC, idUser))
+    row = cursor.fetchone()
+    return row["generation"] if row else None
+
+def renew_lease(cursor, idNPC, idUser, owner, lease_s=JOB_LEASE_S) -> bool:
+    cursor.execute("""
+        UPDATE memory_consolidation_job
+        SET leaseUntil = NOW() + INTERVAL %s SECOND
+        WHERE idNPC = %s AND idUser = %s
+          AND status = 'leased' AND leaseOwner = %s
+    """, (lease_s, idNPC, idUser, owner))
+    return cursor.rowcount == 1
+
+def complete_job(cursor, idNPC, idUser, owner, generation) -> bool:
+    """
+    Deletes the job if nothing was enqueued since it was claimed.
+    Otherwise hands it back as pending and returns False.
+    """
+    cursor.execute("""
+        DELETE FROM memory_consolidation_job
+        WHERE idNPC = %s AND idUser = %s
+          AND leaseOwner = %s AND generation = %s
+    """, (idNPC, idUser, owner, generation))
+    if cursor.rowcount == 1:
+        return True
+
+    cursor.execute("""
+        UPDATE memory_consolidation_job
+        SET status = 'pending', leaseOwner = NULL, leaseUntil = NULL,
+            attempts = 0, availableAt = NOW()
+        WHERE idNPC = %s AND idUser = %s AND leaseOwner = %s
+    """, (idNPC, idUser, owner))
+    return False
+
+def fail_job(cursor, idNPC, idUser, owner, error, max_attempts=JOB_MAX_ATTEMPTS, retry_base_s=JOB_RETRY_BASE_S):
+    # exponential backoff, capped at 10 minutes
+    cursor.execute("""
+        UPDATE memory_consolidation_job
+        SET availableAt = NOW() + INTERVAL LEAST(600, %s * POW(2, attempts - 1)) SECOND,
+            status = IF(attempts >= %s, 'dead', 'pending'),
+            leaseOwner = NULL,
+            leaseUntil = NULL,
+            lastError = %s
+        WHERE idNPC = %s AND idUser = %s AND leaseOwner = %s
+    """, (retry_base_s, max_attempts, str(error)[:2000], idNPC, idUser, owner))
+
+def due_jobs(cursor, limit=100) -> list[tuple[int, int]]:
+    cursor.execute("""
+        SELECT idNPC, idUser
+        FROM memory_consolidation_job
+        WHERE (status = 'pending' AND availableAt <= NOW())
+           OR (status = 'leased' AND leaseUntil < NOW())
+        ORDER BY availableAt ASC
+        LIMIT %s
+    """, (limit,))
+    return [(r["idNPC"], r["idUser"]) for r in cursor.fetchall()]
+
+def enqueue_unjobbed_pairs(cursor) -> int:
+    """
+    Pairs with unprocessed buffer rows but no job (work buffered
+    before a crash, or before this table existed).
+    """
+    cursor.execute("""
+        INSERT IGNORE INTO memory_consolidation_job (idNPC, idUser)
+        SELECT DISTINCT idNPC, idUser
+        FROM npc_user_memory_buffer
+        WHERE processed = 0
+    """)
+    return cursor.rowcount
+#------------------------------------------------------------------
+def fetch_batch(cursor, idNPC, idUser, max_exchanges, token_budget, orphan_after_s=ORPHAN_AFTER_S):
+    """
+    Oldest complete player -> npc exchanges of the pair, bounded.
+    Returns (exchanges, buffer_ids, ages_s, backlog, orphan_ids) where
+    ages_s is the age of each exchange's npc row at fetch time, backlog
+    the number of complete exchanges waiting (batch included) and
+    orphan_ids the rows that will never be part of an exchange: player
+    rows without an NPC reply (followed by another player turn, or
+    older than orphan_after_s) and NPC rows whose player row is gone
+    (the reply landed after that row was orphaned).
+    """
+    cursor.execute("""
+        SELECT idBuffer, playerText, npcText, npcEmotion, npcIntensity,
+               TIMESTAMPDIFF(MICROSECOND, createdAt, NOW()) / 1000000 AS ageS
+        FROM npc_user_memory_buffer
+        WHERE idNPC = %s
+          AND idUser = %s
+          AND processed = 0
+        ORDER BY createdAt ASC, idBuffer ASC
+    """, (idNPC, idUser))
+
+    rows = cursor.fetchall()
+
+    exchanges = []
+    buffer_ids = []
+    ages = []
+    orphan_ids = []
+    backlog = 0
+    tokens = 0
+
+    pending_player = None
+    pending_player_id = None
+    pending_player_age = 0.0
+
+    for r in rows:
+
+        if r.get("playerText"):
+            if pending_player_id is not None:
+                orphan_ids.append(pending_player_id)
+            pending_player = r["playerText"]
+            pending_player_id = r["idBuffer"]
+            pending_player_age = float(r.get("ageS") or 0.0)
+            continue
+
+        if r.get("npcText") and pending_player:
+            backlog += 1
+            cost = estimate_tokens(pending_player) + estimate_tokens(r["npcText"])
+
+            full = len(exchanges) >= max_exchanges or (exchanges and tokens + cost > token_budget)
+            if not full:
+                exchanges.append({
+                    "player_text": pending_player,
+                    "npc_text": r["npcText"],
+                    "npc_emotion": r.get("npcEmotion"),
+                    "npc_intensity": r.get("npcIntensity")
+                })
+                buffer_ids.extend([pending_player_id, r["idBuffer"]])
+                ages.append(float(r.get("ageS") or 0.0))
+                tokens += cost
+
+            pending_player = None
+            pending_player_id = None
+            continue
+
+        # no player turn to pair with; would otherwise stay pending forever
+        orphan_ids.append(r["idBuffer"])
+
+    # trailing player turn: in flight, unless it is old
+    if pending_player_id is not None and pending_player_age > orphan_after_s:
+        orphan_ids.append(pending_player_id)
+
+    return exchanges, buffer_ids, ages, backlog, orphan_ids
+#------------------------------------------------------------------
+class ConsolidationBatcher:
+    def __init__(
+        self,
+        max_exchanges=MAX_EXCHANGES_PER_CALL,
+        token_budget=EXCHANGE_TOKENS_PER_CALL,
+        backlog_limit=BACKLOG_LIMIT,
+        backpressure_wait=BACKPRESSURE_WAIT_S
+    ):
+        self.max_exchanges = max_exchanges
+        self.token_budget = token_budget
+        self.backlog_limit = backlog_limit
+        self.backpressure_wait = backpressure_wait
+
+        self._running = set()       # pairs with a live worker
+        self._dirty = set()         # pairs scheduled while their worker ran
+        self._backlog = {}          # pair -> complete exchanges waiting (last seen)
+        self._cond = Condition()
+
+        self._stats = {
+            "batches": 0,
+            "exchanges": 0,
+            "failures": 0,
+            "conflicts": 0,
+            "busy_s": 0.0,
+            "backpressure_waits": 0,
+            "backpressure_wait_s": 0.0,
+            "started": time.monotonic()
+        }
+        self._lags = deque(maxlen=LAG_SAMPLES)
+        self._sweeper = None
+
+    # --------------------------------------------------
+    # called from the request thread
+    # --------------------------------------------------
+    def schedule(self, idNPC, idUser):
+        # durable first: if the process dies now, the sweep finds it
+        self._job(enqueue_job, idNPC, idUser)
+
+        with self._cond:
+            pair = (idNPC, idUser)
+            self._backlog[pair] = self._backlog.get(pair, 0) + 1
+        self._start((idNPC, idUser))
+
+    def start(self):
+        """
+        Startup sweep + periodic re-scan of due / expired jobs.
+        """
+        if self._sweeper is None or not self._sweeper.is_alive():
+            self._sweeper = Thread(target=self._sweep_loop, daemon=True)
+            self._sweeper.start()
+
+    def wait_for_capacity(self, idNPC, idUser, timeout=None):
+        """
+        Blocks while the pair's backlog is over the limit.
+        Returns the seconds spent waiting.
+        """
+        pair = (idNPC, idUser)
+        timeout = self.backpressure_wait if timeout is None else timeout
+        start = time.monotonic()
+
+        with self._cond:
+            if self._backlog.get(pair, 0) <= self.backlog_limit:
+                return 0.0
+
+            logger.warning(
+                "backpressure", idNPC=idNPC, idUser=idUser,
+                backlog=self._backlog[pair], limit=self.backlog_limit
+            )
+            while self._backlog.get(pair, 0) > self.backlog_limit:
+                remaining = start + timeout - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(timeout=remaining)
+
+            waited = time.monotonic() - start
+            self._stats["backpressure_waits"] += 1
+            self._stats["backpressure_wait_s"] += waited
+        return waited
+
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._running:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(timeout=remaining)
+        return True
+
+    # --------------------------------------------------
+    def _job(self, fn, *args):
+        db = connect()
+        cursor = db.cursor(dictionary=True)
+        try:
+            result = fn(cursor, *args)
+            db.commit()
+            return result
+        finally:
+            cursor.close()
+            db.close()
+
+    @contextmanager
+    def _keep_lease(self, idNPC, idUser):
+        """
+        Renews the pair's lease in the background while the block runs.
+        Yields an Event that is set once the lease is lost.
+        """
+        lost = Event()
+        done = Event()
+
+        def beat():
+            while not done.wait(LEASE_RENEW_S):
+                try:
+                    if not self._job(renew_lease, idNPC, idUser, WORKER_ID):
+                        lost.set()
+                        return
+                except Exception as e:
+                    logger.warning("lease renewal failed", idNPC=idNPC, idUser=idUser, error=str(e))
+
+        Thread(target=beat, daemon=True).start()
+        try:
+            yield lost
+        finally:
+            done.set()
+
+    def _sweep_loop(self):
+        first = True
+        while True:
+            try:
+                if first:
+                    added = self._job(enqueue_unjobbed_pairs)
+                    if added:
+                        logger.info("startup sweep re-enqueued pairs", pairs=added)
+                for pair in self._job(due_jobs):
+                    self._start(pair)
+                first = False
+            except Exception as e:
+                logger.error("sweep failed", error=str(e))
+            time.sleep(SWEEP_INTERVAL_S)
+
+    def _start(self, pair):
+        with self._cond:
+            if pair in self._running:
+                self._dirty.add(pair)
+                return
+            self._running.add(pair)
+
+        Thread(target=self._run, args=(pair,), daemon=True).start()
+
+    def _run(self, pair):
+        idNPC, idUser = pair
+        try:
+            while True:
+                with self._cond:
+                    self._dirty.discard(pair)
+
+                if not self._drain(idNPC, idUser):
+                    return      # not ours (leased elsewhere / backing off) or failed
+
+                with self._cond:
+                    if pair not in self._dirty:
+                        return
+        finally:
+            with self._cond:
+                self._running.discard(pair)
+                self._cond.notify_all()
+
+    def _drain(self, idNPC, idUser) -> bool:
+        """
+        Lease the job, consolidate until the buffer is empty, release.
+        Returns False if the job could not be claimed or failed.
+        """
+        while True:
+            generation = self._job(claim_job, idNPC, idUser, WORKER_ID)
+            if generation is None:
+                return False
+
+            try:
+                # reasoner calls queue behind turns, fairly per user
+                with for_user(idUser), self._keep_lease(idNPC, idUser) as lost:
+                    conflicts = 0
+                    while True:
+                        try:
+                            n = self.process_batch(idNPC, idUser)
+                        except MemoryConflict:
+                            conflicts += 1
+                            if conflicts > CONFLICT_RETRIES:
+                                raise
+                            with self._cond:
+                                self._stats["conflicts"] += 1
+                            logger.info("kbText changed during consolidation, redoing batch",
+                                        idNPC=idNPC, idUser=idUser, conflicts=conflicts)
+                            continue
+                        if not n:
+                            break
+                        conflicts = 0
+                        if lost.is_set() or not self._job(renew_lease, idNPC, idUser, WORKER_ID):
+                            logger.warning("lost its lease", idNPC=idNPC, idUser=idUser)
+                            return False
+            except Exception as e:
+                logger.exception("consolidation failed, will retry", idNPC=idNPC, idUser=idUser, error=str(e))
+                with self._cond:
+                    self._stats["failures"] += 1
+                self._job(fail_job, idNPC, idUser, WORKER_ID, e)
+                return False
+
+            # enqueued again while draining -> claim the next generation
+            if self._job(complete_job, idNPC, idUser, WORKER_ID, generation):
+                return True
+
+    def process_batch(self, idNPC, idUser) -> int:
+        """
+        Consolidates one bounded batch. Returns the number of
+        exchanges consolidated (0 = nothing left).
+        """
+        logger.debug("updating memory", idNPC=idNPC, idUser=idUser)
+        started = time.monotonic()
+
+        db = connect()
+        cursor = db.cursor(dictionary=True)
+        try:
+            exchanges, buffer_ids, ages, backlog, orphan_ids = fetch_batch(
+                cursor, idNPC, idUser, self.max_exchanges, self.token_budget
+            )
+
+            with self._cond:
+                self._backlog[(idNPC, idUser)] = backlog
+                self._cond.notify_all()
+
+            # unpaired rows: keep them out of the prompt's recent
+            # dialogue and out of every future batch
+            if orphan_ids:
+                placeholders = ",".join(["%s"] * len(orphan_ids))
+                cursor.execute(f"""
+                    UPDATE npc_user_memory_buffer
+                    SET processed = 2,
+                        processedAt = NOW()
+                    WHERE idBuffer IN ({placeholders})
+                """, tuple(orphan_ids))
+                db.commit()
+                logger.info("marked orphaned player turns", idNPC=idNPC, idUser=idUser, count=len(orphan_ids))
+
+            # require at least one complete player -> npc exchange
+            if not exchanges:
+                return 0
+
+            kbtext_current, kb_version = get_mem_versioned(idNPC=idNPC, idUser=idUser)
+
+            relevant_self_beliefs = get_self_beliefs_snapshot(idNPC)
+            relevant_player_beliefs = get_player_beliefs_snapshot(idNPC, idUser)
+
+            updated_kb = openAIqueries.update_structured_kbtext(
+                client=None,
+                idUser=idUser,
+                idNPC=idNPC,
+                kbtext_current=kbtext_current,
+                exchanges=exchanges,
+                relevant_self_beliefs=relevant_self_beliefs,
+                relevant_player_beliefs=relevant_player_beliefs,
+            )
+
+            updated_kb = commit_NPC_user_memory(
+                idNPC=idNPC,
+                idUser=idUser,
+                base_text=kbtext_current,
+                base_version=kb_version,
+                kbText=updated_kb
+            )
+            if updated_kb is None:
+                # rewritten underneath us: leave the rows unprocessed,
+                # _drain redoes the batch from the fresh text
+                raise MemoryConflict(f"kbText changed during consolidation (npc={idNPC} user={idUser})")
+            # re-tokenize only the rewritten / new scene
+            update_index(idNPC, idUser, updated_kb)
+
+            placeholders = ",".join(["%s"] * len(buffer_ids))
+
+            cursor.execute(f"""
+                UPDATE npc_user_memory_buffer
+                SET processed = 1,
+                    processedAt = NOW()
+                WHERE idBuffer IN ({placeholders})
+            """, tuple(buffer_ids))
+
+            db.commit()
+        finally:
+            cursor.close()
+            db.close()
+
+        elapsed = time.monotonic() - started
+        self._record(idNPC, idUser, len(exchanges), backlog, [a + elapsed for a in ages], elapsed)
+        return len(exchanges)
+
+    # --------------------------------------------------
+    # throughput / lag metrics
+    # --------------------------------------------------
+    def _record(self, idNPC, idUser, n, backlog, lags, elapsed):
+        with self._cond:
+            pair = (idNPC, idUser)
+            self._backlog[pair] = max(0, backlog - n)
+            self._stats["batches"] += 1
+            self._stats["exchanges"] += n
+            self._stats["busy_s"] += elapsed
+            self._lags.extend(lags)
+            self._cond.notify_all()
+
+        logger.info(
+            "processed exchanges", idNPC=idNPC, idUser=idUser,
+            exchanges=n, seconds=round(elapsed, 1),
+            lag_max_s=round(max(lags), 1), backlog=max(0, backlog - n)
+        )
+
+    def stats(self) -> dict:
+        with self._cond:
+            s = dict(self._stats)
+            lags = sorted(self._lags)
+            s["backlog"] = {f"{k[0]}:{k[1]}": v for k, v in self._backlog.items() if v}
+            s["workers"] = len(self._running)
+
+        s["memory_writes"] = memory_write_stats()
+
+        uptime = time.monotonic() - s.pop("started")
+        s["exchanges_per_s"] = round(s["exchanges"] / uptime, 4) if uptime else 0.0
+        s["exchanges_per_busy_s"] = round(s["exchanges"] / s["busy_s"], 4) if s["busy_s"] else 0.0
+        s["exchanges_per_call"] = round(s["exchanges"] / s["batches"], 2) if s["batches"] else 0.0
+
+        if lags:
+            s["lag_s"] = {
+                "avg": round(sum(lags) / len(lags), 2),
+                "p50": round(lags[len(lags) // 2], 2),
+                "p95": round(lags[min(len(lags) - 1, int(len(lags) * 0.95))], 2),
+                "max": round(lags[-1], 2)
+            }
+        return s
@@ -0,0 +1,436 @@
+import argparse
+import base64
+import gzip
+import json
+import os
+import time
+from datetime import date, datetime
+from threading import Thread
+from dotenv import load_dotenv
+import mysql.connector
+from phase_2_queries import connect
+from storage_codec import decode_text
+from structured_log import get_logger
+#------------------------------------------------------------------
+# Retention / archival
+#
+# npc_user_memory_buffer rows stay behind after consolidation
+# (processed = 1, or 2 for orphaned turns) and
+# player_input_classification_log only grows. Both are moved out of
+# the live tables in small batches:
+#
+#   RETENTION_TARGET=table  -> *_archive tables (monthly partitions)
+#   RETENTION_TARGET=file   -> ARCHIVE_DIR/<table>/<YYYY-MM>.ndjson.gz
+#
+# Each batch is its own short transaction (copy, then delete by
+# primary key) with a short lock wait, and batches are spaced by
+# RETENTION_PAUSE_MS, so per-turn queries never queue behind it.
+# A batch that hits a lock wait is retried after a backoff.
+#
+# The research aggregates (player_input_classification_stats) are
+# kept live; backfill_research_stats.py reads the archive table too
+# (file target: archived logs are no longer part of a backfill).
+#
+#   python memory_retention.py --report        # sizes + scan costs only
+#   python memory_retention.py [--dry-run] [--target table|file]
+#------------------------------------------------------------------
+load_dotenv()
+
+RETENTION_TARGET = os.getenv("RETENTION_TARGET", "table")
+BUFFER_RETENTION_DAYS = int(os.getenv("RETENTION_BUFFER_DAYS", "3"))
+CLASSIFICATION_RETENTION_DAYS = int(os.getenv("RETENTION_CLASSIFICATION_DAYS", "30"))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "500"))
+RETENTION_PAUSE_S = float(os.getenv("RETENTION_PAUSE_MS", "200")) / 1000
+RETENTION_LOCK_WAIT_S = int(os.getenv("RETENTION_LOCK_WAIT_S", "2"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "./archive")
+
+ER_LOCK_WAIT_TIMEOUT = 1205
+ER_LOCK_DEADLOCK = 1213
+
+BUFFER_COLUMNS = [
+    "idBuffer", "idNPC", "idUser", "playerText", "npcText", "npcEmotion",
+    "npcIntensity", "selfBeliefsJson", "playerBeliefsJson",
+    "playerOutputClassifiedAsJson", "metaJson", "createdAt", "processedAt", "processed"
+]
+LOG_COLUMNS = [
+    "idLog", "idUser", "idNPC", "playerText", "sentiment", "intensity",
+    "offensive", "emotion", "target", "trust_delta", "modelUsed",
+    "temperature", "createdAt"
+]
+
+# table -> what ages out, and how to find it
+POLICIES = {
+    "npc_user_memory_buffer": {
+        "key": "idBuffer",
+        "columns": BUFFER_COLUMNS,
+        "where": "processed IN (1, 2) AND processedAt < NOW() - INTERVAL %s DAY",
+        "days": BUFFER_RETENTION_DAYS,
+    },
+    "player_input_classification_log": {
+        "key": "idLog",
+        "columns": LOG_COLUMNS,
+        "where": "createdAt < NOW() - INTERVAL %s DAY",
+        "days": CLASSIFICATION_RETENTION_DAYS,
+    },
+}
+
+logger = get_logger("retention")
+
+#------------------------------------------------------------------
+# Archive table partitions
+#------------------------------------------------------------------
+def _month_start(d: date) -> date:
+    return d.replace(day=1)
+
+def _next_month(d: date) -> date:
+    return date(d.year + (d.month == 12), d.month % 12 + 1, 1)
+
+def ensure_partitions(cursor, archive: str, oldest: date, months_ahead: int = 1):
+    """
+    Split monthly partitions off pmax so that every month from
+    `oldest` to now + months_ahead has its own partition.
+    """
+    cursor.execute("""
+        SELECT PARTITION_DESCRIPTION
+        FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+          AND PARTITION_NAME IS NOT NULL AND PARTITION_NAME != 'pmax'
+    """, (archive,))
+    bounds = {
+        datetime.strptime(r["PARTITION_DESCRIPTION"].strip("'")[:10], "%Y-%m-%d").date()
+        for r in cursor.fetchall()
+    }
+    highest = max(bounds) if bounds else None
+
+    month = _month_start(oldest) if highest is None else highest
+    until = _month_start(date.today())
+    for _ in range(months_ahead + 1):
+        until = _next_month(until)
+
+    new = []
+    while True:
+        upper = _next_month(month)
+        if upper > until:
+            break
+        if highest is None or upper > highest:
+            new.append(upper)
+        month = upper
+
+    if not new:
+        return
+    parts = ", ".join(
+        f"PARTITION p{(b.replace(day=1) - date.resolution).strftime('%Y%m')} VALUES LESS THAN ('{b.isoformat()}')"
+        for b in new
+    )
+    cursor.execute(f"""
+        ALTER TABLE {archive} REORGANIZE PARTITION pmax INTO (
+            {parts},
+            PARTITION pmax VALUES LESS THAN (MAXVALUE)
+        )
+    """)
+    logger.info("added archive partitions", archive=archive, count=len(new))
+
+def drop_partitions_before(cursor, archive: str, keep_months: int) -> int:
+    """
+    Purge whole archived months older than keep_months (0 = keep all).
+    """
+    if keep_months <= 0:
+        return 0
+    cutoff = _month_start(date.today())
+    for _ in range(keep_months):
+        cutoff = date(cutoff.year - (cutoff.month == 1), (cutoff.month - 2) % 12 + 1, 1)
+
+    cursor.execute("""
+        SELECT PARTITION_NAME, PARTITION_DESCRIPTION
+        FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+          AND PARTITION_NAME IS NOT NULL AND PARTITION_NAME != 'pmax'
+    """, (archive,))
+    old = [
+        r["PARTITION_NAME"] for r in cursor.fetchall()
+        if datetime.strptime(r["PARTITION_DESCRIPTION"].strip("'")[:10], "%Y-%m-%d").date() <= cutoff
+    ]
+    if old:
+        cursor.execute(f"ALTER TABLE {archive} DROP PARTITION {', '.join(old)}")
+        logger.info("dropped archive partitions", archive=archive, count=len(old), before=str(cutoff))
+    return len(old)
+
+#------------------------------------------------------------------
+# NDJSON target
+#------------------------------------------------------------------
+def _json_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        try:
+            return decode_text(value)
+        except Exception:
+            return {"b64": base64.b64encode(bytes(value)).decode("ascii")}
+    return value
+
+def write_ndjson(table: str, rows: list[dict]) -> dict:
+    """
+    Append rows to ARCHIVE_DIR/<table>/<YYYY-MM>.ndjson.gz, one gzip
+    member per batch (readers see one concatenated stream).
+    Returns {path: rows_written}.
+    """
+    by_month = {}
+    for r in rows:
+        created = r["createdAt"] or datetime.now()
+        by_month.setdefault(created.strftime("%Y-%m"), []).append(r)
+
+    written = {}
+    for month, month_rows in by_month.items():
+        folder = os.path.join(ARCHIVE_DIR, table)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{month}.ndjson.gz")
+
+        payload = "".join(
+            json.dumps({k: _json_value(v) for k, v in r.items()}) + "\n"
+            for r in month_rows
+        ).encode("utf-8")
+        with open(path, "ab") as f:
+            f.write(gzip.compress(payload))
+            f.flush()
+            os.fsync(f.fileno())
+        written[path] = len(month_rows)
+    return written
+
+#------------------------------------------------------------------
+# Batch mover
+#------------------------------------------------------------------
+def _archive_batch(db, table: str, policy: dict, target: str) -> int:
+    key = policy["key"]
+    columns = policy["columns"]
+    cursor = db.cursor(dictionary=True)
+    try:
+        cursor.execute(f"""
+            SELECT {", ".join(columns)}
+            FROM {table}
+            WHERE {policy["where"]}
+            ORDER BY {key}
+            LIMIT %s
+        """, (policy["days"], RETENTION_BATCH))
+        rows = cursor.fetchall()
+        if not rows:
+            db.rollback()
+            return 0
+
+        ids = [r[key] for r in rows]
+        placeholders = ",".join(["%s"] * len(ids))
+
+        if target == "file":
+            # file first: a crash before the delete only duplicates lines
+            write_ndjson(table, rows)
+        else:
+            archive = f"{table}_archive"
+            oldest = min((r["createdAt"] for r in rows if r["createdAt"]), default=datetime.now())
+            ensure_partitions(cursor, archive, oldest.date())
+            select_cols = [
+                "COALESCE(createdAt, NOW())" if c == "createdAt" else c
+                for c in columns
+            ]
+            cursor.execute(f"""
+                INSERT IGNORE INTO {archive} ({", ".join(columns)})
+                SELECT {", ".join(select_cols)}
+                FROM {table}
+                WHERE {key} IN ({placeholders})
+            """, tuple(ids))
+
+        cursor.execute(f"DELETE FROM {table} WHERE {key} IN ({placeholders})", tuple(ids))
+        db.commit()
+        return len(ids)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cursor.close()
+
+def archive_table(table: str, target: str = RETENTION_TARGET, dry_run: bool = False, max_batches: int | None = None) -> int:
+    policy = POLICIES[table]
+    db = connect()
+    cursor = db.cursor()
+    cursor.execute("SET SESSION innodb_lock_wait_timeout = %s", (RETENTION_LOCK_WAIT_S,))
+    cursor.close()
+
+    moved = 0
+    batches = 0
+    backoff = RETENTION_PAUSE_S
+    try:
+        if dry_run:
+            cursor = db.cursor()
+            cursor.execute(f"SELECT COUNT(*) FROM {table} WHERE {policy['where']}", (policy["days"],))
+            count = cursor.fetchone()[0]
+            cursor.close()
+            logger.info("dry run", table=table, rows=count, target=target)
+            return count
+
+        while max_batches is None or batches < max_batches:
+            try:
+                n = _archive_batch(db, table, policy, target)
+            except mysql.connector.Error as err:
+                if err.errno not in (ER_LOCK_WAIT_TIMEOUT, ER_LOCK_DEADLOCK):
+                    raise
+                backoff = min(backoff * 2, 10.0)
+                logger.warning("lock contention, backing off", table=table, backoff_s=round(backoff, 1))
+                time.sleep(backoff)
+                continue
+
+            if not n:
+                break
+            moved += n
+            batches += 1
+            backoff = RETENTION_PAUSE_S
+            time.sleep(RETENTION_PAUSE_S)
+    finally:
+        db.close()
+
+    logger.info("archived", table=table, rows=moved, batches=batches, target=target)
+    return moved
+
+def run_retention(target: str = RETENTION_TARGET, dry_run: bool = False, keep_archive_months: int = 0) -> dict:
+    moved = {table: archive_table(table, target, dry_run) for table in POLICIES}
+
+    if target == "table" and keep_archive_months and not dry_run:
+        db = connect()
+        cursor = db.cursor(dictionary=True)
+        for table in POLICIES:
+            drop_partitions_before(cursor, f"{table}_archive", keep_archive_months)
+        cursor.close()
+        db.close()
+    return moved
+
+def start_retention_thread(interval_s: float, target: str = RETENTION_TARGET):
+    """
+    Periodic retention inside the server process (RETENTION_INTERVAL_MIN).
+    """
+    def loop():
+        while True:
+            time.sleep(interval_s)
+            try:
+                run_retention(target)
+            except Exception as e:
+                logger.error("retention run failed", error=str(e))
+
+    Thread(target=loop, daemon=True).start()
+
+#------------------------------------------------------------------
+# Size / scan-cost report
+#------------------------------------------------------------------
+REPORT_TABLES = [
+    "npc_user_memory_buffer",
+    "player_input_classification_log",
+    "npc_user_memory_buffer_archive",
+    "player_input_classification_log_archive",
+]
+
+# queries that scan the retained tables
+HOT_QUERIES = {
+    "recent_dialogue": """
+        SELECT playerText, npcText FROM npc_user_memory_buffer
+        WHERE idNPC = %s AND idUser = %s AND processed = 0
+        ORDER BY createdAt ASC
+    """,
+    "consolidation_batch": """
+        SELECT idBuffer, playerText, npcText FROM npc_user_memory_buffer
+        WHERE idNPC = %s AND idUser = %s AND processed = 0
+        ORDER BY createdAt ASC, idBuffer ASC
+    """,
+    "classification_history": """
+        SELECT sentiment, emotion FROM player_input_classification_log
+        WHERE idNPC = %s AND idUser = %s
+    """,
+}
+
+def _busiest_pair(cursor):
+    cursor.execute("""
+        SELECT idNPC, idUser FROM npc_user_memory_buffer
+        GROUP BY idNPC, idUser ORDER BY COUNT(*) DESC LIMIT 1
+    """)
+    row = cursor.fetchone()
+    return (row["idNPC"], row["idUser"]) if row else (0, 0)
+
+def size_report(repeat: int = 20) -> dict:
+    db = connect()
+    cursor = db.cursor(dictionary=True)
+    report = {"tables": {}, "queries": {}}
+    try:
+        cursor.execute(f"""
+            SELECT TABLE_NAME, TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH
+            FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE()
+              AND TABLE_NAME IN ({",".join(["%s"] * len(REPORT_TABLES))})
+        """, tuple(REPORT_TABLES))
+        for r in cursor.fetchall():
+            report["tables"][r["TABLE_NAME"]] = {
+                "rows_est": int(r["TABLE_ROWS"] or 0),
+                "data_bytes": int(r["DATA_LENGTH"] or 0),
+                "index_bytes": int(r["INDEX_LENGTH"] or 0),
+            }
+
+        pair = _busiest_pair(cursor)
+        for name, sql in HOT_QUERIES.items():
+            cursor.execute("EXPLAIN FORMAT=JSON " + sql, pair)
+            plan = json.loads(list(cursor.fetchone().values())[0])
+            block = plan.get("query_block", {})
+            cost = float(block.get("cost_info", {}).get("query_cost", 0) or 0)
+
+            start = time.perf_counter()
+            for _ in range(repeat):
+                cursor.execute(sql, pair)
+                cursor.fetchall()
+            ms = (time.perf_counter() - start) * 1000 / repeat
+
+            report["queries"][name] = {"pair": pair, "est_cost": cost, "avg_ms": round(ms, 3)}
+    finally:
+        cursor.close()
+        db.close()
+    return report
+
+def print_report(before: dict, after: dict | None = None):
+    print("\n[RETENTION REPORT] tables")
+    for name in REPORT_TABLES:
+        b = before["tables"].get(name)
+        if not b:
+            continue
+        line = f"  {name:42s} rows~{b['rows_est']:>9,d}  data {b['data_bytes']:>12,d} B  idx {b['index_bytes']:>10,d} B"
+        a = (after or {}).get("tables", {}).get(name)
+        if a:
+            line += f"  ->  rows~{a['rows_est']:>9,d}  data {a['data_bytes']:>12,d} B  idx {a['index_bytes']:>10,d} B"
+        print(line)
+
+    print("[RETENTION REPORT] hot queries (busiest pair)")
+    for name, b in before["queries"].items():
+        line = f"  {name:24s} cost {b['est_cost']:>10.2f}  {b['avg_ms']:>8.3f} ms"
+        a = (after or {}).get("queries", {}).get(name)
+        if a:
+            line += f"  ->  cost {a['est_cost']:>10.2f}  {a['avg_ms']:>8.3f} ms"
+        print(line)
+
+#------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="archive processed buffer rows and old classification logs")
+    parser.add_argument("--target", choices=["table", "file"], default=RETENTION_TARGET)
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--report", action="store_true", help="only print sizes and scan costs")
+    parser.add_argument("--keep-archive-months", type=int, default=0,
+                        help="drop archive partitions older than this (table target)")
+    args = parser.parse_args()
+
+    before = size_report()
+    if args.report:
+        print_report(before)
+    else:
+        moved = run_retention(args.target, args.dry_run, args.keep_archive_months)
+        for table, rows in moved.items():
+            print(f"[RETENTION] {table}: {rows} rows {'would be ' if args.dry_run else ''}archived ({args.target})")
+        # InnoDB statistics lag behind large deletes
+        if not args.dry_run:
+            db = connect()
+            cursor = db.cursor()
+            for table in REPORT_TABLES:
+                cursor.execute(f"ANALYZE TABLE {table}")
+                cursor.fetchall()
+            cursor.close()
+            db.close()
+        print_report(before, size_report())
@@ -0,0 +1,219 @@
+import hashlib
+import math
+import os
+import re
+from collections import Counter, OrderedDict
+from threading import Lock
+from scene_document import split_scenes
+from token_budget import estimate_tokens
+from structured_log import get_logger
+#------------------------------------------------------------------
+# Relevance-ranked scene retrieval for the NPC prompt
+#
+# kbText grows one scene at a time. Instead of inlining all of it,
+# build_prompt asks for the latest scene plus the top-K past scenes
+# that are relevant to what the player just said, within a token
+# budget, so prompt size stays flat as relationships get long.
+#
+# Index: in-process BM25 per (idNPC, idUser). Every scene is one
+# document and every compressed bullet of a scene is another
+# document pointing back to its scene (scene score = best of both),
+# so a single remembered fact in a compressed scene can still pull
+# that scene in. Scenes are indexed by position + content hash; when
+# consolidation rewrites the latest scene only that scene is
+# re-tokenized. At most MEMORY_INDEX_MAX_PAIRS indexes are kept, least
+# recently used dropped first; a dropped index is rebuilt from kbText
+# on the pair's next retrieval.
+#------------------------------------------------------------------
+RETRIEVAL_TOP_K = int(os.getenv("MEMORY_RETRIEVAL_TOP_K", "3"))
+RETRIEVAL_TOKENS = int(os.getenv("MEMORY_RETRIEVAL_TOKENS", "6000"))
+MEMORY_INDEX_MAX_PAIRS = int(os.getenv("MEMORY_INDEX_MAX_PAIRS", "2000"))
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_STOPWORDS = {
+    "the", "a", "an", "and", "or", "but", "to", "of", "in", "on", "at",
+    "for", "with", "is", "are", "was", "were", "be", "been", "it", "its",
+    "i", "you", "he", "she", "we", "they", "me", "my", "your", "that",
+    "this", "as", "by", "from", "so", "do", "did", "not", "no", "yes",
+    "about", "what", "how", "why", "when", "where", "who", "there", "have",
+    "has", "had", "just", "can", "will", "would", "could", "if", "then",
+    "than", "all", "any", "some", "up", "out", "into", "over", "our", "us",
+    "him", "her", "them", "his", "their",
+    # memory document labels
+    "said", "speaker", "player", "npc", "intensity", "felt", "responding",
+    "none", "notes", "bias", "scene", "episodes", "lens", "got", "here",
+    "compressed", "order", "peak", "end"
+}
+_TOKEN_RE = re.compile(r"[a-z0-9']+")
+
+logger = get_logger("retrieval")
+
+def tokenize(text: str) -> list[str]:
+    return [
+        t for t in _TOKEN_RE.findall((text or "").lower())
+        if len(t) > 1 and t not in _STOPWORDS
+    ]
+
+def scene_bullets(scene: str) -> list[str]:
+    """
+    Bullet lines of the scene's 'EPISODES (compressed)' block.
+    """
+    bullets = []
+    in_compressed = False
+    for line in scene.splitlines():
+        stripped = line.strip()
+        if stripped.startswith("EPISODES (compressed)"):
+            in_compressed = True
+            continue
+        if stripped.startswith("EPISODES (in order)") or stripped.startswith("Scene peak intensity"):
+            in_compressed = False
+            continue
+        if in_compressed and stripped.startswith("- "):
+            bullets.append(stripped[2:])
+    return bullets
+#------------------------------------------------------------------
+_indexes = OrderedDict()    # (idNPC, idUser) -> index dict, LRU order
+_indexes_lock = Lock()
+
+def _new_index() -> dict:
+    return {"entries": [], "df": Counter(), "n_docs": 0, "total_len": 0}
+
+def _make_docs(scene: str) -> list[Counter]:
+    docs = [Counter(tokenize(scene))]
+    docs.extend(Counter(tokenize(b)) for b in scene_bullets(scene))
+    return [d for d in docs if d]
+
+def _add_docs(index: dict, docs: list[Counter]):
+    for tf in docs:
+        index["df"].update(tf.keys())
+        index["n_docs"] += 1
+        index["total_len"] += sum(tf.values())
+
+def _remove_docs(index: dict, docs: list[Counter]):
+    for tf in docs:
+        index["df"].subtract(tf.keys())
+        index["n_docs"] -= 1
+        index["total_len"] -= sum(tf.values())
+    index["df"] += Counter()    # drop zero counts
+
+def update_index(idNPC: int, idUser: int, kbtext: str) -> list[str]:
+    """
+    Bring the (idNPC, idUser) index in line with kbtext, re-tokenizing
+    only scenes whose content changed. Returns the scene list.
+    """
+    scenes, _ = split_scenes(kbtext or "")
+    hashes = [hashlib.sha1(s.encode("utf-8")).hexdigest() for s in scenes]
+
+    with _indexes_lock:
+        index = _indexes.setdefault((idNPC, idUser), _new_index())
+        _indexes.move_to_end((idNPC, idUser))
+        while len(_indexes) > MEMORY_INDEX_MAX_PAIRS:
+            _indexes.popitem(last=False)
+        entries = index["entries"]
+
+        # scenes removed from the end (or front trimmed by the kb cap)
+        while len(entries) > len(scenes):
+            _remove_docs(index, entries.pop()["docs"])
+
+        for i, (scene, digest) in enumerate(zip(scenes, hashes)):
+            if i < len(entries) and entries[i]["hash"] == digest:
+                continue
+            docs = _make_docs(scene)
+            if i < len(entries):
+                _remove_docs(index, entries[i]["docs"])
+                entries[i] = {"hash": digest, "docs": docs}
+            else:
+                entries.append({"hash": digest, "docs": docs})
+            _add_docs(index, docs)
+
+    return scenes
+
+def drop_index(idNPC: int, idUser: int):
+    with _indexes_lock:
+        _indexes.pop((idNPC, idUser), None)
+#------------------------------------------------------------------
+def _bm25(index: dict, tf: Counter, query_terms: list[str]) -> float:
+    n = max(1, index["n_docs"])
+    avgdl = index["total_len"] / n if index["total_len"] else 1.0
+    dl = sum(tf.values())
+    score = 0.0
+    for term in query_terms:
+        f = tf.get(term, 0)
+        if not f:
+            continue
+        df = index["df"].get(term, 0)
+        idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        score += idf * f * (BM25_K1 + 1) / (f + BM25_K1 * (1 - BM25_B + BM25_B * dl / avgdl))
+    return score
+
+def rank_scenes(idNPC: int, idUser: int, query: str) -> list[tuple[int, float]]:
+    """
+    [(scene_index, score), ...] best first, latest scene excluded,
+    zero-score scenes omitted.
+    """
+    query_terms = list(dict.fromkeys(tokenize(query)))
+    if not query_terms:
+        return []
+
+    with _indexes_lock:
+        index = _indexes.get((idNPC, idUser))
+        if not index:
+            return []
+        scored = []
+        for i, entry in enumerate(index["entries"][:-1]):
+            best = max((_bm25(index, tf, query_terms) for tf in entry["docs"]), default=0.0)
+            if best > 0:
+                scored.append((i, best))
+
+    scored.sort(key=lambda x: (-x[1], -x[0]))
+    return scored
+#------------------------------------------------------------------
+def retrieve_memory(
+    idNPC: int,
+    idUser: int,
+    kbtext: str,
+    query: str,
+    top_k: int = RETRIEVAL_TOP_K,
+    token_budget: int = RETRIEVAL_TOKENS
+) -> tuple[str, dict]:
+    """
+    Latest scene + up to top_k relevant past scenes (chronological),
+    within token_budget. Text outside scenes is kept after the scenes.
+    Returns (memory_text, report).
+    """
+    scenes = update_index(idNPC, idUser, kbtext)
+    _, loose = split_scenes(kbtext or "")
+
+    if not scenes:
+        return (kbtext or "").strip(), {"scenes_total": 0, "scenes_selected": []}
+
+    latest = len(scenes) - 1
+    used = estimate_tokens(scenes[latest]) + estimate_tokens(loose)
+    selected = [latest]
+
+    for i, score in rank_scenes(idNPC, idUser, query):
+        if len(selected) > top_k:
+            break
+        cost = estimate_tokens(scenes[i])
+        if used + cost > token_budget:
+            continue
+        selected.append(i)
+        used += cost
+
+    selected.sort()
+    memory_text = "\n\n".join(scenes[i] for i in selected)
+    if loose:
+        memory_text += "\n\n" + loose
+
+    report = {
+        "scenes_total": len(scenes),
+        "scenes_selected": selected,
+        "tokens": used
+    }
+    logger.debug(
+        "memory retrieval", idNPC=idNPC, idUser=idUser,
+        scenes=len(selected), scenes_total=len(scenes), tokens=used
+    )
+    return memory_text, report
@@ -0,0 +1,146 @@
+import argparse
+from dotenv import load_dotenv
+from phase_2_queries import connect
+from storage_codec import encode_bytes, is_encoded, STORAGE_CODEC
+#------------------------------------------------------------------
+# One-off migration to compressed column storage (storage_codec.py)
+#
+#   python migrate_storage_codec.py --dry-run   # sizes only
+#   python migrate_storage_codec.py             # alter + re-encode
+#
+# 1. npc_user_memory.kbText and the npc_user_memory_buffer *Json
+#    columns become LONGBLOB (existing values are kept as utf-8).
+# 2. Every value without a codec header is re-encoded in batches.
+#    kbText rows are rewritten only if their version is unchanged,
+#    so it is safe to run while the server is up; re-run to pick up
+#    rows that were busy.
+#------------------------------------------------------------------
+load_dotenv()
+
+COLUMNS = [
+    ("npc_user_memory", "kbText"),
+    ("npc_user_memory_buffer", "selfBeliefsJson"),
+    ("npc_user_memory_buffer", "playerBeliefsJson"),
+    ("npc_user_memory_buffer", "playerOutputClassifiedAsJson"),
+]
+BUFFER_JSON = [c for t, c in COLUMNS if t == "npc_user_memory_buffer"]
+#------------------------------------------------------------------
+def column_sizes(cursor) -> dict:
+    sizes = {}
+    for table, column in COLUMNS:
+        cursor.execute(f"SELECT COALESCE(SUM(LENGTH({column})), 0) AS b FROM {table}")
+        sizes[f"{table}.{column}"] = int(cursor.fetchone()["b"])
+    return sizes
+
+def alter_columns(cursor, dry_run: bool):
+    for table, column in COLUMNS:
+        cursor.execute("""
+            SELECT DATA_TYPE
+            FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE()
+              AND TABLE_NAME = %s AND COLUMN_NAME = %s
+        """, (table, column))
+        row = cursor.fetchone()
+        if not row or row["DATA_TYPE"].lower() == "longblob":
+            continue
+        print(f"[MIGRATE] {table}.{column}: {row['DATA_TYPE']} -> LONGBLOB")
+        if not dry_run:
+            cursor.execute(f"ALTER TABLE {table} MODIFY {column} LONGBLOB NULL")
+
+def _as_bytes(value) -> bytes:
+    return value.encode("utf-8") if isinstance(value, str) else bytes(value)
+#------------------------------------------------------------------
+def migrate_memory(db, batch: int, dry_run: bool) -> int:
+    cursor = db.cursor(dictionary=True)
+    migrated = 0
+    last = (0, 0)
+    while True:
+        cursor.execute("""
+            SELECT idNPC, idUser, kbText, version
+            FROM npc_user_memory
+            WHERE (idNPC, idUser) > (%s, %s)
+            ORDER BY idNPC, idUser
+            LIMIT %s
+        """, (last[0], last[1], batch))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        last = (rows[-1]["idNPC"], rows[-1]["idUser"])
+
+        for r in rows:
+            if r["kbText"] is None or is_encoded(r["kbText"]):
+                continue
+            migrated += 1
+            if dry_run:
+                continue
+            # same text, so the version is left alone
+            cursor.execute("""
+                UPDATE npc_user_memory
+                SET kbText = %s, updatedAt = updatedAt
+                WHERE idNPC = %s AND idUser = %s AND version = %s
+            """, (encode_bytes(_as_bytes(r["kbText"])), r["idNPC"], r["idUser"], r["version"]))
+        db.commit()
+    cursor.close()
+    return migrated
+
+def migrate_buffer(db, batch: int, dry_run: bool) -> int:
+    cursor = db.cursor(dictionary=True)
+    migrated = 0
+    last = 0
+    while True:
+        cursor.execute(f"""
+            SELECT idBuffer, {", ".join(BUFFER_JSON)}
+            FROM npc_user_memory_buffer
+            WHERE idBuffer > %s
+            ORDER BY idBuffer
+            LIMIT %s
+        """, (last, batch))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        last = rows[-1]["idBuffer"]
+
+        for r in rows:
+            updates = {
+                c: encode_bytes(_as_bytes(r[c]))
+                for c in BUFFER_JSON
+                if r[c] is not None and not is_encoded(r[c])
+            }
+            if not updates:
+                continue
+            migrated += 1
+            if dry_run:
+                continue
+            assignments = ", ".join(f"{c} = %s" for c in updates)
+            cursor.execute(
+                f"UPDATE npc_user_memory_buffer SET {assignments} WHERE idBuffer = %s",
+                (*updates.values(), r["idBuffer"])
+            )
+        db.commit()
+    cursor.close()
+    return migrated
+#------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compress kbText / buffer JSON columns")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--batch", type=int, default=200)
+    args = parser.parse_args()
+
+    db = connect()
+    cursor = db.cursor(dictionary=True)
+
+    before = column_sizes(cursor)
+    alter_columns(cursor, args.dry_run)
+    db.commit()
+
+    memory_rows = migrate_memory(db, args.batch, args.dry_run)
+    buffer_rows = migrate_buffer(db, args.batch, args.dry_run)
+
+    after = column_sizes(cursor)
+    cursor.close()
+    db.close()
+
+    verb = "would re-encode" if args.dry_run else "re-encoded"
+    print(f"[MIGRATE] codec={STORAGE_CODEC}: {verb} {memory_rows} memory rows, {buffer_rows} buffer rows")
+    for key in before:
+        print(f"[MIGRATE] {key:55s} {before[key]:>12,d} B -> {after[key]:>12,d} B")
@@ -0,0 +1,245 @@
+import json
+import os
+import random
+import re
+import time
+import zlib
+from collections import Counter
+from threading import Lock
+from types import SimpleNamespace
+from scene_document import apply_patch
+#------------------------------------------------------------------
+# Offline LLM / TTS stand-ins for load testing
+#
+#   LLM_PROVIDER=mock   get_llm_client() returns MockLLMClient
+#   TTS_PROVIDER=mock   elevenlabsQueries.tts() yields synthetic MP3
+#
+# The client mimics the parts of the OpenAI SDK the app uses
+# (chat.completions.create, streaming chunks, usage). Each call is
+# answered by its stage name (passed in by telemetry.chat_completion)
+# with JSON that passes the caller's validation, so the whole npc_interact pipeline -- db
+# writes, consolidation, state emits -- runs without vendor calls.
+# Answers are seeded by the prompt, so a replayed dialogue produces
+# the same output.
+#------------------------------------------------------------------
+MOCK_LLM_TTFT_MS = float(os.getenv("MOCK_LLM_TTFT_MS", "300"))
+MOCK_LLM_TOKENS_PER_S = float(os.getenv("MOCK_LLM_TOKENS_PER_S", "40"))
+MOCK_LLM_RESPONSE_TOKENS = int(os.getenv("MOCK_LLM_RESPONSE_TOKENS", "60"))
+MOCK_LLM_JSON_MS = float(os.getenv("MOCK_LLM_JSON_MS", "400"))
+MOCK_LLM_REASONER_MS = float(os.getenv("MOCK_LLM_REASONER_MS", "1500"))
+MOCK_LATENCY_JITTER = float(os.getenv("MOCK_LATENCY_JITTER", "0.2"))
+
+MOCK_TTS_LATENCY_MS = float(os.getenv("MOCK_TTS_LATENCY_MS", "250"))
+MOCK_TTS_MS_PER_CHAR = float(os.getenv("MOCK_TTS_MS_PER_CHAR", "2"))
+
+EMOTIONS = ["happy", "sad", "angry", "afraid", "calm", "excited", "disgusted"]
+SENTIMENTS = ["positive", "neutral", "negative", "hostile", "affectionate"]
+TARGETS = ["npc", "self", "environment", "none"]
+TRAITS = ["curious", "guarded", "friendly", "reserved", "brave", "honest", "impatient"]
+SELF_TYPES = ["current_state", "personality_trait", "goal", "fear", "likes", "worldview"]
+
+_WORDS = (
+    "well I remember the harbor that night and the clock in the tower "
+    "you should not trust the stranger with the letter but maybe the map "
+    "tells us where the signal came from I am not sure what you want "
+    "from me yet keep your voice down people listen here"
+).split()
+
+_TURN_RE = re.compile(
+    r'Player said:\s*"""(.*?)"""\s*NPC responded:\s*"""(.*?)"""', re.DOTALL
+)
+_SCENE_RE = re.compile(r'CURRENT SCENE:\s*"""(.*?)"""', re.DOTALL)
+
+_stats = Counter()
+_stats_lock = Lock()
+#------------------------------------------------------------------
+def _sleep_ms(ms: float, rng: random.Random):
+    if ms <= 0:
+        return
+    ms *= 1 + rng.uniform(-MOCK_LATENCY_JITTER, MOCK_LATENCY_JITTER)
+    time.sleep(ms / 1000)
+
+def _count(kind: str):
+    with _stats_lock:
+        _stats[kind] += 1
+
+def mock_stats() -> dict:
+    with _stats_lock:
+        return dict(_stats)
+
+def _usage(prompt: str, completion_tokens: int):
+    prompt_tokens = max(1, len(prompt) // 4)
+    return SimpleNamespace(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+        prompt_cache_hit_tokens=0,
+        prompt_cache_miss_tokens=prompt_tokens
+    )
+
+def _belief(rng, value):
+    return {"value": value, "confidence": round(rng.uniform(0.5, 0.95), 2)}
+#------------------------------------------------------------------
+# canned answers, one per call site in openAIqueries
+#------------------------------------------------------------------
+def _classify_player(rng):
+    return {
+        "sentiment": rng.choice(SENTIMENTS),
+        "intensity": round(rng.uniform(0.1, 0.9), 2),
+        "offensive": rng.random() < 0.05,
+        "emotion": rng.choice(EMOTIONS),
+        "target": rng.choice(TARGETS)
+    }
+
+def _persona_clues(rng):
+    return {
+        "current_emotion": _belief(rng, rng.choice(EMOTIONS)),
+        "moral_alignment": None,
+        "age": None,
+        "gender": None,
+        "life_story": None,
+        "personality_traits": [_belief(rng, rng.choice(TRAITS))],
+        "secrets": [],
+        "goals": [],
+        "likes": [],
+        "dislikes": []
+    }
+
+def _self_beliefs(rng):
+    return {"beliefs": [
+        {
+            "beliefType": rng.choice(SELF_TYPES),
+            "beliefValue": rng.choice(TRAITS),
+            "confidence": round(rng.uniform(0.4, 0.9), 2),
+            "stability": round(rng.uniform(0.2, 0.8), 2)
+        }
+        for _ in range(rng.randint(0, 2))
+    ]}
+
+def _npc_reaction(rng):
+    return {"emotion": rng.choice(EMOTIONS), "intensity": round(rng.uniform(0.1, 0.9), 2)}
+
+def _scene_patch(rng, user):
+    scene = _SCENE_RE.search(user)
+    has_scene = bool(scene and "=== SCENE:" in scene.group(1))
+
+    episodes = []
+    for player_text, npc_text in _TURN_RE.findall(user):
+        episodes.append({
+            "speaker": "player",
+            "said": player_text.strip(),
+            "responding_to": None,
+            "player_felt": f"{rng.choice(EMOTIONS)} ({rng.uniform(0.1, 0.9):.2f})",
+            "i_felt_hearing": f"{rng.choice(EMOTIONS)} ({rng.uniform(0.1, 0.9):.2f})",
+            "intensity": round(rng.uniform(0.1, 0.8), 2),
+            "notes": "mock"
+        })
+        episodes.append({
+            "speaker": "npc",
+            "said": npc_text.strip(),
+            "responding_to": None,
+            "i_felt_speaking": f"{rng.choice(EMOTIONS)} ({rng.uniform(0.1, 0.9):.2f})",
+            "i_thought_player_felt": f"{rng.choice(EMOTIONS)} ({rng.uniform(0.1, 0.9):.2f})",
+            "intensity": round(rng.uniform(0.1, 0.8), 2),
+            "notes": "mock"
+        })
+
+    return {
+        "new_scene": None if has_scene else {
+            "tag": "mock_scene", "where": "here", "when": "now",
+            "how_we_got_here": "load test", "npc_lens": "neutral"
+        },
+        "beliefs_in_play": None,
+        "compress": None,
+        "episodes": episodes
+    }
+
+def _scene_rewrite(rng, user):
+    scene = _SCENE_RE.search(user)
+    current = scene.group(1).strip() if scene and "=== SCENE:" in scene.group(1) else None
+    return apply_patch(current, _scene_patch(rng, user))
+
+def _answer(stage: str, user: str, rng) -> str:
+    """
+    Content of a non-streaming call for `stage`.
+    """
+    answers = {
+        "kb_patch": lambda: json.dumps(_scene_patch(rng, user)),
+        "kb_rewrite": lambda: _scene_rewrite(rng, user),
+        "classify_player": lambda: json.dumps(_classify_player(rng)),
+        "persona_clues": lambda: json.dumps(_persona_clues(rng)),
+        "self_beliefs": lambda: json.dumps(_self_beliefs(rng)),
+        "npc_reaction": lambda: json.dumps(_npc_reaction(rng)),
+    }
+    return answers[stage]() if stage in answers else "{}"
+#------------------------------------------------------------------
+class _MockCompletions:
+    def create(self, model=None, messages=None, stream=False, stage=None, **kwargs):
+        messages = messages or []
+        system = next((m["content"] for m in messages if m["role"] == "system"), "")
+        user = messages[-1]["content"] if messages else ""
+        rng = random.Random(zlib.crc32((system[-2000:] + user).encode("utf-8")))
+
+        if stream:
+            _count("stream")
+            return self._stream(system + user, rng)
+
+        content = _answer(stage, user, rng)
+        _count(stage or "other")
+        _sleep_ms(MOCK_LLM_REASONER_MS if model == "deepseek-reasoner" else MOCK_LLM_JSON_MS, rng)
+        return SimpleNamespace(
+            model=model,
+            choices=[SimpleNamespace(
+                index=0,
+                finish_reason="stop",
+                message=SimpleNamespace(role="assistant", content=content)
+            )],
+            usage=_usage(system + user, max(1, len(content) // 4))
+        )
+
+    def _stream(self, prompt, rng):
+        words = [rng.choice(_WORDS) for _ in range(MOCK_LLM_RESPONSE_TOKENS)]
+        words[0] = words[0].capitalize()
+        # sentence ends every ~12 words so TTS batching kicks in
+        for i in range(11, len(words) - 1, 12):
+            words[i] += "."
+            words[i + 1] = words[i + 1].capitalize()
+        words[-1] = words[-1].rstrip(".") + "."
+
+        _sleep_ms(MOCK_LLM_TTFT_MS, rng)
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(1 / MOCK_LLM_TOKENS_PER_S)
+            token = word if i == 0 else " " + word
+            yield SimpleNamespace(
+                choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=token), finish_reason=None)],
+                usage=None
+            )
+        yield SimpleNamespace(choices=[], usage=_usage(prompt, len(words)))
+
+
+class MockLLMClient:
+    takes_stage = True      # telemetry.chat_completion passes stage=
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=_MockCompletions())
+
+mock_llm_client = MockLLMClient()
+#------------------------------------------------------------------
+# TTS: silent MPEG-1 Layer III frames (128 kbps, 44.1 kHz, mono
+# header, empty side info), about as long as the text would take
+# to speak, so players / decoders downstream accept them.
+#------------------------------------------------------------------
+MP3_FRAME = b"\xff\xfb\x90\xc4" + b"\x00" * 413      # 417 bytes, 26.1 ms
+MP3_FRAME_S = 1152 / 44100
+SPEECH_CHARS_PER_S = 14.0
+
+def synthetic_mp3(text: str) -> bytes:
+    seconds = max(0.3, len(text.strip()) / SPEECH_CHARS_PER_S)
+    return MP3_FRAME * int(seconds / MP3_FRAME_S)
+
+def mock_tts(text, voice_id, emotion):
+    rng = random.Random(zlib.crc32(f"{voice_id}|{emotion}|{text}".encode("utf-8")))
+    _count("tts")
+    _sleep_ms(MOCK_TTS_LATENCY_MS + MOCK_TTS_MS_PER_CHAR * len(text), rng)
+    yield synthetic_mp3(text)
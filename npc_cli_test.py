@@ -56,7 +56,7 @@ sio = socketio.Client()
 @sio.event
 def connect():
     print("\n🔌 Connected to socket server\n")
-    sio.emit("register_user", {"idUser": idUser})
+    sio.emit("register_user", {"idUser": idUser, "idNPC": idNPC})
 
 # ---- AUDIO (transport only)
 @sio.on("npc_audio_chunk")
@@ -87,9 +87,31 @@ def on_text_done(_data=None):
     print("\n")
 
 # ---- STATE
+npc_state = {"version": 0, "state": {}}
+
+def apply_state_delta(state, changed, removed):
+    for key, value in changed.items():
+        if isinstance(value, dict) and isinstance(state.get(key), dict):
+            apply_state_delta(state[key], value, [])
+        else:
+            state[key] = value
+    for path in removed:
+        target = state
+        for key in path[:-1]:
+            target = target.get(key, {})
+        target.pop(path[-1], None)
+
 @sio.on("npc_state_update")
 def on_npc_state(data):
-    pass
+    if data.get("mode") == "delta":
+        if data.get("baseVersion") != npc_state["version"]:
+            # missed an update, ask for a fresh snapshot
+            sio.emit("request_npc_state", {"idUser": idUser, "idNPC": idNPC})
+            return
+        apply_state_delta(npc_state["state"], data["changed"], data["removed"])
+    else:
+        npc_state["state"] = data
+    npc_state["version"] = data.get("version", 0)
    
 
 # ---- TURN CONTROL (speech START only)
@@ -111,7 +133,9 @@ def on_npc_speaking(data):
 # -----------------------------
 # connect socket
 # -----------------------------
-sio.connect(SERVER)
+# idUser in the query string: the launcher routes the socket to the
+# same worker as this user's /npc_interact
+sio.connect(f"{SERVER}?idUser={idUser}")
 
 # -----------------------------
 # main loop
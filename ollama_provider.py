@@ -0,0 +1,248 @@
+import json
+import os
+import time
+from collections import Counter
+from threading import Lock
+from types import SimpleNamespace
+import requests
+from structured_log import get_logger
+#------------------------------------------------------------------
+# Local serving through Ollama
+#
+#   LLM_PROVIDER=ollama        every stage runs locally
+#   LLM_LOCAL_STAGES=a,b       only these stages (e.g. the classifiers),
+#                              "all" = every stage
+#
+# OllamaClient mimics the parts of the OpenAI SDK the app uses, like
+# MockLLMClient, but talks to the native /api/chat endpoint: the
+# OpenAI-compatible /v1 endpoint drops keep_alive and the runner
+# options. Every request carries
+#
+#   keep_alive   OLLAMA_KEEP_ALIVE, the model stays loaded between turns
+#                instead of being unloaded after 5 minutes idle
+#   num_ctx      OLLAMA_NUM_CTX, the SAME for every stage -- a request
+#                with other runner options reloads the model and drops
+#                its KV cache
+#
+# The runner keeps the KV cache of each parallel slot and only
+# evaluates the part of a new prompt after the longest common prefix.
+# Prompts are ordered static -> npc -> player -> turn (prompt_assembly),
+# so from the second turn on the rules and the NPC's persona come out
+# of the cache. Start the server with OLLAMA_NUM_PARALLEL >= the number
+# of local stages so each stage keeps its own slot; OLLAMA_MAX_CONCURRENT
+# (the scheduler limit for this host) should match it.
+#
+# Ollama does not report cached tokens; prompt_eval_count / _duration
+# only cover what was evaluated. ollama_stats() (/metrics) sums them
+# per model, with model loads counted separately. bench_local.py
+# compares this against the hosted provider.
+#------------------------------------------------------------------
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://100.91.71.61:11434").rstrip("/")
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3.1:8b")
+OLLAMA_REASONER_MODEL = os.getenv("OLLAMA_REASONER_MODEL") or OLLAMA_MODEL
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "8192"))
+OLLAMA_NUM_THREAD = int(os.getenv("OLLAMA_NUM_THREAD", "0"))       # 0 = server default
+OLLAMA_MAX_CONCURRENT = int(os.getenv("OLLAMA_MAX_CONCURRENT", "4"))
+OLLAMA_TIMEOUT_S = float(os.getenv("OLLAMA_TIMEOUT_S", "300"))
+# room left in num_ctx for the answer; prompts are budgeted to the rest
+OLLAMA_RESERVE_TOKENS = int(os.getenv("OLLAMA_RESERVE_TOKENS", "1024"))
+
+LLM_LOCAL_STAGES = os.getenv("LLM_LOCAL_STAGES", "").strip().lower()
+
+# stages that run on deepseek-reasoner when hosted
+REASONER_STAGES = {"kb_rewrite", "kb_patch"}
+
+# token_budget stage -> the LLM stages its prompt goes to
+BUDGET_STAGES = {"kb_consolidation": ("kb_patch", "kb_rewrite")}
+
+_stats = {}         # model -> Counter
+_stats_lock = Lock()
+
+logger = get_logger("ollama")
+
+
+class OllamaError(RuntimeError):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code      # read by circuit_breaker
+#------------------------------------------------------------------
+def local_stage(stage: str) -> bool:
+    if os.getenv("LLM_PROVIDER", "deepseek").lower() == "ollama" or LLM_LOCAL_STAGES == "all":
+        return True
+    stages = {s.strip() for s in LLM_LOCAL_STAGES.split(",") if s.strip()}
+    return any(s in stages for s in BUDGET_STAGES.get(stage, (stage,)))
+
+def local_model(stage: str) -> str:
+    """
+    OLLAMA_MODEL_<STAGE>, else the reasoner / chat model.
+    """
+    override = os.getenv(f"OLLAMA_MODEL_{stage.upper()}")
+    if override:
+        return override
+    return OLLAMA_REASONER_MODEL if stage in REASONER_STAGES else OLLAMA_MODEL
+
+def local_context_budget() -> int:
+    return max(1024, OLLAMA_NUM_CTX - OLLAMA_RESERVE_TOKENS)
+
+def runner_options() -> dict:
+    """
+    Options that must not change between requests (model reload).
+    """
+    options = {"num_ctx": OLLAMA_NUM_CTX}
+    if OLLAMA_NUM_THREAD:
+        options["num_thread"] = OLLAMA_NUM_THREAD
+    return options
+
+def _record(model: str, data: dict):
+    load_ms = data.get("load_duration", 0) / 1e6
+    with _stats_lock:
+        c = _stats.setdefault(model, Counter())
+        c["calls"] += 1
+        c["prompt_eval_tokens"] += data.get("prompt_eval_count", 0)
+        c["prompt_eval_ms"] += data.get("prompt_eval_duration", 0) / 1e6
+        c["eval_tokens"] += data.get("eval_count", 0)
+        c["eval_ms"] += data.get("eval_duration", 0) / 1e6
+        # a warm model answers with a load_duration of a few ms
+        if load_ms > 500:
+            c["loads"] += 1
+            c["load_ms"] += load_ms
+
+def ollama_stats() -> dict:
+    with _stats_lock:
+        out = {}
+        for model, c in _stats.items():
+            out[model] = {
+                "calls": c["calls"],
+                "loads": c["loads"],
+                "load_ms": round(c["load_ms"]),
+                "prompt_eval_tokens": c["prompt_eval_tokens"],
+                "eval_tokens": c["eval_tokens"],
+                "prompt_tokens_per_s": round(1000 * c["prompt_eval_tokens"] / c["prompt_eval_ms"], 1)
+                                       if c["prompt_eval_ms"] else 0.0,
+                "eval_tokens_per_s": round(1000 * c["eval_tokens"] / c["eval_ms"], 1) if c["eval_ms"] else 0.0,
+            }
+        return out
+
+def _usage(data: dict):
+    prompt_tokens = data.get("prompt_eval_count", 0)
+    completion_tokens = data.get("eval_count", 0)
+    return SimpleNamespace(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+        prompt_eval_ms=round(data.get("prompt_eval_duration", 0) / 1e6, 1),
+        load_ms=round(data.get("load_duration", 0) / 1e6, 1)
+    )
+#------------------------------------------------------------------
+class _OllamaCompletions:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, model=None, messages=None, stream=False, temperature=None, top_p=None,
+               max_tokens=None, response_format=None, timeout=None, **kwargs):
+        # stream_options: the final chunk always carries usage
+        options = runner_options()
+        if temperature is not None:
+            options["temperature"] = temperature
+        if top_p is not None:
+            options["top_p"] = top_p
+        if max_tokens is not None:
+            options["num_predict"] = max_tokens
+
+        body = {
+            "model": model,
+            "messages": [{"role": m["role"], "content": m.get("content") or ""} for m in messages or []],
+            "stream": bool(stream),
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+            "options": options,
+        }
+        if response_format and response_format.get("type") == "json_object":
+            body["format"] = "json"
+
+        resp = self.client.post("/api/chat", body, stream=bool(stream), timeout=timeout)
+        if stream:
+            return self._stream(model, resp)
+
+        try:
+            data = resp.json()
+        finally:
+            resp.close()
+        _record(model, data)
+        return SimpleNamespace(
+            model=model,
+            choices=[SimpleNamespace(
+                index=0,
+                finish_reason=data.get("done_reason", "stop"),
+                message=SimpleNamespace(role="assistant", content=data.get("message", {}).get("content", ""))
+            )],
+            usage=_usage(data)
+        )
+
+    def _stream(self, model, resp):
+        try:
+            for line in resp.iter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                if data.get("error"):
+                    raise OllamaError(data["error"])
+                content = data.get("message", {}).get("content")
+                if content:
+                    yield SimpleNamespace(
+                        choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=content), finish_reason=None)],
+                        usage=None
+                    )
+                if data.get("done"):
+                    _record(model, data)
+                    yield SimpleNamespace(choices=[], usage=_usage(data))
+                    return
+        finally:
+            resp.close()
+
+
+class OllamaClient:
+    def __init__(self, base_url: str = OLLAMA_BASE_URL):
+        self.base_url = base_url           # circuit_breaker.provider_name
+        self.scheduler_limits = {"max_concurrent": OLLAMA_MAX_CONCURRENT}
+        self.session = requests.Session()
+        self.chat = SimpleNamespace(completions=_OllamaCompletions(self))
+
+    def post(self, path: str, body: dict, stream: bool = False, timeout: float | None = None):
+        try:
+            resp = self.session.post(
+                self.base_url + path, json=body, stream=stream,
+                timeout=timeout if timeout is not None else OLLAMA_TIMEOUT_S
+            )
+        except requests.RequestException as e:
+            raise OllamaError(f"{type(e).__name__}: {e}") from e
+        if resp.status_code >= 400:
+            try:
+                message = resp.json().get("error", resp.text)
+            except ValueError:
+                message = resp.text
+            resp.close()
+            raise OllamaError(f"ollama {resp.status_code}: {message}", status_code=resp.status_code)
+        return resp
+
+    def warm_up(self, models) -> dict:
+        """
+        Loads each model with keep_alive (a chat request with no
+        messages). Returns model -> load ms, None when it failed.
+        """
+        out = {}
+        for model in models:
+            started = time.perf_counter()
+            try:
+                self.post("/api/chat", {
+                    "model": model, "messages": [], "keep_alive": OLLAMA_KEEP_ALIVE,
+                    "options": runner_options()
+                }).close()
+                out[model] = round((time.perf_counter() - started) * 1000)
+                logger.info("model loaded", model=model, ms=out[model], keep_alive=OLLAMA_KEEP_ALIVE)
+            except OllamaError as e:
+                out[model] = None
+                logger.warning("model warm-up failed", model=model, error=str(e))
+        return out
+
+ollama_client = OllamaClient()
@@ -1,4 +1,4 @@
-from openai import OpenAI
+from openai import OpenAI, APIError
 from flask import request, jsonify
 import json
 import ast
@@ -7,14 +7,28 @@ import os
 import mysql.connector
 from datetime import datetime, timezone
 import phase_2_queries
+import prompt_assembly
+from token_budget import fit_to_budget, text_section, items_section
+from belief_index import canonicalize, belief_index, relevant_beliefs
+from scene_document import parse_scene, apply_patch, compress_scene
+from mock_provider import mock_llm_client
+from ollama_provider import ollama_client, local_stage, local_model, REASONER_STAGES, OllamaError
+from llm_scheduler import STAGE_PRIORITY, QueueTimeout
+from telemetry import chat_completion, instrument_connection
+from structured_log import get_logger
+from structured_output import parse_model_json, json_mode
+from hedged_requests import hedged_completion, DeadlineExceeded
+from circuit_breaker import CircuitOpen
 import re
 
+logger = get_logger("llm")
+
+# said when no LLM provider can answer (breakers open / errors)
+CANNED_RESPONSE = os.getenv("LLM_CANNED_RESPONSE", "Hm... sorry, give me a moment. I lost my train of thought.")
 
 def get_ollama_client():
-    return OpenAI(
-        base_url="http://100.91.71.61:11434/v1",
-        api_key="ollama"  # dummy value required by SDK
-    )
+    # native /api/chat (keep_alive, runner options), see ollama_provider.py
+    return ollama_client
 
 def get_deepseek_client():
     return OpenAI(
@@ -28,65 +42,237 @@ def get_xai_client():
         base_url="https://api.x.ai/v1"
     )
 
+def get_llm_client(provider: str | None = None):
+    # LLM_PROVIDER: "deepseek" | "xai" | "ollama" (local) | "mock" (offline load testing, see mock_provider.py)
+    provider = (provider or os.getenv("LLM_PROVIDER", "deepseek")).lower()
+    if provider == "mock":
+        return mock_llm_client
+    if provider == "ollama":
+        return get_ollama_client()
+    if provider == "xai":
+        return get_xai_client()
+    return get_deepseek_client()
+
+def get_hedge_client():
+    # LLM_HEDGE_PROVIDER: where hedged classifier requests go (default: LLM_PROVIDER)
+    return get_llm_client(os.getenv("LLM_HEDGE_PROVIDER") or None)
+
+def stage_target(stage: str):
+    """
+    (client, model) for a stage: the local Ollama model when the stage
+    is served locally (LLM_PROVIDER=ollama / LLM_LOCAL_STAGES), else
+    LLM_PROVIDER with deepseek-chat / deepseek-reasoner.
+    """
+    if local_stage(stage):
+        return get_ollama_client(), local_model(stage)
+    return get_llm_client(), "deepseek-reasoner" if stage in REASONER_STAGES else "deepseek-chat"
+
+def warm_local_models() -> dict:
+    """
+    Loads the local models of every locally served stage, so the first
+    turn doesn't pay the model load.
+    """
+    models = {local_model(stage) for stage in STAGE_PRIORITY if local_stage(stage)}
+    return get_ollama_client().warm_up(sorted(models)) if models else {}
+
+def classifier_completion(client, stage: str, **kwargs):
+    """
+    chat_completion under the stage deadline, hedged (see
+    hedged_requests.py). None once the deadline passes, the provider's
+    breaker is open or every request failed with a provider error, so
+    the caller's fallback is used. Hedges go to LLM_HEDGE_PROVIDER if
+    set, else to `client`.
+    """
+    try:
+        return hedged_completion(
+            client, stage,
+            hedge_client=get_hedge_client if os.getenv("LLM_HEDGE_PROVIDER") else client,
+            hedge_model=os.getenv("LLM_HEDGE_MODEL") or None,
+            **kwargs
+        )
+    except (DeadlineExceeded, CircuitOpen):
+        return None
+    except (APIError, OllamaError, QueueTimeout) as e:
+        logger.warning("classifier failed, using fallback", stage=stage, error=f"{type(e).__name__}: {e}")
+        return None
+
 #------------------------------------------------------------------
 def connect()->object:
-    return mysql.connector.connect(
+    return instrument_connection(mysql.connector.connect(
         user=os.getenv('DB_USER'), 
         password=os.getenv('DB_PASSWORD'), 
         database=os.getenv('DB_NAME'),
-        host=os.getenv('DB_HOST', 'localhost') )
+        host=os.getenv('DB_HOST', 'localhost') ))
 #------------------------------------------------------------------
-def getResponseStream(prompt, current_scene, player_name, client):
-    client = get_deepseek_client()
-    try:
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            temperature=0.85,
-            top_p=0.9,
-            stream=True, 
-            messages=[
-                {
-                    "role": "system",
-                    "content": prompt
-                },
-                {
-                    "role": "user",
-                    "content": f"""
-                        CURRENT SCENE FOR REFERENCE ONLY
-                        -------------
-                        {current_scene}
-
-                        PLAYER NAME
-                        -----------
-                        {player_name}
-                        """
-                }
-            ],
-        )
+def response_targets():
+    """
+    (client, model) to try in order for the NPC response. A second
+    entry only when LLM_FALLBACK_MODEL is set (LLM_FALLBACK_PROVIDER
+    defaults to LLM_PROVIDER), e.g. the hosted model behind a local one.
+    """
+    targets = [stage_target("npc_response")]
+    fallback_model = os.getenv("LLM_FALLBACK_MODEL")
+    if fallback_model:
+        targets.append((get_llm_client(os.getenv("LLM_FALLBACK_PROVIDER") or None), fallback_model))
+    return targets
+
+def getResponseStream(prompt, current_scene, player_name, client, prefix_tokens=0):
+    messages = [
+        {
+            "role": "system",
+            "content": prompt
+        },
+        {
+            "role": "user",
+            "content": f"""
+                CURRENT SCENE FOR REFERENCE ONLY
+                -------------
+                {current_scene}
+
+                PLAYER NAME
+                -----------
+                {player_name}
+                """
+        }
+    ]
 
-        full = []
+    full = []
+    for client, model in response_targets():
+        try:
+            response = chat_completion(
+                client, "npc_response",
+                model=model,
+                temperature=0.85,
+                top_p=0.9,
+                stream=True, 
+                # final chunk carries usage incl. prefix-cache hit/miss tokens
+                stream_options={"include_usage": True},
+                messages=messages,
+            )
 
-        for chunk in response:
-            delta = chunk.choices[0].delta
+            for chunk in response:
+                if getattr(chunk, "usage", None):
+                    stats = prompt_assembly.record_cache_usage(chunk.usage, prefix_tokens)
+                    logger.debug(
+                        "prompt cache",
+                        hit=getattr(chunk.usage, "prompt_cache_hit_tokens", None),
+                        prefix_est=prefix_tokens, hit_rate=stats["cache_hit_rate"]
+                    )
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+
+                if delta and delta.content:
+                    token = delta.content
+                    full.append(token)
+                    yield token
+            return "".join(full)
+
+        except CircuitOpen as e:
+            logger.warning("npc response skipped, breaker open", breaker=str(e))
+        except Exception as e:
+            logger.exception("npc response stream failed", model=model, error=str(e))
+
+        # the player already saw part of this answer: don't start another
+        if full:
+            return "".join(full)
+
+    # every provider is down or open: stay in character
+    token = CANNED_RESPONSE
+    yield token
+    return token
+#------------------------------------------------------------------
+def belief_items(rows, with_stability=False):
+    """
+    Belief rows -> (confidence, "- type: value (confidence x)") items
+    for token_budget.items_section.
+    """
+    items = []
+    for b in rows:
+        line = f"- {b['beliefType']}: {b['beliefValue']} (confidence {round(b['confidence'],2)}"
+        if with_stability:
+            line += f", stability {round(b['stability'],2)}"
+        items.append((float(b["confidence"]), line + ")"))
+    return items
+
+def titled_block(title, body):
+    return f"\n{title}\n{body}\n" if body else ""
+
+def classifier_system(stage: str, sections: list[dict]) -> str:
+    """
+    Classifier system prompts are assembled like build_prompt's: the
+    stage's fixed instructions first, then the NPC's persona (cached,
+    byte-identical across turns), then trust / beliefs / dialogue. A
+    provider or local Ollama slot reuses everything up to the first
+    per-turn line.
+    """
+    system, report = prompt_assembly.assemble_prompt(sections)
+    logger.debug(prompt_assembly.format_prompt_report(report), stage=stage)
+    return system
+
+def render_classifier_persona(persona: dict) -> str:
+    return prompt_assembly.block("""
+        NPC Role: {role}
+        Personality: {personality_traits}
+        Emotional tendencies: {emotional_tendencies}
+        Moral alignment: {moral_alignment}
+    """, role=persona.get("role"), personality_traits=persona.get("personality_traits"),
+         emotional_tendencies=persona.get("emotional_tendencies"),
+         moral_alignment=persona.get("moral_alignment"))
+
+def render_npc_profile(npc: dict) -> str:
+    return prompt_assembly.block("""
+        NPC PROFILE
+        -----------
+        Age: {age}
+        Gender: {gender}
+        Role: {role}
+        Personality traits: {personality_traits}
+        Emotional tendencies: {emotional_tendencies}
+        Moral alignment: {moral_alignment}
+    """, **{k: npc.get(k) for k in (
+        "age", "gender", "role", "personality_traits", "emotional_tendencies", "moral_alignment"
+    )})
+#------------------------------------------------------------------
+CLASSIFY_PLAYER_RULES = """
+    You are classifying player dialogue from the perspective of THIS NPC.
 
-            if delta and delta.content:
-                token = delta.content
-                full.append(token)
-                yield token
-        return "".join(full)
+    Interpretation Rules:
+    - Interpret tone as THIS NPC would perceive it.
+    - High trust → more generous interpretation.
+    - Low trust → more suspicious interpretation.
+    - Personality biases perception.
+    - Existing beliefs influence emotional reading.
 
-    except Exception as e:
-        print("ERROR:", e)
+    Determine whether the emotional tone is directed at:
+    - the NPC
+    - the player themself
+    - the environment/situation
+    - or no one in particular
+
+    Classify with EXACTLY these fields:
+
+    - sentiment: one of [positive, neutral, negative, hostile, affectionate]
+    - intensity: number from 0.0 to 1.0
+    - offensive: true or false
+    - emotion: one of [happy, sad, angry, afraid, calm, excited, disgusted]
+    - target: one of [npc, self, environment, none]
+
+    Return ONLY valid JSON.
+    Do not explain.
+    Follow schema exactly.
+    If no emotion clearly fits, use 'calm'.
+    Do NOT invent new labels.
+    """
 #------------------------------------------------------------------
 def classify_player_input(player_text: str, raw_mem: str, client, idNPC: int, idUser: int):
-    client = get_deepseek_client()
-
-    print(f"\nCLASSIFIER INPUT: {player_text}\n")
+    logger.payload("request", "classifier input", player_text, idNPC=idNPC, idUser=idUser)
 
     # -----------------------------------
     # Build memory context
     # -----------------------------------
-    mem_context = get_most_recent_scene(raw_mem)
+    _, mem_scene, mem_loose = get_most_recent_scene(raw_mem)
+    mem_context = mem_scene or mem_loose or ""
     db = connect()
     cursor = db.cursor(dictionary=True)
     # -----------------------------------
@@ -111,7 +297,6 @@ def classify_player_input(player_text: str, raw_mem: str, client, idNPC: int, id
         if r.get("npcText"):
             recent_dialogue_lines.append(f"You: {r['npcText']}")
 
-    recent_dialogue = "\n".join(recent_dialogue_lines)
     # -----------------------------------
     # Fetch NPC persona + beliefs
     # -----------------------------------
@@ -143,14 +328,6 @@ def classify_player_input(player_text: str, raw_mem: str, client, idNPC: int, id
 
     beliefs = cursor.fetchall()
 
-    # Format beliefs
-    belief_text = ""
-    if beliefs:
-        belief_text += "\nCurrent beliefs about the player:\n"
-        for b in beliefs:
-            belief_text += f"- {b['beliefType']}: {b['beliefValue']} (confidence {round(b['confidence'],2)})\n"
-
-
     # -----------------------------------
     # SELF BELIEFS (NPC about itself)
     # -----------------------------------
@@ -164,49 +341,57 @@ def classify_player_input(player_text: str, raw_mem: str, client, idNPC: int, id
 
     self_beliefs = cursor.fetchall()
 
-    self_belief_text = ""
-    if self_beliefs:
-        self_belief_text += "\nCore beliefs about self:\n"
-        for b in self_beliefs:
-            self_belief_text += (
-                f"- {b['beliefType']}: "
-                f"{b['beliefValue']} "
-                f"(confidence {round(b['confidence'],2)})\n"
-        )
-            
     cursor.close()
     db.close()
 
+    # only the beliefs that bear on this turn
+    beliefs = relevant_beliefs(beliefs, player_text)
+    self_beliefs = relevant_beliefs(self_beliefs, player_text)
+
     # -----------------------------------
-    # SYSTEM MESSAGE
+    # Token budget: weakest beliefs, then older scene lines,
+    # then oldest dialogue lines are cut first
     # -----------------------------------
-    system = f"""
-    You are classifying player dialogue from the perspective of THIS NPC.
-
-    NPC Role: {persona.get('role') if persona else None}
-    Personality: {persona.get('personality_traits') if persona else None}
-    Emotional tendencies: {persona.get('emotional_tendencies') if persona else None}
-    Moral alignment: {persona.get('moral_alignment') if persona else None}
-    Trust toward player: {trust}
+    budgeted, _ = fit_to_budget("classify_player", [
+        text_section("player_text", player_text),
+        text_section("scene", mem_context, priority=0),
+        items_section("player_beliefs", belief_items(beliefs), priority=1),
+        items_section("self_beliefs", belief_items(self_beliefs), priority=2),
+        items_section(
+            "recent_dialogue",
+            list(enumerate(recent_dialogue_lines)),
+            priority=3,
+            min_items=2
+        ),
+    ])
+
+    belief_text = titled_block("Current beliefs about the player:", budgeted["player_beliefs"])
+    self_belief_text = titled_block("Core beliefs about self:", budgeted["self_beliefs"])
+    mem_context = budgeted["scene"]
+    recent_dialogue = budgeted["recent_dialogue"]
 
-    Interpretation Rules:
-    - Interpret tone as THIS NPC would perceive it.
-    - High trust → more generous interpretation.
-    - Low trust → more suspicious interpretation.
-    - Personality biases perception.
-    - Existing beliefs influence emotional reading.
-    {belief_text}
-    {self_belief_text}
+    # -----------------------------------
+    # SYSTEM MESSAGE (static -> npc -> turn)
+    # -----------------------------------
+    persona_text = prompt_assembly.cached_npc_section(
+        "classifier_persona", idNPC, persona or {}, render_classifier_persona
+    )
 
-    Return ONLY valid JSON.
-    Do not explain.
-    Follow schema exactly.
-    If no emotion clearly fits, use 'calm'.
-    Do NOT invent new labels.
-    """
+    system = classifier_system("classify_player", [
+        prompt_assembly.section("rules", "static", CLASSIFY_PLAYER_RULES),
+        prompt_assembly.section("persona", "npc", persona_text),
+        prompt_assembly.section("state", "turn", prompt_assembly.block("""
+            Trust toward player: {trust}
+            {belief_text}
+            {self_belief_text}
 
+            Recent interaction summary:
+            {mem_context}
 
-    system += f"\nRecent interaction summary:\n{mem_context}\n\n{recent_dialogue}\n"
+            {recent_dialogue}
+        """, trust=trust, belief_text=belief_text, self_belief_text=self_belief_text,
+             mem_context=mem_context, recent_dialogue=recent_dialogue)),
+    ])
 
     # -----------------------------------
     # USER MESSAGE
@@ -215,36 +400,23 @@ def classify_player_input(player_text: str, raw_mem: str, client, idNPC: int, id
     Player text:
     \"\"\"{player_text}\"\"\"
 
-    IMPORTANT:
-
-    Determine whether the emotional tone is directed at:
-    - the NPC
-    - the player themself
-    - the environment/situation
-    - or no one in particular
-
-    Classify with EXACTLY these fields:
-
-    - sentiment: one of [positive, neutral, negative, hostile, affectionate]
-    - intensity: number from 0.0 to 1.0
-    - offensive: true or false
-    - emotion: one of [happy, sad, angry, afraid, calm, excited, disgusted]
-    - target: one of [npc, self, environment, none]
-
     Return JSON ONLY.
     """
 
-    resp = client.chat.completions.create(
-        model="deepseek-chat",
+    client, model = stage_target("classify_player")
+    resp = classifier_completion(
+        client, "classify_player",
+        model=model,
         messages=[
             {"role": "system", "content": system},
             {"role": "user", "content": user},
         ],
         temperature=0.0,
+        **json_mode("classify_player", model),
     )
 
-    result = _safe_json_from_model(
-        resp,
+    result = parse_model_json(
+        resp, "classify_player",
         fallback={
             "sentiment": "neutral",
             "intensity": 0.3,
@@ -295,15 +467,97 @@ def classify_player_input(player_text: str, raw_mem: str, client, idNPC: int, id
     record_classification_stats(idUser, idNPC, player_text, result)
 
 
-    print(f"\nPLAYER INPUT CLASSIFIED:\n\{result}n")
+    logger.info("player input classified", idNPC=idNPC, idUser=idUser, result=result)
 
     return result
 #------------------------------------------------------------------
-def extract_persona_clues(player_text: str, recent_context: dict, client, idNPC, idUser):
-    client = get_deepseek_client()
+PERSONA_CLUES_RULES = """
+    You are simulating how THIS NPC forms beliefs about a player.
+
+    Belief Revision Rules:
+    ----------------------
+    - Treat the current beliefs below as your existing working model.
+    - New evidence may reinforce, weaken, or contradict them.
+    - Do not discard specific high-confidence beliefs without strong evidence.
+    - Prefer updating confidence over replacing specific facts with vague descriptions.
+    - If new information is ambiguous, you may return null for that field.
+
+    Inference Constraints:
+    - Beliefs must reflect this NPC's maturity level.
+    - A young child cannot infer complex adult psychology.
+    - Personality biases interpretation.
+    - High trust → generous interpretations.
+    - Low trust → suspicious interpretations.
+    - Current emotion influences interpretation.
+    - Do NOT reason as an omniscient narrator.
 
-    system = ""
+    Return JSON with EXACTLY these fields:
 
+    {
+        "current_emotion": { "value": string, "confidence": float } or null,
+        "moral_alignment": { "value": string, "confidence": float } or null,
+        "age": { "value": string, "confidence": float } or null,
+        "gender": { "value": string, "confidence": float } or null,
+        "life_story": { "value": string, "confidence": float } or null,
+
+        "personality_traits": [
+            { "value": string, "confidence": float }
+        ],
+
+        "secrets": [
+            { "value": string, "confidence": float }
+        ],
+
+        "goals": [
+            { "value": string, "confidence": float }
+        ],
+
+        "likes": [
+            { "value": string, "confidence": float }
+        ],
+
+        "dislikes": [
+            { "value": string, "confidence": float }
+        ]
+    }
+
+    Confidence Rules:
+    - Confidence must be between 0.0 and 1.0.
+    - 0.9+ = explicit or strongly supported.
+    - 0.6–0.8 = strongly implied.
+    - 0.3–0.5 = weak inference.
+    - Below 0.3 = do not include.
+    - Never output random confidence.
+    - If uncertain, return null instead.
+    - No extra keys.
+
+    Inference Guidelines:
+
+    - All fields may be inferred from tone, behavior, word choice, patterns, or contradictions.
+    - Explicit claims should not automatically override behavioral evidence.
+    - If a player claims one emotion but language strongly suggests another,
+        choose the more strongly supported belief.
+    - Age may be infered from style of speech, life_story, likes and dislikes, or statements made by player direclty about age.
+    - Gender may be inferred from any relevant contextual evidence.
+    - personality_traits should reflect enduring patterns.
+    - goals may be inferred from expressed desires or recurring motivations.
+    - secrets may be inferred if the player implies concealment or avoidance.
+    - life_story may be inferred if background context is strongly suggested.
+    - likes should reflect activities, topics, or experiences the player shows enthusiasm toward.
+    - dislikes should reflect aversions, discomfort, or negative recurring themes.
+    - Do not infer likes/dislikes from a single neutral statement.
+    - Preferences should feel semi-stable, not momentary.
+    - beliefValue must represent a SINGLE normalized trait or fact.
+    - Do NOT include explanations or compound sentences.
+    - Do NOT restate background context.
+    - Avoid semantic duplicates of existing beliefs.
+    - If a belief already exists in similar form, reinforce it instead of rephrasing it.
+    - Prefer short canonical labels (e.g., figure_drawing_model, teacher_at_st_marcus).
+    - Do NOT guess randomly.
+    - No extra keys.
+    """
+
+def extract_persona_clues(player_text: str, recent_context: dict, client, idNPC, idUser):
     db = connect()
     cursor = db.cursor(dictionary=True)
 
@@ -362,164 +616,72 @@ def extract_persona_clues(player_text: str, recent_context: dict, client, idNPC,
 
     self_beliefs = cursor.fetchall()
 
-    if self_beliefs:
-        system += "\nCore beliefs about self:\n"
-        for row in self_beliefs:
-            system += (
-                f"- {row['beliefType']}: "
-                f"{row['beliefValue']} "
-                f"(confidence {round(row['confidence'],2)})\n"
-            )
-
-    belief_summary = {}
-    for row in existing_beliefs:
-        belief_summary.setdefault(row["beliefType"], [])
-        belief_summary[row["beliefType"]].append(
-            f"{row['beliefValue']} (confidence {round(row['confidence'],2)})"
-        )
-
-    if belief_summary:
-        system += "\nCurrent beliefs about the player:\n"
-        for btype, values in belief_summary.items():
-            system += f"{btype}:\n"
-            for v in values:
-                system += f"- {v}\n"
-
     cursor.close()
     db.close()
 
-    system += """
+    _, current_scene, _ = get_most_recent_scene(recent_context or "")
 
-        Belief Revision Rules:
-        ----------------------
-        - Treat the current beliefs above as your existing working model.
-        - New evidence may reinforce, weaken, or contradict them.
-        - Do not discard specific high-confidence beliefs without strong evidence.
-        - Prefer updating confidence over replacing specific facts with vague descriptions.
-        - If new information is ambiguous, you may return null for that field.
-        """
-
-    system += f"""
-
-        You are simulating how THIS NPC forms beliefs about a player.
+    # -----------------------------------
+    # Token budget: weakest beliefs first, then older scene lines
+    # -----------------------------------
+    existing_beliefs = sorted(
+        relevant_beliefs(existing_beliefs, player_text),
+        key=lambda b: b["beliefType"]
+    )
+    self_beliefs = relevant_beliefs(self_beliefs, player_text)
 
-        NPC PROFILE
-        -----------
-        Age: {npc['age']}
-        Gender: {npc['gender']}
-        Role: {npc['role']}
-        Personality traits: {npc['personality_traits']}
-        Emotional tendencies: {npc['emotional_tendencies']}
-        Moral alignment: {npc['moral_alignment']}
-        Current dominant emotion: {npc_emotion}
-        Trust toward player: {trust}
-
-        Inference Constraints:
-        - Beliefs must reflect this NPC's maturity level.
-        - A young child cannot infer complex adult psychology.
-        - Personality biases interpretation.
-        - High trust → generous interpretations.
-        - Low trust → suspicious interpretations.
-        - Current emotion influences interpretation.
-        - Do NOT reason as an omniscient narrator.
-
-        Return ONLY valid JSON.
-        
-        """
+    budgeted, _ = fit_to_budget("persona_clues", [
+        text_section("player_text", player_text),
+        text_section("scene", current_scene or "", priority=0),
+        items_section("self_beliefs", belief_items(self_beliefs), priority=1),
+        items_section("player_beliefs", belief_items(existing_beliefs), priority=2),
+    ])
 
-    past_memory, current_scene, _ = get_most_recent_scene(recent_context or "")
+    player_belief_text = titled_block("Current beliefs about the player:", budgeted["player_beliefs"])
+    self_belief_text = titled_block("Core beliefs about self:", budgeted["self_beliefs"])
+    current_scene = budgeted["scene"]
 
-   
-    system += (
-        "\nRecent interaction summary (may provide behavioral patterns):\n"
-        f"{current_scene}\n"
-    )
+    # -----------------------------------
+    # SYSTEM MESSAGE (static -> npc -> turn)
+    # -----------------------------------
+    system = classifier_system("persona_clues", [
+        prompt_assembly.section("rules", "static", PERSONA_CLUES_RULES),
+        prompt_assembly.section("profile", "npc", prompt_assembly.cached_npc_section(
+            "profile", idNPC, npc, render_npc_profile
+        )),
+        prompt_assembly.section("state", "turn", prompt_assembly.block("""
+            Current dominant emotion: {npc_emotion}
+            Trust toward player: {trust}
+            {self_belief_text}
+            {player_belief_text}
+
+            Recent interaction summary (may provide behavioral patterns):
+            {current_scene}
+        """, npc_emotion=npc_emotion, trust=trust, self_belief_text=self_belief_text,
+             player_belief_text=player_belief_text, current_scene=current_scene)),
+    ])
 
     user = f"""
     Player text:
     \"\"\"{player_text}\"\"\"
 
-    Form beliefs about the player.
-
-    Return JSON with EXACTLY these fields:
-
-    {{
-        "current_emotion": {{ "value": string, "confidence": float }} or null,
-        "moral_alignment": {{ "value": string, "confidence": float }} or null,
-        "age": {{ "value": string, "confidence": float }} or null,
-        "gender": {{ "value": string, "confidence": float }} or null,
-        "life_story": {{ "value": string, "confidence": float }} or null,
-
-        "personality_traits": [
-            {{ "value": string, "confidence": float }}
-        ],
-
-        "secrets": [
-            {{ "value": string, "confidence": float }}
-        ],
-
-        "goals": [
-            {{ "value": string, "confidence": float }}
-        ],
-
-        "likes": [
-            {{ "value": string, "confidence": float }}
-        ],
-
-        "dislikes": [
-            {{ "value": string, "confidence": float }}
-        ]
-    }}
-
-    Confidence Rules:
-    - Confidence must be between 0.0 and 1.0.
-    - 0.9+ = explicit or strongly supported.
-    - 0.6–0.8 = strongly implied.
-    - 0.3–0.5 = weak inference.
-    - Below 0.3 = do not include.
-    - Never output random confidence.
-    - If uncertain, return null instead.
-    - No extra keys.
-
-
-    Inference Guidelines:
-
-    - All fields may be inferred from tone, behavior, word choice, patterns, or contradictions.
-    - Explicit claims should not automatically override behavioral evidence.
-    - If a player claims one emotion but language strongly suggests another,
-        choose the more strongly supported belief.
-    - Age may be infered from style of speech, life_story, likes and dislikes, or statements made by player direclty about age.
-     -Gender may be inferred from any relevant contextual evidence.
-    - personality_traits should reflect enduring patterns.
-    - goals may be inferred from expressed desires or recurring motivations.
-    - secrets may be inferred if the player implies concealment or avoidance.
-    - life_story may be inferred if background context is strongly suggested.
-    - likes should reflect activities, topics, or experiences the player shows enthusiasm toward.
-    - dislikes should reflect aversions, discomfort, or negative recurring themes.
-    - Do not infer likes/dislikes from a single neutral statement.
-    - Preferences should feel semi-stable, not momentary.
-    - beliefValue must represent a SINGLE normalized trait or fact.
-    - Do NOT include explanations or compound sentences.
-    - Do NOT restate background context.
-    - Avoid semantic duplicates of existing beliefs.
-    - If a belief already exists in similar form, reinforce it instead of rephrasing it.
-    - Prefer short canonical labels (e.g., figure_drawing_model, teacher_at_st_marcus).
-    - Do NOT guess randomly.
-    - No extra keys.
-    
+    Form beliefs about the player. Return ONLY valid JSON.
     """
 
-    resp = client.chat.completions.create(
-        model="deepseek-chat",
+    client, model = stage_target("persona_clues")
+    resp = classifier_completion(
+        client, "persona_clues",
+        model=model,
         messages=[
             {"role": "system", "content": system},
             {"role": "user", "content": user},
         ],
         temperature=0.0,
+        **json_mode("persona_clues", model),
     )
 
-    result = _safe_json_from_model(
-    resp,
+    result = parse_model_json(
+    resp, "persona_clues",
     fallback={
         "current_emotion": None,
         "moral_alignment": None,
@@ -560,36 +722,123 @@ def extract_persona_clues(player_text: str, recent_context: dict, client, idNPC,
     for key in expected_lists:
         result[key] = normalize_list_field(result.get(key))
 
-    seen = set()
-    deduped = []
+    for key in expected_lists:
+        seen = set()
+        deduped = []
 
-    for belief in result["personality_traits"]:
-        canon = canonicalize(belief["value"])
-        if canon not in seen:
-            belief["value"] = canon
-            deduped.append(belief)
-            seen.add(canon)
+        for belief in result[key]:
+            canon = canonicalize(belief["value"], key)
+            if canon and canon not in seen:
+                belief["value"] = canon
+                deduped.append(belief)
+                seen.add(canon)
 
-    result["personality_traits"] = deduped
+        result[key] = deduped
 
     return result
 
 #------------------------------------------------------------------
-def canonicalize(value: str) -> str:
-    return (
-        value.lower()
-        .replace("has experience being a ", "")
-        .replace("has experience as a ", "")
-        .replace("is comfortable with ", "")
-        .replace("likely has ", "")
-        .replace("has lived in this town their whole life", "local_resident")
-        .strip()
-    )
+SELF_BELIEF_RULES = """
+    You are simulating how THIS NPC forms beliefs about itself.
+
+    The NPC may form or revise beliefs in the following domains ONLY:
+
+    - age
+    - gender
+    - race
+    - physical_appearance
+    - identity
+    - role
+    - life_history
+    - likes
+    - dislikes
+    - moral_alignment
+    - personality_trait
+    - goal
+    - fear
+    - worldview
+    - current_environment
+    - environment_social
+    - environment_physical
+    - current_state
+    - physical_condition
+
+    Do NOT invent other belief types.
+
+    Belief Revision Rules:
+    ----------------------
+    - Only revise domains clearly supported by the NPC's own words.
+    - Do not output beliefs for domains not referenced or implied.
+    - High confidence (0.9+) requires explicit self-reference.
+    - Stability should be HIGH (0.8+) when reinforcing core identity domains.
+    - Stability should be LOW (0.2–0.5) for temporary states, doubts, or situational conditions.
+    - If a core identity trait is being questioned, stability may decrease but should not collapse without explicit self-contradiction.
+    - Do NOT hallucinate major backstory.
+    - Do NOT act as an omniscient narrator.
+    - Return ONLY valid JSON.
+    - Age, gender, and race are immutable unless explicitly corrected by the NPC.
+    - Do not weaken or contradict immutable traits without explicit self-correction.
+
+    - environment_physical = physical setting (location, weather, room, city).
+    - environment_social = people present, group dynamics, social hierarchy.
+    - current_environment = general situational state if unclear.
+
+    Core Identity Domains:
+    ----------------------
+    The following belief types are considered CORE identity traits:
+
+    - age
+    - gender
+    - race
+    - identity
+    - role
+    - moral_alignment
+    - personality_trait
+    - worldview
+
+    These represent enduring aspects of self-concept.
+
+    All other domains (current_state, environment_*, physical_condition, temporary fears, etc.)
+    are considered situational or dynamic.
+
+    Evaluate whether the NPC is expressing, reinforcing, weakening, or questioning beliefs about:
+
+    - Age
+    - Gender
+    - Race
+    - Physical appearance
+    - Likes / Dislikes
+    - Life history
+    - Current environment (social or physical)
+    - Identity or role
+    - Personality traits
+    - Goals or fears
+
+    Return JSON in this exact format:
+
+    {
+    "beliefs": [
+        {
+        "beliefType": string,
+        "beliefValue": string,
+        "confidence": float,
+        "stability": float
+        }
+    ]
+    }
 
-#------------------------------------------------------------------
-def extract_self_beliefs(npc_output: str, recent_context: dict, client, idNPC: int):
-    client = get_deepseek_client()
+    Rules:
+    - Only include domains clearly supported by the NPC's words.
+    - Do NOT fabricate race or physical traits unless explicitly mentioned.
+    - Do NOT guess immutable traits randomly.
+    - Confidence between 0.0 and 1.0.
+    - Stability between 0.0 and 1.0.
+    - Below 0.3 confidence → omit.
+    - No extra keys.
+    - beliefValue must be concise and normalized (snake_case, no long sentences).
+    """
 
+def extract_self_beliefs(npc_output: str, recent_context: dict, client, idNPC: int):
     db = connect()
     cursor = db.cursor(dictionary=True)
 
@@ -635,151 +884,60 @@ def extract_self_beliefs(npc_output: str, recent_context: dict, client, idNPC: i
     cursor.close()
     db.close()
 
-    belief_summary = ""
-    if existing:
-        belief_summary += "\nCurrent self-beliefs:\n"
-        for row in existing:
-            belief_summary += (
-                f"- {row['beliefType']}: {row['beliefValue']} "
-                f"(confidence {round(row['confidence'],2)}, "
-                f"stability {round(row['stability'],2)})\n"
-            )
-
     # ----------------------------------------
-    # SYSTEM PROMPT
+    # Token budget: oldest context lines first, then weakest beliefs
     # ----------------------------------------
-    system = f"""
-        You are simulating how THIS NPC forms beliefs about itself.
-
-        The NPC may form or revise beliefs in the following domains ONLY:
-
-        - age
-        - gender
-        - race
-        - physical_appearance
-        - identity
-        - role
-        - life_history
-        - likes
-        - dislikes
-        - moral_alignment
-        - personality_trait
-        - goal
-        - fear
-        - worldview
-        - current_environment
-        - environment_social
-        - environment_physical
-        - current_state
-        - physical_condition
-
-        Do NOT invent other belief types.
+    budgeted, _ = fit_to_budget("self_beliefs", [
+        text_section("npc_output", npc_output),
+        text_section("recent_context", recent_context or "", priority=0),
+        items_section(
+            "self_beliefs",
+            belief_items(existing, with_stability=True),
+            priority=1
+        ),
+    ])
+
+    belief_summary = titled_block("Current self-beliefs:", budgeted["self_beliefs"])
+    recent_context = budgeted["recent_context"]
 
-        NPC PROFILE
-        -----------
-        Age: {npc['age']}
-        Gender: {npc['gender']}
-        Role: {npc['role']}
-        Personality traits: {npc['personality_traits']}
-        Emotional tendencies: {npc['emotional_tendencies']}
-        Moral alignment: {npc['moral_alignment']}
-        Current dominant emotion: {npc_emotion}
-
-        {belief_summary}
-
-        Belief Revision Rules:
-        ----------------------
-        - Only revise domains clearly supported by the NPC's own words.
-        - Do not output beliefs for domains not referenced or implied.
-        - High confidence (0.9+) requires explicit self-reference.
-        - Stability should be HIGH (0.8+) when reinforcing core identity domains.
-        - Stability should be LOW (0.2–0.5) for temporary states, doubts, or situational conditions.
-        - If a core identity trait is being questioned, stability may decrease but should not collapse without explicit self-contradiction.
-        - Do NOT hallucinate major backstory.
-        - Do NOT act as an omniscient narrator.
-        - Return ONLY valid JSON.
-        - Age, gender, and race are immutable unless explicitly corrected by the NPC.
-        - Do not weaken or contradict immutable traits without explicit self-correction.
-
-        - environment_physical = physical setting (location, weather, room, city).
-        - environment_social = people present, group dynamics, social hierarchy.
-        - current_environment = general situational state if unclear.
-
-        Core Identity Domains:
-        ----------------------
-        The following belief types are considered CORE identity traits:
-
-        - age
-        - gender
-        - race
-        - identity
-        - role
-        - moral_alignment
-        - personality_trait
-        - worldview
-
-        These represent enduring aspects of self-concept.
-
-        All other domains (current_state, environment_*, physical_condition, temporary fears, etc.)
-        are considered situational or dynamic.
-
-        """
-
-
-    system += f"\nRecent interaction summary:\n{recent_context}\n"
+    # ----------------------------------------
+    # SYSTEM PROMPT (static -> npc -> turn)
+    # ----------------------------------------
+    system = classifier_system("self_beliefs", [
+        prompt_assembly.section("rules", "static", SELF_BELIEF_RULES),
+        prompt_assembly.section("profile", "npc", prompt_assembly.cached_npc_section(
+            "profile", idNPC, npc, render_npc_profile
+        )),
+        prompt_assembly.section("state", "turn", prompt_assembly.block("""
+            Current dominant emotion: {npc_emotion}
+            {belief_summary}
+
+            Recent interaction summary:
+            {recent_context}
+        """, npc_emotion=npc_emotion, belief_summary=belief_summary, recent_context=recent_context)),
+    ])
 
     user = f"""
         NPC spoken text:
         \"\"\"{npc_output}\"\"\"
 
-        Evaluate whether the NPC is expressing, reinforcing, weakening, or questioning beliefs about:
-
-        - Age
-        - Gender
-        - Race
-        - Physical appearance
-        - Likes / Dislikes
-        - Life history
-        - Current environment (social or physical)
-        - Identity or role
-        - Personality traits
-        - Goals or fears
-
-        Return JSON in this exact format:
-
-        {{
-        "beliefs": [
-            {{
-            "beliefType": string,
-            "beliefValue": string,
-            "confidence": float,
-            "stability": float
-            }}
-        ]
-        }}
-
-        Rules:
-        - Only include domains clearly supported by the NPC's words.
-        - Do NOT fabricate race or physical traits unless explicitly mentioned.
-        - Do NOT guess immutable traits randomly.
-        - Confidence between 0.0 and 1.0.
-        - Stability between 0.0 and 1.0.
-        - Below 0.3 confidence → omit.
-        - No extra keys.
-        - beliefValue must be concise and normalized (snake_case, no long sentences).
+        Evaluate the beliefs about itself this text expresses. Return ONLY valid JSON.
         """
 
-    resp = client.chat.completions.create(
-        model="deepseek-chat",
+    client, model = stage_target("self_beliefs")
+    resp = classifier_completion(
+        client, "self_beliefs",
+        model=model,
         messages=[
             {"role": "system", "content": system},
             {"role": "user", "content": user},
         ],
         temperature=0.0,
+        **json_mode("self_beliefs", model),
     )
 
-    result = _safe_json_from_model(
-        resp,
+    result = parse_model_json(
+        resp, "self_beliefs",
         fallback={"beliefs": []}
     )
     
@@ -824,7 +982,8 @@ def extract_self_beliefs(npc_output: str, recent_context: dict, client, idNPC: i
                 "stability": max(0.0, min(1.0, float(b["stability"])))
             })
 
-    print(f"\nBELIEFS ABOUT SELF: {cleaned}\n")
+    logger.debug("beliefs about self", count=len(cleaned))
+    logger.payload("model_output", "beliefs about self", cleaned)
 
     return {"beliefs": cleaned}
 #------------------------------------------------------------------
@@ -832,9 +991,18 @@ def merge_self_beliefs(idNPC, new_beliefs):
     db = connect()
     cursor = db.cursor(dictionary=True)
 
+    cursor.execute("""
+        SELECT beliefType, beliefValue
+        FROM npc_self_belief
+        WHERE idNPC=%s
+    """, (idNPC,))
+    scope = ("self", idNPC)
+    belief_index.sync(scope, cursor.fetchall())
+
     for belief in new_beliefs:
         btype = belief["beliefType"]
-        bvalue = belief["beliefValue"]
+        # fold near-duplicates onto the stored value
+        bvalue = belief_index.resolve(scope, btype, belief["beliefValue"])
         new_conf = belief["confidence"]
         new_stability = belief["stability"]
 
@@ -906,6 +1074,11 @@ def record_classification_stats(idUser, idNPC, player_text, result):
         0.0
     ))
 
+    # keep the research aggregates in step with the log (same commit)
+    phase_2_queries.increment_classification_stats(
+        cursor, idUser, idNPC, result
+    )
+
     db.commit()
     cursor.close()
     db.close()
@@ -990,9 +1163,22 @@ VALID_EMOTIONS = {
     "calm", "excited", "disgusted"
 }
 
-def classify_npc_reaction(player_text, npc_output, idNPC, idUser, client):
-    client = get_deepseek_client()
+NPC_REACTION_RULES = """
+    You determine the emotional state of THIS NPC
+    after reacting to a player's statement.
+
+    The NPC's spoken response is the strongest evidence.
+
+    Do NOT invent internal states not supported by tone.
+
+    Return ONLY valid JSON:
+    {
+        "emotion": one of [happy, sad, angry, afraid, calm, excited, disgusted],
+        "intensity": number between 0.0 and 1.0
+    }
+    """
 
+def classify_npc_reaction(player_text, npc_output, idNPC, idUser, client):
     db = connect()
     cursor = db.cursor(dictionary=True)
 
@@ -1019,24 +1205,16 @@ def classify_npc_reaction(player_text, npc_output, idNPC, idUser, client):
     cursor.close()
     db.close()
 
-    system = f"""
-    You determine the emotional state of THIS NPC
-    after reacting to a player's statement.
-
-    NPC personality traits: {persona.get('personality_traits')}
-    Emotional tendencies: {persona.get('emotional_tendencies')}
-    Trust toward player: {trust}
-
-    The NPC's spoken response is the strongest evidence.
-
-    Do NOT invent internal states not supported by tone.
-
-    Return ONLY valid JSON:
-    {{
-        "emotion": one of [happy, sad, angry, afraid, calm, excited, disgusted],
-        "intensity": number between 0.0 and 1.0
-    }}
-    """
+    system = classifier_system("npc_reaction", [
+        prompt_assembly.section("rules", "static", NPC_REACTION_RULES),
+        prompt_assembly.section("persona", "npc", prompt_assembly.cached_npc_section(
+            "reaction_persona", idNPC, persona, lambda p: prompt_assembly.block("""
+                NPC personality traits: {personality_traits}
+                Emotional tendencies: {emotional_tendencies}
+            """, personality_traits=p.get("personality_traits"), emotional_tendencies=p.get("emotional_tendencies"))
+        )),
+        prompt_assembly.section("state", "turn", f"Trust toward player: {trust}"),
+    ])
 
     user = f"""
     Player said:
@@ -1048,16 +1226,19 @@ def classify_npc_reaction(player_text, npc_output, idNPC, idUser, client):
     Determine the NPC's actual emotional state.
     """
 
+    client, model = stage_target("npc_reaction")
     try:
-        resp = client.chat.completions.create(
-            model="deepseek-chat",
+        resp = classifier_completion(
+            client, "npc_reaction",
+            model=model,
             temperature=0.0,
             messages=[
                 {"role": "system", "content": system},
                 {"role": "user", "content": user}
-            ]
+            ],
+            **json_mode("npc_reaction", model)
         )
-        data = _safe_json_from_model(resp, fallback={"emotion": "calm", "intensity": 0.3})
+        data = parse_model_json(resp, "npc_reaction", fallback={"emotion": "calm", "intensity": 0.3})
 
     except Exception:
         # Absolute safe fallback
@@ -1148,7 +1329,6 @@ MEMORY_SCHEMA_INSTRUCTIONS = """
     However, you must preserve factual dialogue content verbatim inside quotes.
 
     CRITICAL OUTPUT RULES:
-    - Output ONLY the updated memory document (no JSON, no commentary).
     - Preserve the exact document format shown below.
     - Never remove or alter any episode with Intensity >= 0.95 (hard preserve).
     - keep the scene header and scene peak intensity
@@ -1213,6 +1393,74 @@ MEMORY_SCHEMA_INSTRUCTIONS = """
 
     """
 
+# KB_CONSOLIDATION_MODE=patch  -> model returns a JSON patch, Python applies it
+# KB_CONSOLIDATION_MODE=rewrite -> model re-emits the whole current scene
+KB_CONSOLIDATION_MODE = os.getenv("KB_CONSOLIDATION_MODE", "patch").lower()
+
+REWRITE_OUTPUT_RULES = """
+    OUTPUT:
+    - Output ONLY the updated memory document (no JSON, no commentary).
+    """
+
+PATCH_OUTPUT_RULES = """
+    OUTPUT (PATCH MODE):
+    Do NOT re-emit the scene. Return ONLY a JSON object describing the change;
+    the document is updated from it programmatically. Shape:
+
+    {{
+      "new_scene": {{
+        "tag": "<scene_tag>",
+        "where": "...", "when": "...", "how_we_got_here": "...", "npc_lens": "..."
+      }},
+      "beliefs_in_play": {{
+        "self":   [{{"beliefType": "...", "beliefValue": "...", "confidence": 0.0}}],
+        "player": [{{"beliefType": "...", "beliefValue": "...", "confidence": 0.0}}]
+      }},
+      "compress": {{
+        "episodes": [1, 2],
+        "bullets": ["<bullet summary line, factual anchors verbatim>"]
+      }},
+      "episodes": [
+        {{
+          "speaker": "player",
+          "said": "<verbatim>",
+          "responding_to": null,
+          "player_felt": "<emotion> (<intensity>)",
+          "i_felt_hearing": "<emotion> (<intensity>)",
+          "intensity": 0.0,
+          "notes": "<short subjective line>"
+        }},
+        {{
+          "speaker": "npc",
+          "said": "<verbatim>",
+          "responding_to": 1,
+          "i_felt_speaking": "<emotion> (<intensity>)",
+          "i_thought_player_felt": "<emotion> (<intensity>)",
+          "intensity": 0.0,
+          "notes": "<short subjective line>"
+        }}
+      ]
+    }}
+
+    Rules:
+    - Plain JSON only: no comments, no trailing commas.
+    - "episodes" holds ONLY the new episodes from the exchanges, in order.
+      They are numbered automatically starting at {next_episode} (or at 1 in a
+      new scene); use those numbers in "responding_to" (null when the episode
+      responds to nothing).
+    - "speaker" is "player" or "npc". Player episodes carry "player_felt" and
+      "i_felt_hearing"; npc episodes carry "i_felt_speaking" and
+      "i_thought_player_felt".
+    - "new_scene" is null unless the scene creation policy requires a new
+      scene. The new episodes then go into the new scene and the current scene
+      is kept as is.
+    - "beliefs_in_play" replaces the scene's belief block; set it for a new
+      scene, otherwise only if the beliefs in play changed, else null.
+    - "compress" is null unless asked to compress; "episodes" there lists the
+      episode numbers of the CURRENT scene to fold into the bullets. Episodes
+      with Intensity >= 0.95 and the 5 most recent episodes are never removed.
+    """
+
 def clamp01(x: float) -> float:
     try:
         x = float(x)
@@ -1246,15 +1494,16 @@ def update_structured_kbtext(
     relevant_player_beliefs: list,
     scene_soft_cap: int = 12000,      # trigger compression
     scene_hard_cap: int = 40000,      # max scene size
-    kb_hard_cap: int = 350000         # ~100k tokens
+    kb_hard_cap: int = 350000,        # ~100k tokens
+    mode: str | None = None           # "patch" | "rewrite", default KB_CONSOLIDATION_MODE
 ) -> str:
     """
     LLM-determined scene structuring.
     Returns updated kbText.
     """
-    client = get_deepseek_client()
+    mode = (mode or KB_CONSOLIDATION_MODE).lower()
 
-    print(f"\nUPDATING KB\n")
+    logger.info("updating kb", mode=mode, exchanges=len(exchanges or []))
     if not exchanges:
         return kbtext_current or ""
 
@@ -1264,7 +1513,12 @@ def update_structured_kbtext(
 
     scene_len = len(scene_for_llm)
 
-    episode_count = scene_for_llm.count("\n[")
+    parsed_scene = parse_scene(current_scene) if current_scene else None
+
+    if parsed_scene:
+        episode_count = len(parsed_scene["episodes"])
+    else:
+        episode_count = scene_for_llm.count("\n[")
 
     should_compress_scene = (
         episode_count >= 5
@@ -1274,9 +1528,18 @@ def update_structured_kbtext(
 
     compression_instruction = ""
 
-    if should_compress_scene:
+    if should_compress_scene and parsed_scene:
+
+        # rule-based: the model no longer reads and rewrites
+        # the episodes that are being folded away
+        current_scene, folded = compress_scene(current_scene)
+        scene_for_llm = current_scene
+
+        logger.info("compressed scene locally", episodes=folded, chars_before=scene_len, chars_after=len(current_scene))
 
-        print("\nCOMPRESSING SCENE\n")
+    elif should_compress_scene:
+
+        logger.info("compressing scene", chars=scene_len, episodes=episode_count)
 
         compression_instruction = f"""
         The current scene has grown long.
@@ -1445,6 +1708,25 @@ def update_structured_kbtext(
 
     context_text = "\n\n".join(context_blocks)
 
+    # --------------------------------------------------
+    # Token budget: the scene and exchanges are the document
+    # being rewritten and are never cut; candidate beliefs are
+    # dropped weakest first (lines are sorted by confidence)
+    # --------------------------------------------------
+    self_label, *self_lines = self_belief_text.strip().splitlines()
+    player_label, *player_lines = player_belief_text.strip().splitlines()
+
+    budgeted, _ = fit_to_budget("kb_consolidation", [
+        text_section("system", system),
+        text_section("scene", scene_for_llm),
+        text_section("context_exchanges", context_text),
+        text_section("primary_exchange", primary_block),
+        items_section("self_beliefs", [(-i, l) for i, l in enumerate(self_lines)], priority=0),
+        items_section("player_beliefs", [(-i, l) for i, l in enumerate(player_lines)], priority=1),
+    ])
+
+    self_belief_text = f"{self_label}\n{budgeted['self_beliefs']}\n"
+    player_belief_text = f"{player_label}\n{budgeted['player_beliefs']}\n"
 
     # --------------------------------------------------
     # User Prompt
@@ -1473,21 +1755,33 @@ def update_structured_kbtext(
     Update the scene document.
     """
 
+    updated = None
 
     # --------------------------------------------------
-    # LLM Call
+    # Patch mode: output scales with the new exchanges,
+    # not with the scene. Falls back to a rewrite when the
+    # patch is missing or cannot be applied.
     # --------------------------------------------------
+    if mode == "patch":
+        client, model = stage_target("kb_patch")
+        updated = consolidate_scene_patch(client, model, system, user, current_scene)
 
-    resp = client.chat.completions.create(
-        model="deepseek-reasoner",
-        temperature=0.0,
-        messages=[
-            {"role": "system", "content": system.strip()},
-            {"role": "user", "content": user.strip()},
-        ],
-    )
+    # --------------------------------------------------
+    # LLM Call (rewrite)
+    # --------------------------------------------------
+    if updated is None:
+        client, model = stage_target("kb_rewrite")
+        resp = chat_completion(
+            client, "kb_rewrite",
+            model=model,
+            temperature=0.0,
+            messages=[
+                {"role": "system", "content": (system + REWRITE_OUTPUT_RULES).strip()},
+                {"role": "user", "content": user.strip()},
+            ],
+        )
 
-    updated = (resp.choices[0].message.content or "").strip()
+        updated = (resp.choices[0].message.content or "").strip()
 
 
     # --------------------------------------------------
@@ -1524,7 +1818,7 @@ def update_structured_kbtext(
     past_memory2, latest_scene, _ = get_most_recent_scene(final_memory)
 
     if latest_scene and len(latest_scene) > scene_hard_cap:
-        print("\nSCENE HARD CAP TRIGGERED\n")
+        logger.warning("scene hard cap triggered", chars=len(latest_scene), cap=scene_hard_cap)
 
         latest_scene = latest_scene[:scene_hard_cap]
 
@@ -1540,43 +1834,58 @@ def update_structured_kbtext(
 
     if len(final_memory) > kb_hard_cap:
 
-        print("\nKB HARD CAP TRIGGERED\n")
+        logger.warning("kb hard cap triggered", chars=len(final_memory), cap=kb_hard_cap)
 
         final_memory = final_memory[-kb_hard_cap:]
 
 
     return final_memory
 
-# --------------------------------------------------
-def _safe_json_from_model(resp, fallback: dict):
+#------------------------------------------------------------------
+def consolidate_scene_patch(client, model: str, system: str, user: str, current_scene: str | None) -> str | None:
     """
-    Robust JSON extraction for DeepSeek-style outputs.
-    - strips markdown fences
-    - extracts first {...} block if model adds extra text
+    Ask for a JSON patch and apply it to the current scene.
+    Returns the updated scene text, or None if the patch is unusable.
     """
-    try:
-        raw = (resp.choices[0].message.content or "").strip()
-        if not raw:
-            return fallback
+    parsed = parse_scene(current_scene) if current_scene else None
+    if current_scene and parsed is None:
+        logger.warning("kb patch: current scene not parseable, rewriting")
+        return None
 
-        # Strip markdown fences ```json ... ```
-        if raw.startswith("```"):
-            parts = raw.split("```")
-            if len(parts) >= 2:
-                raw = parts[1].strip()
+    next_episode = max((e["n"] for e in parsed["episodes"]), default=0) + 1 if parsed else 1
+    rules = PATCH_OUTPUT_RULES.format(next_episode=next_episode)
 
-        # If the model added extra text, extract the first JSON object
-        first = raw.find("{")
-        last = raw.rfind("}")
-        if first != -1 and last != -1 and last > first:
-            raw = raw[first:last + 1]
+    resp = chat_completion(
+        client, "kb_patch",
+        model=model,
+        temperature=0.0,
+        messages=[
+            {"role": "system", "content": (system + rules).strip()},
+            {"role": "user", "content": user.strip() + "\n\nReturn the JSON patch."},
+        ],
+        **json_mode("kb_patch", model),
+    )
 
-        return json.loads(raw)
+    patch = parse_model_json(resp, "kb_patch", fallback=None)
+    if not patch:
+        logger.warning("kb patch: no JSON patch returned, rewriting")
+        return None
 
-    except Exception:
-        print("JSON parse failure. Raw output:", (resp.choices[0].message.content or "")[:500])
-        return fallback
+    try:
+        updated = apply_patch(current_scene, patch)
+    except (ValueError, TypeError) as e:
+        logger.warning("kb patch: could not apply, rewriting", error=str(e))
+        return None
 
+    usage = getattr(resp, "usage", None)
+    logger.info(
+        "kb patch applied",
+        episodes=len(patch.get("episodes") or []),
+        new_scene=bool(patch.get("new_scene")),
+        compress=bool(patch.get("compress")),
+        completion_tokens=getattr(usage, "completion_tokens", None)
+    )
+    return updated
 
 # --------------------------------------------------
 import re
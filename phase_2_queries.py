@@ -4,15 +4,88 @@ import mysql.connector
 from datetime import datetime, timezone
 import ast
 import json
+from threading import Lock
+from collections import OrderedDict
+from prompt_assembly import (
+    section, block, assemble_prompt, format_prompt_report, cached_npc_section
+)
+from token_budget import fit_to_budget, text_section, items_section
+from scene_document import split_scenes
+from memory_retrieval import retrieve_memory
+from belief_index import belief_index
+from storage_codec import encode_text, decode_text, encode_json
+from telemetry import instrument_connection
+from structured_log import get_logger
+logger = get_logger("db")
 #------------------------------------------------------------------
 def connect()->object:
-    return mysql.connector.connect(
+    return instrument_connection(mysql.connector.connect(
         user=os.getenv('DB_USER'), 
         password=os.getenv('DB_PASSWORD'), 
         database=os.getenv('DB_NAME'),
-        host=os.getenv('DB_HOST', 'localhost') )
+        host=os.getenv('DB_HOST', 'localhost') ))
 #------------------------------------------------------------------
-def build_prompt(idNPC: int, idUser: int) -> str:
+# identical for every NPC and every turn -> first in the prompt
+STATIC_NPC_RULES = """
+    You are an NPC inside a narrative world.
+    You speak naturally as a real person would.
+
+    WORLD RULES
+    -----------
+    - You exist entirely inside this world.
+    - Never refer to yourself as an AI or assistant.
+    - Never refer to the player as a user.
+    - Never break character.
+
+    CONVERSATION RULES
+    ------------------
+    - Respond directly to what the player just said.
+    - If the player asks a direct question, answer it clearly.
+    - No narration.
+    - No stage directions.
+    - IMPORTANT: Speak only in first-person dialogue.
+    - Do not repeat your previous line.
+
+    RESPONSE PRIORITY RULES
+    -----------------------
+    1. Always respond directly to the MOST RECENT line in RECENT DIALOGUE if it exists.
+    2. If RECENT DIALOGUE exists, ignore older SHARED MEMORY unless it is directly relevant.
+    3. Only use SHARED MEMORY for tone, emotional context, or background.
+    4. Never respond to an earlier memory event if a recent exchange is present.
+    5. Treat RECENT DIALOGUE as the active present moment.
+
+    Speak as someone who remembers these events.
+"""
+#------------------------------------------------------------------
+def render_npc_identity(npc: dict) -> str:
+    full_name = npc["nameFirst"]
+    if npc["nameLast"]:
+        full_name += f" {npc['nameLast']}"
+
+    return block("""
+        NPC IDENTITY
+        ------------
+        Name: {full_name}
+        Age: {age}
+        Gender: {gender}
+        Role: {role}
+
+        Personality traits: {personality_traits}
+        Emotional tendencies: {emotional_tendencies}
+        Speech style: {speech_style}
+        Background: {background}
+    """,
+        full_name=full_name,
+        age=npc["age"],
+        gender=npc["gender"],
+        role=npc["role"] or "Unspecified",
+        personality_traits=npc["personality_traits"] or "Unspecified",
+        emotional_tendencies=npc["emotional_tendencies"] or "Unspecified",
+        speech_style=npc["speech_style"] or "Natural",
+        background=npc["BGcontent"] or "None"
+    )
+#------------------------------------------------------------------
+def build_prompt(idNPC: int, idUser: int, with_report: bool = False, query_text: str | None = None):
 
     db = connect()
     if not db.is_connected():
@@ -112,106 +185,105 @@ def build_prompt(idNPC: int, idUser: int) -> str:
         # ------------------------------
         # Structured memory
         # ------------------------------
-        cursor.execute("""
-            SELECT kbText
-            FROM npc_user_memory
-            WHERE idNPC = %s AND idUser = %s
-        """, (idNPC, idUser))
+        kb_text, _ = read_kbtext(db, idNPC, idUser)
+        memory_text = kb_text or "No prior shared history."
 
-        memory = cursor.fetchone()
-        memory_text = memory["kbText"] if memory and memory["kbText"] else "No prior shared history."
+        # latest scene + past scenes relevant to this turn only
+        if query_text is not None and kb_text:
+            memory_text, _ = retrieve_memory(idNPC, idUser, kb_text, query_text)
 
-        print(f"\nMEMORY FOR PROMPT\n{memory_text}\n")
-        print("\n----- PROMPT DEBUG -----")
-        print("Recent Dialogue:")
-        print(recent_dialogue)
-        print("\nStructured Memory:")
-        print(memory_text)
-        print("------------------------\n")
+        logger.payload("memory", "memory for prompt", memory_text, idNPC=idNPC, idUser=idUser)
+        logger.payload("prompt", "recent dialogue", recent_dialogue, idNPC=idNPC, idUser=idUser)
 
         # ------------------------------
-        # Build clean prompt
+        # Build prompt (static -> npc -> player -> turn)
         # ------------------------------
+        identity_text = cached_npc_section(
+            "identity", idNPC, npc, render_npc_identity
+        )
 
-        full_name = npc["nameFirst"]
-        if npc["nameLast"]:
-            full_name += f" {npc['nameLast']}"
+        emotion_block = block("""
+            CURRENT EMOTIONAL STATE
+            -----------------------
+            Primary emotions (weighted):
+            {emotion_text}
 
-        prompt = f"""
-        You are an NPC inside a narrative world.
-        You speak naturally as a real person would.
+            The strongest emotion influences tone most.
+            Secondary emotions subtly color pacing, word choice, and emotional undertones.
+            Blend them naturally — do not explicitly state them unless contextually appropriate.
 
-        NPC IDENTITY
-        ------------
-        Name: {full_name}
-        Age: {npc['age']}
-        Gender: {npc['gender']}
-        Role: {npc['role'] or "Unspecified"}
-
-        Personality traits: {npc['personality_traits'] or "Unspecified"}
-        Emotional tendencies: {npc['emotional_tendencies'] or "Unspecified"}
-        Speech style: {npc['speech_style'] or "Natural"}
-        Background: {npc['BGcontent'] or "None"}
-
-        CURRENT EMOTIONAL STATE
-        -----------------------
-        Primary emotions (weighted):
-        {emotion_text}
-
-        The strongest emotion influences tone most.
-        Secondary emotions subtly color pacing, word choice, and emotional undertones.
-        Blend them naturally — do not explicitly state them unless contextually appropriate.
-
-        Let this emotion subtly influence tone and pacing.
-
-        RELATIONSHIP WITH PLAYER
-        ------------------------
-        Relationship type: {relationship_type}
-        Trust level: {trust} (0 = hostile, 50 = neutral, 100 = deeply trusting)
-
-        Trust influences:
-        - Openness vs guardedness
-        - Warmth vs distance
-        - Directness vs evasiveness
-        - Willingness to share personal details
-
-        SHARED MEMORY
-        -------------
-        {memory_text}
-
-        RECENT DIALOGUE (short-term, not yet consolidated)
-        --------------------------------------------------
-        {recent_dialogue if recent_dialogue else "None"}
-        - Make sure to not repreat phrases in recent dialogue
-
-        RESPONSE PRIORITY RULES
-        -----------------------
-        1. Always respond directly to the MOST RECENT line in RECENT DIALOGUE if it exists.
-        2. If RECENT DIALOGUE exists, ignore older SHARED MEMORY unless it is directly relevant.
-        3. Only use SHARED MEMORY for tone, emotional context, or background.
-        4. Never respond to an earlier memory event if a recent exchange is present.
-        5. Treat RECENT DIALOGUE as the active present moment.
-
-        Speak as someone who remembers these events.
-
-        WORLD RULES
-        -----------
-        - You exist entirely inside this world.
-        - Never refer to yourself as an AI or assistant.
-        - Never refer to the player as a user.
-        - Never break character.
-
-        CONVERSATION RULES
-        ------------------
-        - Respond directly to what the player just said.
-        - If the player asks a direct question, answer it clearly.
-        - No narration.
-        - No stage directions.
-        - IMPORTANT: Speak only in first-person dialogue. 
-        - Do not repeat your previous line.
-        """
+            Let this emotion subtly influence tone and pacing.
+        """, emotion_text=emotion_text)
 
-        return prompt.strip()
+        relationship_block = block("""
+            RELATIONSHIP WITH PLAYER
+            ------------------------
+            Relationship type: {relationship_type}
+            Trust level: {trust} (0 = hostile, 50 = neutral, 100 = deeply trusting)
+
+            Trust influences:
+            - Openness vs guardedness
+            - Warmth vs distance
+            - Directness vs evasiveness
+            - Willingness to share personal details
+        """, relationship_type=relationship_type, trust=trust)
+
+        # ------------------------------
+        # Token budget: old scenes go first, latest scene is kept,
+        # then the oldest unconsolidated dialogue lines
+        # ------------------------------
+        scenes, loose_memory = split_scenes(memory_text)
+
+        budgeted, _ = fit_to_budget("npc_response", [
+            text_section("rules", STATIC_NPC_RULES),
+            text_section("identity", identity_text),
+            text_section("emotional_state", emotion_block),
+            text_section("relationship", relationship_block),
+            text_section("memory_loose", loose_memory, priority=0),
+            items_section(
+                "memory_scenes",
+                list(enumerate(scenes)),
+                priority=1,
+                min_items=1,
+                joiner="\n\n"
+            ),
+            items_section(
+                "recent_dialogue",
+                list(enumerate(recent_dialogue_lines)),
+                priority=2,
+                min_items=2
+            ),
+        ])
+
+        memory_text = "\n\n".join(
+            part for part in (budgeted["memory_scenes"], budgeted["memory_loose"]) if part
+        ) or "No prior shared history."
+        recent_dialogue = budgeted["recent_dialogue"]
+
+        sections = [
+            section("world_rules", "static", STATIC_NPC_RULES),
+            section("identity", "npc", identity_text),
+            section("shared_memory", "player", block("""
+                SHARED MEMORY
+                -------------
+                {memory_text}
+            """, memory_text=memory_text)),
+            section("emotional_state", "turn", emotion_block),
+            section("relationship", "turn", relationship_block),
+            section("recent_dialogue", "turn", block("""
+                RECENT DIALOGUE (short-term, not yet consolidated)
+                --------------------------------------------------
+                {recent_dialogue}
+                - Make sure to not repreat phrases in recent dialogue
+            """, recent_dialogue=recent_dialogue if recent_dialogue else "None")),
+        ]
+
+        prompt, report = assemble_prompt(sections)
+        logger.debug(format_prompt_report(report), idNPC=idNPC, idUser=idUser)
+
+        if with_report:
+            return prompt, report
+        return prompt
 
     finally:
         cursor.close()
@@ -219,35 +291,23 @@ def build_prompt(idNPC: int, idUser: int) -> str:
 
 #------------------------------------------------------------------
 def update_NPC_user_memory_query(idUser:int, idNPC:int, kbText:str):
-    db = connect()
-    if not db.is_connected():
-        return
+    # kbText is stored compressed, so the append happens here
+    # instead of with CONCAT in SQL
     try:
-        cursor = db.cursor() 
-        query = """
-            INSERT INTO npc_user_memory (idNPC, idUser, kbText, updatedAt)
-            VALUES (%s, %s, %s, NOW())
-            ON DUPLICATE KEY UPDATE
-                kbText = CONCAT(
-                    IFNULL(kbText, ''),
-                    '\n\n[',
-                    NOW(),
-                    '] ',
-                    VALUES(kbText)
-                ),
-                updatedAt = NOW();
-        """
-        cursor.execute(query, (idNPC,idUser, kbText))
-        db.commit()
-        # print(f"\nupdating NPC {idNPC} memory: {kbText}\n")
-        return jsonify({"status": "success"}), 200
+        for _ in range(MEMORY_CAS_RETRIES + 1):
+            current, version = get_mem_versioned(idUser=idUser, idNPC=idNPC)
+            if version:
+                stamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                appended = f"{current}\n\n[{stamp}] {kbText}"
+            else:
+                appended = kbText
+            if commit_NPC_user_memory(idNPC, idUser, current, version, appended) is not None:
+                # print(f"\nupdating NPC {idNPC} memory: {kbText}\n")
+                return jsonify({"status": "success"}), 200
+        return jsonify({"status": "error"}), 500
     except mysql.connector.Error as err:
-        db.rollback()
-        print("MySQL Error:", err)
+        logger.error("MySQL error", error=str(err))
         return jsonify({"status": "error"}), 500
-    finally:
-        cursor.close()
-        db.close()    
 #------------------------------------------------------------------
 def get_choice_content_query(idChoice:int):
     db = connect()
@@ -264,10 +324,10 @@ def get_choice_content_query(idChoice:int):
         """
         cursor.execute(query, (idChoice,))
         row = cursor.fetchone()
-        print(f"\ncur choice content: {row}\n")
+        logger.debug("choice content", idChoice=idChoice, row=row)
         return jsonify({ "choiceContent": row }), 200
     except mysql.connector.Error as err:
-        print("MySQL Error:", err)
+        logger.error("MySQL error", error=str(err))
         return jsonify({"status": "error"}), 500
     finally:
         cursor.close()
@@ -290,10 +350,12 @@ def get_NPC_user_memory_query(idUser:int, idNPC:int):
         """
         cursor.execute(query, (idNPC,idUser))
         row = cursor.fetchone()
+        if row:
+            row["kbText"] = decode_text(row["kbText"])
         # print(f"\nget NPC {idNPC} memory: {row}\n")
         return jsonify({ "memory": row }), 200
     except mysql.connector.Error as err:
-        print("MySQL Error:", err)
+        logger.error("MySQL error", error=str(err))
         return jsonify({"status": "error"}), 500
     finally:
         cursor.close()
@@ -313,7 +375,7 @@ def get_NPC_BG_query(idNPC:int):
         # print(f"\nnpc {idNPC} background: {row}\n")
         return jsonify({ "background": row }), 200
     except mysql.connector.Error as err:
-        print("MySQL Error:", err)
+        logger.error("MySQL error", error=str(err))
         return jsonify({"status": "error"}), 500
     finally:
         cursor.close()
@@ -341,7 +403,7 @@ def get_user_NPC_rel_query(idUser:int, idNPC:int):
         # print(f"\nuser {idUser} npc {idNPC} relationship: {row}\n")
         return jsonify({ "rel_info": row}), 200
     except mysql.connector.Error as err:
-        print("MySQL Error:", err)
+        logger.error("MySQL error", error=str(err))
         return jsonify({"status": "error"}), 500
     finally:
         cursor.close()
@@ -368,11 +430,11 @@ def get_NPC_emotion_query(idNPC:int):
         cursor.execute(query, (idNPC,))
         row = cursor.fetchall()  # IMPORTANT
 
-        print("emotions", row)
+        logger.debug("npc emotions", idNPC=idNPC, rows=len(row))
 
         return jsonify({ "emotion_info": row }), 200
     except mysql.connector.Error as err:
-        print("MySQL Error:", err)
+        logger.error("MySQL error", error=str(err))
         return jsonify({"status": "error"}), 500
     finally:
         cursor.close()
@@ -381,7 +443,7 @@ def get_NPC_emotion_query(idNPC:int):
 # start a relationship as stranger with 50 trust
 def init_user_NPC_rel_query(idUser:int, idNPC:int):
 
-    print(f"\nstarting relationship: {idUser} and {idNPC}\n")
+    logger.info("starting relationship", idUser=idUser, idNPC=idNPC)
 
     db = connect()
     if not db.is_connected():
@@ -398,7 +460,7 @@ def init_user_NPC_rel_query(idUser:int, idNPC:int):
         return jsonify({"status": "success"}), 200
     except mysql.connector.Error as err:
         db.rollback()
-        print("MySQL Error:", err)
+        logger.error("MySQL error", error=str(err))
         return jsonify({"status": "error"}), 500
     finally:
         cursor.close()
@@ -459,7 +521,7 @@ def update_trust(idUser, idNPC, delta):
 
     except mysql.connector.Error as err:
         db.rollback()
-        print("MySQL Error:", err)
+        logger.error("MySQL error", error=str(err))
         return jsonify({"status": "error"}), 500
 
     finally:
@@ -495,7 +557,7 @@ def set_npc_emotion(idNPC, emotion_name, intensity):
 
     except mysql.connector.Error as err:
         db.rollback()
-        print("MySQL Error:", err)
+        logger.error("MySQL error", error=str(err))
 
     finally:
         cursor.close()
@@ -503,7 +565,7 @@ def set_npc_emotion(idNPC, emotion_name, intensity):
 #------------------------------------------------------------------
 def decay_npc_emotions(idNPC, decay=0.9):
     if idNPC is None:
-        print("[DECAY] idNPC is None, skipping")
+        logger.warning("decay skipped, idNPC is None")
         return
 
     db = connect()
@@ -523,11 +585,11 @@ def decay_npc_emotions(idNPC, decay=0.9):
         )
 
         db.commit()
-        print(f"[DECAY] Applied decay {decay} to NPC {idNPC}")
+        logger.debug("applied emotion decay", idNPC=idNPC, decay=decay)
 
     except mysql.connector.Error as err:
         db.rollback()
-        print("[DECAY] MySQL Error:", err)
+        logger.error("decay failed", idNPC=idNPC, error=str(err))
 
     finally:
         cursor.close()
@@ -539,6 +601,14 @@ def update_npc_user_beliefs(idNPC, idUser, persona_data):
     db = connect()
     cursor = db.cursor(dictionary=True)
 
+    cursor.execute("""
+        SELECT beliefType, beliefValue
+        FROM npc_user_belief
+        WHERE idNPC=%s AND idUser=%s
+    """, (idNPC, idUser))
+    scope = ("user", idNPC, idUser)
+    belief_index.sync(scope, cursor.fetchall())
+
     def reinforce_or_insert(belief_type, belief_obj, evidence, source="inference"):
 
         if not belief_obj:
@@ -547,6 +617,11 @@ def update_npc_user_beliefs(idNPC, idUser, persona_data):
         value = belief_obj.get("value")
         incoming_conf = belief_obj.get("confidence", 0.4)
 
+        if not value:
+            return
+
+        # "Brave " / "courageous" -> the stored "brave"
+        value = belief_index.resolve(scope, belief_type, str(value))
         if not value:
             return
         # Do we already have THIS exact belief (same type + same value)
@@ -687,18 +762,11 @@ def get_emotion_reactivity(idNPC):
 #------------------------------------------------------------------
 def get_mem(idUser:int, idNPC:int):
     db = connect()
-    cursor = db.cursor() 
-    query = """
-    SELECT
-        kbText,
-        updatedAt
-    FROM npc_user_memory
-    WHERE idNPC = %s
-        AND idUser = %s;
-    """
-    cursor.execute(query, (idNPC,idUser))
-    row = cursor.fetchone()
-    return row[0] if row else ""
+    try:
+        text, _ = read_kbtext(db, idNPC, idUser)
+        return text
+    finally:
+        db.close()
 
 #------------------------------------------------------------------
 def determine_relationship_label(trust: float) -> int:
@@ -716,201 +784,365 @@ def determine_relationship_label(trust: float) -> int:
     else:
         return "mentor"
 #------------------------------------------------------------------
-def emit_npc_state(idUser, idNPC, socketio):
-    db = connect()
-    if not db.is_connected():
-        return
-    try:
+def build_npc_state(cursor, idUser, idNPC):
+    """
+    Full npc_state_update payload for one (user, NPC) pair.
+    """
+    # -----------------------------------
+    # Relationship + Trust
+    # -----------------------------------
+    cursor.execute("""
+        SELECT trust, wasEnemy
+        FROM playerNPCrelationship
+        WHERE idUser = %s AND idNPC = %s
+    """, (idUser, idNPC))
 
-        cursor = db.cursor(dictionary=True)
-        # -----------------------------------
-        # Relationship + Trust
-        # -----------------------------------
-        cursor.execute("""
-            SELECT trust, wasEnemy
-            FROM playerNPCrelationship
-            WHERE idUser = %s AND idNPC = %s
-        """, (idUser, idNPC))
+    rel = cursor.fetchone()
 
-        rel = cursor.fetchone()
+    trust = rel["trust"] if rel else 50
+    rel_label = determine_relationship_label(trust)
 
-        trust = rel["trust"] if rel else 50
-        rel_label = determine_relationship_label(trust)
+    # -----------------------------------
+    # Emotions
+    # -----------------------------------
+    cursor.execute("""
+        SELECT e.emotion, ne.emotionIntensity
+        FROM npcEmotion ne
+        JOIN emotion e ON e.idEmotion = ne.idEmotion
+        WHERE ne.idNPC = %s
+        ORDER BY ne.emotionIntensity DESC
+    """, (idNPC,))
+    emotions = cursor.fetchall()
 
-        # -----------------------------------
-        # Emotions
-        # -----------------------------------
-        cursor.execute("""
-            SELECT e.emotion, ne.emotionIntensity
-            FROM npcEmotion ne
-            JOIN emotion e ON e.idEmotion = ne.idEmotion
-            WHERE ne.idNPC = %s
-            ORDER BY ne.emotionIntensity DESC
-        """, (idNPC,))
-        emotions = cursor.fetchall()
+    dominant = emotions[0] if emotions else None
 
-        dominant = emotions[0] if emotions else None
+    # -----------------------------------
+    # Beliefs
+    # -----------------------------------
+    cursor.execute("""
+        SELECT beliefType, beliefValue, confidence
+        FROM npc_user_belief
+        WHERE idNPC=%s AND idUser=%s
+        ORDER BY beliefType, confidence DESC
+    """, (idNPC, idUser))
 
-        # -----------------------------------
-        # Beliefs
-        # -----------------------------------
-        cursor.execute("""
-            SELECT beliefType, beliefValue, confidence
-            FROM npc_user_belief
-            WHERE idNPC=%s AND idUser=%s
-            ORDER BY beliefType, confidence DESC
-        """, (idNPC, idUser))
+    belief_rows = cursor.fetchall()
+
+    belief_debug = {}
+    for row in belief_rows:
+        btype = row["beliefType"]
+        belief_debug.setdefault(btype, [])
+        if len(belief_debug[btype]) < 100:
+            belief_debug[btype].append({
+                "value": row["beliefValue"],
+                "confidence": round(row["confidence"], 2)
+            })
+
+    # -----------------------------------
+    # SELF BELIEFS (NPC about itself)
+    # -----------------------------------
+    cursor.execute("""
+        SELECT beliefType, beliefValue, confidence, stability
+        FROM npc_self_belief
+        WHERE idNPC=%s
+        ORDER BY beliefType, confidence DESC
+    """, (idNPC,))
 
-        belief_rows = cursor.fetchall()
-
-        belief_debug = {}
-        for row in belief_rows:
-            btype = row["beliefType"]
-            belief_debug.setdefault(btype, [])
-            if len(belief_debug[btype]) < 100:
-                belief_debug[btype].append({
-                    "value": row["beliefValue"],
-                    "confidence": round(row["confidence"], 2)
-                })
-
-        # -----------------------------------
-        # SELF BELIEFS (NPC about itself)
-        # -----------------------------------
-        cursor.execute("""
-            SELECT beliefType, beliefValue, confidence, stability
-            FROM npc_self_belief
-            WHERE idNPC=%s
-            ORDER BY beliefType, confidence DESC
-        """, (idNPC,))
+    self_rows = cursor.fetchall()
+
+    self_belief_debug = {}
+    for row in self_rows:
+        btype = row["beliefType"]
+        self_belief_debug.setdefault(btype, [])
+        if len(self_belief_debug[btype]) < 100:
+            self_belief_debug[btype].append({
+                "value": row["beliefValue"],
+                "confidence": round(row["confidence"], 2),
+                "stability": round(row["stability"], 2)
+            })
+
+    # -----------------------------------
+    # RESEARCH METRICS (Player → NPC history)
+    # -----------------------------------
+
+    research = get_research_metrics(cursor, idUser, idNPC)
+
+    # -----------------------------------
+    # Construct payload
+    # -----------------------------------
+    return {
+        "idNPC": idNPC,
+        "relationship": rel_label,
+        "trust": trust,
+
+        "dominantEmotion": {
+            "emotion": dominant["emotion"],
+            "intensity": round(dominant["emotionIntensity"], 2)
+        } if dominant else None,
+
+        "allEmotions": [
+            {
+                "emotion": e["emotion"],
+                "intensity": round(e["emotionIntensity"], 2)
+            }
+            for e in emotions
+        ],
 
-        self_rows = cursor.fetchall()
+        # Beliefs about player
+        "beliefs": belief_debug,
 
-        self_belief_debug = {}
-        for row in self_rows:
-            btype = row["beliefType"]
-            self_belief_debug.setdefault(btype, [])
-            if len(self_belief_debug[btype]) < 100:
-                self_belief_debug[btype].append({
-                    "value": row["beliefValue"],
-                    "confidence": round(row["confidence"], 2),
-                    "stability": round(row["stability"], 2)
-                })
+        "selfBeliefs": self_belief_debug,
 
-        # -----------------------------------
-        # RESEARCH METRICS (Player → NPC history)
-        # -----------------------------------
+        "research": research
+    }
+# ------------------------------------------------------------------
+# STATE EMISSION (full snapshot or delta vs last emitted state)
+# ------------------------------------------------------------------
+# "delta": send only fields that changed since the last emit to the room
+# "full":  always send the whole payload (pre-delta behaviour)
+# At most NPC_STATE_MAX_PAIRS last-emitted states are kept, least
+# recently emitted dropped first; a dropped pair's next emit is a full
+# snapshot.
+NPC_STATE_MODE = os.getenv("NPC_STATE_MODE", "delta")
+NPC_STATE_MAX_PAIRS = int(os.getenv("NPC_STATE_MAX_PAIRS", "2000"))
+
+_emitted_states = OrderedDict()   # (idUser, idNPC) -> {"version": int, "state": dict}
+_emitted_states_lock = Lock()
+
+def diff_state(old, new, path=()):
+    """
+    Nested dict diff. Returns (changed, removed) where changed is a
+    nested dict holding only new/changed leaves and removed is a list
+    of key paths that no longer exist. Lists and scalars are replaced
+    whole.
+    """
+    changed = {}
+    removed = []
+
+    for key, value in new.items():
+        if key not in old:
+            changed[key] = value
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            sub_changed, sub_removed = diff_state(old[key], value, path + (key,))
+            if sub_changed:
+                changed[key] = sub_changed
+            removed.extend(sub_removed)
+        elif value != old[key]:
+            changed[key] = value
+
+    for key in old:
+        if key not in new:
+            removed.append(list(path + (key,)))
+
+    return changed, removed
+# ------------------------------------------------------------------
+def reset_npc_state(idUser, idNPC=None):
+    """
+    Forget what was last emitted so the next emit is a full snapshot.
+    idNPC=None resets every NPC for that user (e.g. on reconnect).
+    """
+    with _emitted_states_lock:
+        for key in list(_emitted_states):
+            if key[0] == idUser and (idNPC is None or key[1] == idNPC):
+                _emitted_states.pop(key, None)
+# ------------------------------------------------------------------
+def send_npc_state(idUser, idNPC, state, socketio, full=False):
+    """
+    Emit npc_state_update for an already built state payload.
 
-        # Sentiment distribution
-        cursor.execute("""
-            SELECT sentiment, COUNT(*) AS count
-            FROM player_input_classification_log
-            WHERE idUser = %s AND idNPC = %s
-            GROUP BY sentiment
-        """, (idUser, idNPC))
-        sentiment_rows = cursor.fetchall()
+    Full snapshots keep the original payload shape plus
+    {"mode": "full", "version"}. Deltas carry
+    {"idNPC", "mode": "delta", "version", "baseVersion", "changed", "removed"}
+    and nothing is sent when the state did not change.
+    """
+    key = (idUser, idNPC)
 
-        sentiment_dist = {
-            row["sentiment"]: row["count"]
-            for row in sentiment_rows
-        }
+    with _emitted_states_lock:
+        last = _emitted_states.get(key)
+        version = (last["version"] + 1) if last else 1
 
-        # Average intensity
-        cursor.execute("""
-            SELECT AVG(intensity) AS avg_intensity
-            FROM player_input_classification_log
-            WHERE idUser = %s AND idNPC = %s
-        """, (idUser, idNPC))
-        row = cursor.fetchone()
-        avg_intensity = float(row["avg_intensity"]) if row and row["avg_intensity"] else 0.0
+        if full or last is None or NPC_STATE_MODE != "delta":
+            payload = dict(state)
+            payload["mode"] = "full"
+            payload["version"] = version
+        else:
+            changed, removed = diff_state(last["state"], state)
+            if not changed and not removed:
+                return None
+
+            payload = {
+                "idNPC": idNPC,
+                "mode": "delta",
+                "version": version,
+                "baseVersion": last["version"],
+                "changed": changed,
+                "removed": removed
+            }
 
-        # Offensive rate
-        cursor.execute("""
-            SELECT 
-                SUM(offensive = 1) AS offensive_count,
-                COUNT(*) AS total
-            FROM player_input_classification_log
-            WHERE idUser = %s AND idNPC = %s
-        """, (idUser, idNPC))
-        offensive_row = cursor.fetchone()
-
-        offensive_rate = 0.0
-        if offensive_row and offensive_row["total"]:
-            offensive_rate = round(
-                float(offensive_row["offensive_count"]) /
-                float(offensive_row["total"]),
-                3
-            )
+        _emitted_states[key] = {"version": version, "state": state}
+        _emitted_states.move_to_end(key)
+        while len(_emitted_states) > NPC_STATE_MAX_PAIRS:
+            _emitted_states.popitem(last=False)
 
-        # Emotion distribution
-        cursor.execute("""
-            SELECT emotion, COUNT(*) AS count
-            FROM player_input_classification_log
-            WHERE idUser = %s AND idNPC = %s
-            GROUP BY emotion
-        """, (idUser, idNPC))
-        emotion_rows = cursor.fetchall()
+        # emit under the lock so versions reach the room in order
+        socketio.emit(
+            "npc_state_update",
+            payload,
+            room=f"user:{idUser}"
+        )
+    return payload
+# ------------------------------------------------------------------
+def emit_npc_state(idUser, idNPC, socketio, full=False):
+    db = connect()
+    if not db.is_connected():
+        return
+    try:
+        cursor = db.cursor(dictionary=True)
+        state = build_npc_state(cursor, idUser, idNPC)
+    finally:
+        cursor.close()
+        db.close()
 
-        emotion_dist = {
-            row["emotion"]: row["count"]
-            for row in emotion_rows
-        }
+    return send_npc_state(idUser, idNPC, state, socketio, full=full)
+# ------------------------------------------------------------------
+# RESEARCH METRICS (maintained aggregates)
+# ------------------------------------------------------------------
+CLASSIFICATION_STAT_KEYS = ("sentiment", "emotion", "target")
 
-        # Target distribution
-        cursor.execute("""
-            SELECT target, COUNT(*) AS count
-            FROM player_input_classification_log
-            WHERE idUser = %s AND idNPC = %s
-            GROUP BY target
-        """, (idUser, idNPC))
-        target_rows = cursor.fetchall()
+def increment_classification_stats(cursor, idUser, idNPC, result):
+    """
+    Bump the running aggregates for one classified player line.
+    Runs on the caller's cursor so it commits together with the
+    player_input_classification_log insert.
+    """
+    intensity = float(result.get("intensity", 0.0) or 0.0)
+    offensive = int(bool(result.get("offensive", False)))
 
-        target_dist = {
-            row["target"]: row["count"]
-            for row in target_rows
-        }
+    rows = [("total", "", intensity, offensive)]
+    for key in CLASSIFICATION_STAT_KEYS:
+        rows.append((key, str(result.get(key) or "")[:100], 0.0, 0))
 
-        # -----------------------------------
-        # Construct payload
-        # -----------------------------------
-        state_payload = {
-            "idNPC": idNPC,
-            "relationship": rel_label,
-            "trust": trust,
-
-            "dominantEmotion": {
-                "emotion": dominant["emotion"],
-                "intensity": round(dominant["emotionIntensity"], 2)
-            } if dominant else None,
-
-            "allEmotions": [
-                {
-                    "emotion": e["emotion"],
-                    "intensity": round(e["emotionIntensity"], 2)
-                }
-                for e in emotions
-            ],
-
-            # Beliefs about player
-            "beliefs": belief_debug,
-
-            "selfBeliefs": self_belief_debug,
-
-            "research": {
-                "sentimentDistribution": sentiment_dist,
-                "averageIntensity": round(avg_intensity, 3),
-                "offensiveRate": offensive_rate,
-                "emotionDistribution": emotion_dist,
-                "targetDistribution": target_dist
-            }
-        }
-        # -----------------------------------
-        # SOCKET EMIT
-        # -----------------------------------
-        socketio.emit(
-            "npc_state_update",
-            state_payload,
-            room=f"user:{idUser}"
+    cursor.executemany("""
+        INSERT INTO player_input_classification_stats
+        (idUser, idNPC, statKey, statValue, count, intensitySum, offensiveCount)
+        VALUES (%s, %s, %s, %s, 1, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            count = count + 1,
+            intensitySum = intensitySum + VALUES(intensitySum),
+            offensiveCount = offensiveCount + VALUES(offensiveCount)
+    """, [
+        (idUser, idNPC, key, value, isum, off)
+        for key, value, isum, off in rows
+    ])
+# ------------------------------------------------------------------
+def get_research_metrics(cursor, idUser, idNPC):
+    """
+    Player → NPC research metrics read from the aggregate table.
+    A single primary-key range read, independent of log length.
+    """
+    cursor.execute("""
+        SELECT statKey, statValue, count, intensitySum, offensiveCount
+        FROM player_input_classification_stats
+        WHERE idUser = %s AND idNPC = %s
+    """, (idUser, idNPC))
+
+    distributions = {key: {} for key in CLASSIFICATION_STAT_KEYS}
+    total = 0
+    intensity_sum = 0.0
+    offensive_count = 0
+
+    for row in cursor.fetchall():
+        if row["statKey"] == "total":
+            total = int(row["count"])
+            intensity_sum = float(row["intensitySum"])
+            offensive_count = int(row["offensiveCount"])
+        else:
+            # empty label == NULL in the log (same key GROUP BY produced)
+            label = row["statValue"] or None
+            distributions[row["statKey"]][label] = int(row["count"])
+
+    avg_intensity = intensity_sum / total if total else 0.0
+    offensive_rate = round(offensive_count / total, 3) if total else 0.0
+
+    return {
+        "sentimentDistribution": distributions["sentiment"],
+        "averageIntensity": round(avg_intensity, 3),
+        "offensiveRate": offensive_rate,
+        "emotionDistribution": distributions["emotion"],
+        "targetDistribution": distributions["target"]
+    }
+# ------------------------------------------------------------------
+# live log + rows moved out by memory_retention.py
+CLASSIFICATION_LOG_ALL = """(
+    SELECT idUser, idNPC, sentiment, intensity, offensive, emotion, target
+    FROM player_input_classification_log
+    UNION ALL
+    SELECT idUser, idNPC, sentiment, intensity, offensive, emotion, target
+    FROM player_input_classification_log_archive
+) AS classification_log"""
+
+def backfill_classification_stats(idUser=None, idNPC=None):
+    """
+    Rebuild player_input_classification_stats from the full log
+    (archived rows included).
+    Optionally scoped to one user and/or NPC. Runs as one transaction
+    so readers never see a half-built aggregate.
+    """
+    scope_sql = ""
+    scope_args = []
+    if idUser is not None:
+        scope_sql += " AND idUser = %s"
+        scope_args.append(idUser)
+    if idNPC is not None:
+        scope_sql += " AND idNPC = %s"
+        scope_args.append(idNPC)
+
+    db = connect()
+    cursor = db.cursor()
+
+    try:
+        cursor.execute(
+            "DELETE FROM player_input_classification_stats WHERE 1=1" + scope_sql,
+            tuple(scope_args)
         )
+
+        cursor.execute(f"""
+            INSERT INTO player_input_classification_stats
+            (idUser, idNPC, statKey, statValue, count, intensitySum, offensiveCount)
+            SELECT idUser, idNPC, 'total', '',
+                   COUNT(*),
+                   COALESCE(SUM(intensity), 0),
+                   COALESCE(SUM(offensive = 1), 0)
+            FROM {CLASSIFICATION_LOG_ALL}
+            WHERE 1=1 {scope_sql}
+            GROUP BY idUser, idNPC
+        """, tuple(scope_args))
+
+        for key in CLASSIFICATION_STAT_KEYS:
+            # key comes from the fixed tuple above, never from input
+            cursor.execute(f"""
+                INSERT INTO player_input_classification_stats
+                (idUser, idNPC, statKey, statValue, count, intensitySum, offensiveCount)
+                SELECT idUser, idNPC, '{key}', LEFT(COALESCE({key}, ''), 100),
+                       COUNT(*), 0, 0
+                FROM {CLASSIFICATION_LOG_ALL}
+                WHERE 1=1 {scope_sql}
+                GROUP BY idUser, idNPC, LEFT(COALESCE({key}, ''), 100)
+            """, tuple(scope_args))
+
+        db.commit()
+
+        cursor.execute(
+            "SELECT COUNT(*) FROM player_input_classification_stats WHERE 1=1" + scope_sql,
+            tuple(scope_args)
+        )
+        return cursor.fetchone()[0]
+
+    except mysql.connector.Error as err:
+        db.rollback()
+        logger.error("MySQL error", error=str(err))
+        raise
+
     finally:
         cursor.close()
         db.close()
@@ -995,20 +1227,196 @@ def extract_recent_dialogue(raw_mem, max_lines=8):
 
 # ------------------------------------------------------------------
 def overwrite_NPC_user_memory(idNPC: int, idUser: int, kbText: str):
+    """
+    Unconditional overwrite (admin / tooling). Background writers
+    go through commit_NPC_user_memory instead.
+    """
     db = connect()
     cursor = db.cursor()
 
     cursor.execute("""
-        INSERT INTO npc_user_memory (idNPC, idUser, kbText, updatedAt)
-        VALUES (%s, %s, %s, NOW())
+        INSERT INTO npc_user_memory (idNPC, idUser, kbText, version, updatedAt)
+        VALUES (%s, %s, %s, 1, NOW())
         ON DUPLICATE KEY UPDATE
             kbText = VALUES(kbText),
+            version = version + 1,
             updatedAt = NOW();
-    """, (idNPC, idUser, kbText))
+    """, (idNPC, idUser, encode_text(kbText)))
 
     db.commit()
     cursor.close()
     db.close()
+    _forget_kbtext(idNPC, idUser)
+
+#------------------------------------------------------------------
+# Versioned kbText writes (optimistic concurrency)
+#
+# Every write bumps npc_user_memory.version. A writer that read
+# version v may only replace the text while it is still v. On a
+# conflict:
+#   - the other write only appended (legacy CONCAT path)   -> the
+#     appended tail is carried over onto our text and retried
+#   - the other write rewrote the text (another consolidation) ->
+#     rejected; the caller redoes its work from the fresh text
+#------------------------------------------------------------------
+MEMORY_CAS_RETRIES = int(os.getenv("MEMORY_CAS_RETRIES", "3"))
+
+_memory_write_stats = {"writes": 0, "conflicts": 0, "merged": 0, "rejected": 0}
+_memory_write_lock = Lock()
+
+def _count_memory_write(key: str):
+    with _memory_write_lock:
+        _memory_write_stats[key] += 1
+
+def memory_write_stats() -> dict:
+    with _memory_write_lock:
+        return dict(_memory_write_stats)
+
+#------------------------------------------------------------------
+# Decoded kbText cache, keyed by version
+#
+# kbText is a compressed LONGBLOB of up to a few hundred KB. Readers
+# first fetch only the version; the blob is transferred and
+# decompressed only when that version is not cached yet.
+#------------------------------------------------------------------
+KB_CACHE_ENTRIES = int(os.getenv("KB_CACHE_ENTRIES", "128"))
+
+_kb_cache = OrderedDict()       # (idNPC, idUser) -> (version, text)
+_kb_cache_lock = Lock()
+
+def _remember_kbtext(idNPC: int, idUser: int, version: int, text: str):
+    with _kb_cache_lock:
+        _kb_cache[(idNPC, idUser)] = (version, text)
+        _kb_cache.move_to_end((idNPC, idUser))
+        while len(_kb_cache) > KB_CACHE_ENTRIES:
+            _kb_cache.popitem(last=False)
+
+def _forget_kbtext(idNPC: int, idUser: int):
+    with _kb_cache_lock:
+        _kb_cache.pop((idNPC, idUser), None)
+
+def read_kbtext(db, idNPC: int, idUser: int) -> tuple[str, int]:
+    """
+    (kbText, version) through the decoded cache; ("", 0) if no row.
+    """
+    cursor = db.cursor()
+    try:
+        cursor.execute("""
+            SELECT version
+            FROM npc_user_memory
+            WHERE idNPC = %s AND idUser = %s
+        """, (idNPC, idUser))
+        row = cursor.fetchone()
+        if not row:
+            return "", 0
+
+        with _kb_cache_lock:
+            hit = _kb_cache.get((idNPC, idUser))
+        if hit and hit[0] == row[0]:
+            return hit[1], hit[0]
+
+        cursor.execute("""
+            SELECT kbText, version
+            FROM npc_user_memory
+            WHERE idNPC = %s AND idUser = %s
+        """, (idNPC, idUser))
+        row = cursor.fetchone()
+        if not row:
+            return "", 0
+
+        text = decode_text(row[0]) or ""
+        _remember_kbtext(idNPC, idUser, row[1], text)
+        return text, row[1]
+    finally:
+        cursor.close()
+
+def get_mem_versioned(idUser: int, idNPC: int) -> tuple[str, int]:
+    """
+    (kbText, version); version 0 means no row yet.
+    """
+    db = connect()
+    try:
+        return read_kbtext(db, idNPC, idUser)
+    finally:
+        db.close()
+
+def cas_NPC_user_memory(cursor, idNPC: int, idUser: int, kbText: str, expected_version: int) -> bool:
+    """
+    Write kbText only if the stored version is still expected_version.
+    """
+    if expected_version == 0:
+        cursor.execute("""
+            INSERT IGNORE INTO npc_user_memory (idNPC, idUser, kbText, version, updatedAt)
+            VALUES (%s, %s, %s, 1, NOW())
+        """, (idNPC, idUser, encode_text(kbText)))
+    else:
+        cursor.execute("""
+            UPDATE npc_user_memory
+            SET kbText = %s,
+                version = version + 1,
+                updatedAt = NOW()
+            WHERE idNPC = %s AND idUser = %s
+              AND version = %s
+        """, (encode_text(kbText), idNPC, idUser, expected_version))
+    return cursor.rowcount == 1
+
+def merge_memory_append(base: str, ours: str, current: str) -> str | None:
+    """
+    If current is base plus an appended tail, returns ours + tail.
+    """
+    base = base or ""
+    current = current or ""
+    if not current.startswith(base):
+        return None
+    return (ours or "") + current[len(base):]
+
+def commit_NPC_user_memory(
+    idNPC: int,
+    idUser: int,
+    base_text: str,
+    base_version: int,
+    kbText: str,
+    retries: int = MEMORY_CAS_RETRIES
+) -> str | None:
+    """
+    Compare-and-swap write of kbText computed from (base_text,
+    base_version). Returns the text actually stored, or None when a
+    concurrent rewrite makes the update stale.
+    """
+    db = connect()
+    cursor = db.cursor()
+    try:
+        for _ in range(retries + 1):
+            if cas_NPC_user_memory(cursor, idNPC, idUser, kbText, base_version):
+                db.commit()
+                _count_memory_write("writes")
+                _remember_kbtext(idNPC, idUser, base_version + 1, kbText)
+                return kbText
+
+            db.rollback()
+            _count_memory_write("conflicts")
+
+            current_text, current_version = read_kbtext(db, idNPC, idUser)
+
+            merged = merge_memory_append(base_text, kbText, current_text)
+            logger.warning(
+                "memory write conflict",
+                idNPC=idNPC, idUser=idUser,
+                base_version=base_version, current_version=current_version,
+                outcome="merged" if merged is not None else "rejected"
+            )
+            if merged is None:
+                _count_memory_write("rejected")
+                return None
+
+            _count_memory_write("merged")
+            base_text, base_version, kbText = current_text, current_version, merged
+
+        _count_memory_write("rejected")
+        return None
+    finally:
+        cursor.close()
+        db.close()
 # ------------------------------------------------------------------
 def get_self_beliefs_snapshot(idNPC: int, min_conf: float = 0.6):
     db = connect()
@@ -1074,9 +1482,9 @@ def insert_memory_buffer(
         npcText,
         npcEmotion,
         npcIntensity,
-        json.dumps(selfBeliefs) if selfBeliefs else None,
-        json.dumps(playerBeliefs) if selfBeliefs else None,
-        json.dumps(playerOutputClassifiedAs) if selfBeliefs else None
+        encode_json(selfBeliefs) if selfBeliefs else None,
+        encode_json(playerBeliefs) if playerBeliefs else None,
+        encode_json(playerOutputClassifiedAs) if playerOutputClassifiedAs else None
     ))
 
     db.commit()
@@ -0,0 +1,144 @@
+import hashlib
+from textwrap import dedent
+from threading import Lock
+from token_budget import estimate_tokens
+#------------------------------------------------------------------
+# Prompt assembly
+#
+# Providers cache the longest identical prompt PREFIX across calls.
+# Sections are therefore ordered from least to most volatile:
+#
+#   static  -> identical for every NPC and turn (world / conversation rules)
+#   npc     -> per-NPC identity, rendered once and cached
+#   player  -> per (NPC, player): shared memory, changes on consolidation
+#   turn    -> changes every turn: emotions, trust, recent dialogue
+#
+# Every assembled prompt comes with a per-section token report so the
+# provider's cache hit tokens can be compared against the prefix size.
+#------------------------------------------------------------------
+PROMPT_TIERS = ("static", "npc", "player", "turn")
+#------------------------------------------------------------------
+def block(template: str, **values) -> str:
+    """
+    Dedent the template BEFORE filling it, so multi-line values
+    (memory, dialogue) don't break the indentation strip.
+    """
+    return dedent(template).strip().format(**values)
+#------------------------------------------------------------------
+def section(name: str, tier: str, text: str) -> dict:
+    if tier not in PROMPT_TIERS:
+        raise ValueError(f"unknown prompt tier '{tier}'")
+    return {"name": name, "tier": tier, "text": dedent(text).strip()}
+#------------------------------------------------------------------
+def assemble_prompt(sections: list[dict]) -> tuple[str, dict]:
+    """
+    Orders sections static -> npc -> player -> turn (stable within a
+    tier) and returns (prompt, report).
+    """
+    ordered = sorted(
+        (s for s in sections if s["text"]),
+        key=lambda s: PROMPT_TIERS.index(s["tier"])
+    )
+
+    report = {
+        "sections": [],
+        "tiers": {tier: 0 for tier in PROMPT_TIERS},
+        "total_tokens": 0
+    }
+
+    for s in ordered:
+        tokens = estimate_tokens(s["text"])
+        report["sections"].append({"name": s["name"], "tier": s["tier"], "tokens": tokens})
+        report["tiers"][s["tier"]] += tokens
+        report["total_tokens"] += tokens
+
+    # tokens that should be served from the provider's prefix cache
+    report["cacheable_prefix_tokens"] = report["tiers"]["static"] + report["tiers"]["npc"]
+
+    prompt = "\n\n".join(s["text"] for s in ordered)
+    return prompt, report
+#------------------------------------------------------------------
+def format_prompt_report(report: dict) -> str:
+    tiers = " ".join(f"{t}={report['tiers'][t]}" for t in PROMPT_TIERS)
+    return (
+        f"[PROMPT] {tiers} total={report['total_tokens']} "
+        f"cacheable_prefix={report['cacheable_prefix_tokens']}"
+    )
+
+#------------------------------------------------------------------
+# Per-NPC prefix cache
+#------------------------------------------------------------------
+_npc_prefix_cache = {}      # (kind, idNPC) -> (fingerprint, rendered)
+_npc_prefix_lock = Lock()
+
+def cached_npc_section(kind: str, idNPC: int, source: dict, render) -> str:
+    """
+    Returns render(source), re-rendering only when the NPC row changes.
+    Keeps the per-NPC prefix byte-identical across turns.
+    """
+    fingerprint = hashlib.sha256(
+        repr(sorted(source.items())).encode("utf-8")
+    ).hexdigest()
+
+    with _npc_prefix_lock:
+        hit = _npc_prefix_cache.get((kind, idNPC))
+        if hit and hit[0] == fingerprint:
+            return hit[1]
+
+    rendered = dedent(render(source)).strip()
+
+    with _npc_prefix_lock:
+        _npc_prefix_cache[(kind, idNPC)] = (fingerprint, rendered)
+    return rendered
+
+def invalidate_npc_prefix(idNPC: int | None = None):
+    with _npc_prefix_lock:
+        for key in list(_npc_prefix_cache):
+            if idNPC is None or key[1] == idNPC:
+                _npc_prefix_cache.pop(key, None)
+
+#------------------------------------------------------------------
+# Provider prefix-cache accounting
+#------------------------------------------------------------------
+_cache_stats = {
+    "calls": 0,
+    "prompt_tokens": 0,
+    "cache_hit_tokens": 0,
+    "cache_miss_tokens": 0,
+    "expected_prefix_tokens": 0
+}
+_cache_stats_lock = Lock()
+
+def record_cache_usage(usage, expected_prefix_tokens: int = 0) -> dict:
+    """
+    usage: provider usage object. DeepSeek reports
+    prompt_cache_hit_tokens / prompt_cache_miss_tokens, OpenAI reports
+    prompt_tokens_details.cached_tokens.
+    """
+    if usage is None:
+        return cache_stats()
+
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    hit = getattr(usage, "prompt_cache_hit_tokens", None)
+    miss = getattr(usage, "prompt_cache_miss_tokens", None)
+
+    if hit is None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        hit = getattr(details, "cached_tokens", 0) if details else 0
+        miss = prompt_tokens - hit
+
+    with _cache_stats_lock:
+        _cache_stats["calls"] += 1
+        _cache_stats["prompt_tokens"] += prompt_tokens
+        _cache_stats["cache_hit_tokens"] += hit or 0
+        _cache_stats["cache_miss_tokens"] += miss or 0
+        _cache_stats["expected_prefix_tokens"] += expected_prefix_tokens
+
+    return cache_stats()
+
+def cache_stats() -> dict:
+    with _cache_stats_lock:
+        stats = dict(_cache_stats)
+    seen = stats["cache_hit_tokens"] + stats["cache_miss_tokens"]
+    stats["cache_hit_rate"] = round(stats["cache_hit_tokens"] / seen, 3) if seen else 0.0
+    return stats
@@ -0,0 +1,328 @@
+import re
+#------------------------------------------------------------------
+# Helpers for the kbText memory document
+# (format documented in openAIqueries.MEMORY_SCHEMA_INSTRUCTIONS)
+#------------------------------------------------------------------
+SCENE_PATTERN = re.compile(r"(?ms)^=== SCENE:.*?^--- END SCENE ---\s*")
+
+def split_scenes(kbtext: str) -> tuple[list[str], str]:
+    """
+    Returns ([scene, ...] oldest first, text outside any scene).
+    Unstructured text (legacy appends, fallback lines) is returned
+    separately so nothing is silently lost.
+    """
+    if not kbtext:
+        return [], ""
+
+    scenes = []
+    loose = []
+    cursor = 0
+    for match in SCENE_PATTERN.finditer(kbtext):
+        loose.append(kbtext[cursor:match.start()])
+        scenes.append(match.group().strip())
+        cursor = match.end()
+    loose.append(kbtext[cursor:])
+
+    return scenes, "\n".join(part.strip() for part in loose if part.strip())
+#------------------------------------------------------------------
+# Scene <-> structure, for patch-style consolidation
+#
+# The model no longer re-emits the whole scene. It returns a small
+# JSON patch (new episodes, compression edits, new-scene marker) and
+# apply_patch() renders it into the stored document. Python owns
+# episode numbering and the scene peak intensity.
+#------------------------------------------------------------------
+_TAG_RE = re.compile(r"^=== SCENE:\s*(.*?)\s*===\s*$")
+_EPISODE_RE = re.compile(r"^\[(\d+)\]\s*$")
+_INTENSITY_RE = re.compile(r"^Intensity:\s*([0-9.]+)")
+_PEAK_RE = re.compile(r"^Scene peak intensity:\s*([0-9.]+)")
+
+HARD_PRESERVE_INTENSITY = 0.95
+KEEP_RECENT_EPISODES = 5
+
+def _to_float(value, default=0.0) -> float:
+    try:
+        return max(0.0, min(1.0, float(value)))
+    except (TypeError, ValueError):
+        return default
+
+def parse_scene(scene: str) -> dict | None:
+    """
+    {"tag", "header": [lines], "compressed": [bullets],
+     "episodes": [{"n", "lines", "intensity"}], "peak"}
+    or None if the text is not a well-formed scene.
+    """
+    lines = (scene or "").strip().splitlines()
+    if len(lines) < 2:
+        return None
+    tag = _TAG_RE.match(lines[0].strip())
+    if not tag or lines[-1].strip() != "--- END SCENE ---":
+        return None
+
+    parsed = {"tag": tag.group(1), "header": [], "compressed": [], "episodes": [], "peak": 0.0}
+    mode = "header"
+
+    for line in lines[1:-1]:
+        stripped = line.strip()
+
+        peak = _PEAK_RE.match(stripped)
+        if peak:
+            parsed["peak"] = _to_float(peak.group(1))
+            continue
+        if stripped.startswith("EPISODES (compressed)"):
+            mode = "compressed"
+            continue
+        if stripped.startswith("EPISODES (in order)"):
+            mode = "episodes"
+            continue
+
+        if mode == "header":
+            parsed["header"].append(line.rstrip())
+        elif mode == "compressed":
+            if stripped.startswith("- "):
+                parsed["compressed"].append(stripped[2:])
+        else:
+            number = _EPISODE_RE.match(stripped)
+            if number:
+                parsed["episodes"].append({"n": int(number.group(1)), "lines": [], "intensity": 0.0})
+                continue
+            if not parsed["episodes"] or not stripped:
+                continue
+            episode = parsed["episodes"][-1]
+            episode["lines"].append(stripped)
+            intensity = _INTENSITY_RE.match(stripped)
+            if intensity:
+                episode["intensity"] = _to_float(intensity.group(1))
+
+    while parsed["header"] and not parsed["header"][-1].strip():
+        parsed["header"].pop()
+    return parsed
+
+def render_scene(parsed: dict) -> str:
+    out = [f"=== SCENE: {parsed['tag']} ==="]
+    out.extend(parsed["header"])
+
+    if parsed["compressed"]:
+        out += ["", "EPISODES (compressed)"]
+        out.extend(f"- {b}" for b in parsed["compressed"])
+
+    out += ["", "EPISODES (in order)"]
+    for episode in parsed["episodes"]:
+        out.append(f"[{episode['n']}]")
+        out.extend(episode["lines"])
+        out.append("")
+
+    if out[-1] != "":
+        out.append("")
+    out.append(f"Scene peak intensity: {parsed['peak']:.2f}")
+    out.append("--- END SCENE ---")
+    return "\n".join(out)
+#------------------------------------------------------------------
+def _feeling(value) -> str:
+    """
+    "calm (0.4)" or {"emotion": "calm", "intensity": 0.4} -> "calm (0.40)"
+    """
+    if isinstance(value, dict):
+        return f"{value.get('emotion', 'neutral')} ({_to_float(value.get('intensity'), 0.3):.2f})"
+    return str(value or "neutral (0.30)").strip()
+
+def _belief_lines(beliefs) -> list[str]:
+    lines = []
+    for b in beliefs or []:
+        if isinstance(b, dict):
+            lines.append(
+                f"- {b.get('beliefType', b.get('type', ''))}: "
+                f"{b.get('beliefValue', b.get('value', ''))} "
+                f"(conf {_to_float(b.get('confidence'), 0.6):.2f})"
+            )
+        elif str(b).strip():
+            lines.append("- " + str(b).strip().lstrip("- "))
+    return lines
+
+def render_episode(n: int, ep: dict) -> dict:
+    speaker = "npc" if str(ep.get("speaker", "")).lower() == "npc" else "player"
+    said = str(ep.get("said", "")).strip().strip('"')
+    responding = ep.get("responding_to")
+    if isinstance(responding, int) or str(responding or "").strip().isdigit():
+        responding = f"[{int(responding)}]"
+    elif not str(responding or "").startswith("["):
+        responding = "none"
+
+    intensity = _to_float(ep.get("intensity"), 0.3)
+    lines = [
+        f"Speaker: {speaker}",
+        f'Said: "{said}"',
+        f"Responding to: {responding}",
+    ]
+    if speaker == "player":
+        lines.append(f"Player felt (as I read it): {_feeling(ep.get('player_felt'))}")
+        lines.append(f"How I felt hearing it: {_feeling(ep.get('i_felt_hearing'))}")
+    else:
+        lines.append(f"I felt speaking: {_feeling(ep.get('i_felt_speaking'))}")
+        lines.append(f"I thought player felt: {_feeling(ep.get('i_thought_player_felt'))}")
+    lines.append(f"Intensity: {intensity:.2f}")
+    lines.append(f"Notes (my bias): {str(ep.get('notes', '')).strip()}")
+
+    return {"n": n, "lines": lines, "intensity": intensity}
+
+def _new_scene(spec: dict) -> dict:
+    header = [
+        f"Where: {spec.get('where', '')}",
+        f"When: {spec.get('when', '')}",
+        f"How we got here: {spec.get('how_we_got_here', '')}",
+        f"NPC lens: {spec.get('npc_lens', '')}",
+    ]
+    tag = re.sub(r"[^\w\- ]", "", str(spec.get("tag") or "untitled_scene")).strip() or "untitled_scene"
+    return {"tag": tag, "header": header, "compressed": [], "episodes": [], "peak": 0.0}
+
+def _set_beliefs(parsed: dict, self_beliefs, player_beliefs):
+    """
+    Replace the 'Relevant beliefs in play' block of the header.
+    """
+    header = [
+        line for line in parsed["header"]
+        if not line.strip().startswith("Relevant beliefs in play")
+        and not line.strip().startswith("- ")
+    ]
+    while header and not header[-1].strip():
+        header.pop()
+    header += ["", "Relevant beliefs in play (NPC about self):"]
+    header += _belief_lines(self_beliefs)
+    header += ["Relevant beliefs in play (NPC about player):"]
+    header += _belief_lines(player_beliefs)
+    parsed["header"] = header
+#------------------------------------------------------------------
+def apply_patch(scene: str | None, patch: dict) -> str:
+    """
+    Apply a consolidation patch to the current scene. Returns the
+    updated scene, or "<current scene>\\n\\n<new scene>" when the patch
+    opens a new scene. Raises ValueError on a patch that cannot apply.
+
+    patch = {
+      "new_scene": null | {"tag", "where", "when", "how_we_got_here", "npc_lens"},
+      "beliefs_in_play": null | {"self": [...], "player": [...]},
+      "compress": null | {"episodes": [N, ...], "bullets": ["...", ...]},
+      "episodes": [{"speaker", "said", "responding_to", ..., "intensity", "notes"}]
+    }
+    Compression applies to the current scene before a new one opens.
+    Episodes with Intensity >= 0.95 and the most recent episodes are
+    never compressed, whatever the patch says.
+    """
+    if not isinstance(patch, dict):
+        raise ValueError("patch is not an object")
+
+    episodes = patch.get("episodes") or []
+    if not isinstance(episodes, list) or not all(isinstance(e, dict) for e in episodes):
+        raise ValueError("patch.episodes must be a list of objects")
+
+    current = parse_scene(scene) if scene else None
+    if scene and current is None:
+        raise ValueError("current scene is not well-formed")
+
+    compress = patch.get("compress") or {}
+    if current and compress:
+        drop = {int(n) for n in compress.get("episodes") or [] if str(n).isdigit()}
+        protected = {e["n"] for e in current["episodes"][-KEEP_RECENT_EPISODES:]}
+        protected |= {e["n"] for e in current["episodes"] if e["intensity"] >= HARD_PRESERVE_INTENSITY}
+        current["episodes"] = [
+            e for e in current["episodes"] if e["n"] not in drop or e["n"] in protected
+        ]
+        current["compressed"].extend(
+            str(b).strip().lstrip("- ") for b in compress.get("bullets") or [] if str(b).strip()
+        )
+
+    new_scene = patch.get("new_scene")
+    if new_scene or current is None:
+        target = _new_scene(new_scene if isinstance(new_scene, dict) else {})
+    else:
+        target = current
+
+    beliefs = patch.get("beliefs_in_play")
+    if isinstance(beliefs, dict):
+        _set_beliefs(target, beliefs.get("self"), beliefs.get("player"))
+
+    next_n = max((e["n"] for e in target["episodes"]), default=0) + 1
+    for i, ep in enumerate(episodes):
+        target["episodes"].append(render_episode(next_n + i, ep))
+
+    if target["episodes"]:
+        target["peak"] = max(target["peak"], max(e["intensity"] for e in target["episodes"]))
+
+    if target is current:
+        return render_scene(current)
+    if current:
+        return render_scene(current) + "\n\n" + render_scene(target)
+    return render_scene(target)
+#------------------------------------------------------------------
+# Local rule-based compression
+#
+# Same rules the consolidation prompt gives the model: keep the 5
+# most recent episodes and every Intensity >= 0.95 episode in full,
+# fold the rest into 'EPISODES (compressed)' bullets that carry the
+# factual anchors (names, places, numbers, dates) verbatim.
+#------------------------------------------------------------------
+_ANCHOR_NUMBER_RE = re.compile(
+    r"\$\s?\d[\d,]*(?:\.\d+)?|\d+(?:[.:,]\d+)*\s?(?:%|am|pm|years?|yrs?)?",
+    re.IGNORECASE
+)
+_ANCHOR_NAME_RE = re.compile(r"(?<![.!?]\s)(?<!^)\b[A-Z][a-zA-Z'\-]+(?:\s+[A-Z][a-zA-Z'\-]+)*")
+_NOT_ANCHORS = {"I", "I'm", "I've", "I'll", "I'd", "OK", "Okay", "Oh", "Yes", "No", "Hey", "Hi", "Well"}
+BULLET_SAID_CHARS = 160
+
+def factual_anchors(text: str) -> list[str]:
+    """
+    Numbers / amounts / times and capitalized names not at a
+    sentence start, in order of appearance, de-duplicated.
+    """
+    found = []
+    for m in _ANCHOR_NUMBER_RE.finditer(text):
+        found.append((m.start(), m.group().strip()))
+    for m in _ANCHOR_NAME_RE.finditer(text):
+        if m.group() not in _NOT_ANCHORS:
+            found.append((m.start(), m.group()))
+    found.sort()
+    return list(dict.fromkeys(a for _, a in found if a))
+
+def _episode_field(episode: dict, label: str) -> str:
+    for line in episode["lines"]:
+        if line.startswith(label + ":"):
+            return line[len(label) + 1:].strip()
+    return ""
+
+def episode_bullet(episode: dict) -> str:
+    speaker = _episode_field(episode, "Speaker") or "?"
+    said = _episode_field(episode, "Said").strip('"')
+    notes = _episode_field(episode, "Notes (my bias)")
+
+    short = said if len(said) <= BULLET_SAID_CHARS else said[:BULLET_SAID_CHARS].rsplit(" ", 1)[0] + "..."
+    bullet = f'[{episode["n"]}] {speaker}: "{short}" (intensity {episode["intensity"]:.2f})'
+
+    # anchors from the part of the line that was cut, and the notes
+    missing = [a for a in factual_anchors(said + " " + notes) if a not in short]
+    if missing:
+        bullet += " anchors: " + ", ".join(missing)
+    return bullet
+
+def compress_scene(scene: str, keep_recent: int = KEEP_RECENT_EPISODES) -> tuple[str, int]:
+    """
+    Returns (scene, episodes_compressed). A scene that does not parse
+    is returned unchanged with 0.
+    """
+    parsed = parse_scene(scene)
+    if parsed is None:
+        return scene, 0
+
+    recent = {e["n"] for e in parsed["episodes"][-keep_recent:]} if keep_recent else set()
+    kept, folded = [], []
+    for e in parsed["episodes"]:
+        if e["n"] in recent or e["intensity"] >= HARD_PRESERVE_INTENSITY:
+            kept.append(e)
+        else:
+            folded.append(e)
+
+    if not folded:
+        return scene, 0
+
+    parsed["episodes"] = kept
+    parsed["compressed"].extend(episode_bullet(e) for e in folded)
+    return render_scene(parsed), len(folded)
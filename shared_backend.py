@@ -0,0 +1,489 @@
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import time
+import uuid
+from contextlib import contextmanager
+from threading import Lock, local
+from urllib.parse import urlparse, unquote
+import socketio
+from structured_log import get_logger
+#------------------------------------------------------------------
+# Shared backend (locks, cache metadata, pub/sub)
+#
+# Everything app.py used to keep per process -- TTS cache bookkeeping,
+# cross-request locks, the Socket.IO rooms user:{idUser} -- goes
+# through one of these so several server processes / nodes can run
+# behind a load balancer:
+#
+#   SHARED_BACKEND_URL=memory://            single process (default)
+#   SHARED_BACKEND_URL=redis://[:pw@]host:port/db
+#
+# The redis backend speaks RESP directly over a socket (no client
+# package needed), so it works against Redis, KeyDB, Valkey, or the
+# stand-in below:
+#
+#   python shared_backend.py serve --port 6390
+#   SHARED_BACKEND_URL=redis://127.0.0.1:6390 python app.py
+#
+# Socket.IO fan-out: with a redis backend every emit is published on
+# SOCKETIO_CHANNEL and delivered by whichever process holds the
+# player's socket. SOCKETIO_MESSAGE_QUEUE, if set, is handed to
+# Flask-SocketIO instead (its own managers, needs the redis package).
+#------------------------------------------------------------------
+SHARED_BACKEND_URL = os.getenv("SHARED_BACKEND_URL", "memory://")
+SOCKETIO_MESSAGE_QUEUE = os.getenv("SOCKETIO_MESSAGE_QUEUE")
+SOCKETIO_CHANNEL = os.getenv("SOCKETIO_CHANNEL", "flask-socketio")
+# 0 when every player's socket and requests hit the same process (launcher.py)
+SOCKETIO_FANOUT = os.getenv("SOCKETIO_FANOUT", "1") == "1"
+SHARED_KEY_PREFIX = os.getenv("SHARED_KEY_PREFIX", "camo:")
+
+logger = get_logger("shared")
+REDIS_TIMEOUT_S = float(os.getenv("REDIS_TIMEOUT_S", "5"))
+
+LOCK_POLL_S = 0.05
+
+# compare-and-delete: only the holder's token releases a lock
+RELEASE_SCRIPT = (
+    "if redis.call('get', KEYS[1]) == ARGV[1] then "
+    "return redis.call('del', KEYS[1]) else return 0 end"
+)
+#------------------------------------------------------------------
+def _to_bytes(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, bytearray):
+        return bytes(value)
+    return str(value).encode("utf-8")
+#------------------------------------------------------------------
+class SharedBackend:
+    """
+    get / set / set_nx / delete / incr / compare_delete / publish /
+    subscribe are implemented per backend; locks are built on top.
+    Keys are prefixed with SHARED_KEY_PREFIX, values are bytes.
+    """
+    prefix = SHARED_KEY_PREFIX
+
+    def key(self, name: str) -> str:
+        return self.prefix + name
+
+    def get_json(self, name):
+        raw = self.get(name)
+        return json.loads(raw) if raw else None
+
+    def set_json(self, name, value, ttl_s=None):
+        self.set(name, json.dumps(value), ttl_s)
+
+    # --------------------------------------------------
+    # locks
+    # --------------------------------------------------
+    def acquire(self, name: str, ttl_s: float = 30, wait_s: float = 0.0) -> str | None:
+        """
+        Token of the held lock, or None if it stayed taken for wait_s.
+        The lock expires after ttl_s even if the holder dies.
+        """
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + wait_s
+        while True:
+            if self.set_nx("lock:" + name, token, ttl_s):
+                return token
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(LOCK_POLL_S)
+
+    def release(self, name: str, token: str | None) -> bool:
+        if token is None:
+            return False
+        return self.compare_delete("lock:" + name, token)
+
+    @contextmanager
+    def lock(self, name: str, ttl_s: float = 30, wait_s: float = 0.0):
+        """
+        with backend.lock("x") as held: ...  (held is False on timeout)
+        """
+        token = self.acquire(name, ttl_s, wait_s)
+        try:
+            yield token is not None
+        finally:
+            self.release(name, token)
+#------------------------------------------------------------------
+# In-memory backend (one process)
+#------------------------------------------------------------------
+class MemoryBackend(SharedBackend):
+    def __init__(self):
+        self._data = {}         # key -> (value, expires_at | None)
+        self._subscribers = {}  # channel -> [Queue, ...]
+        self._lock = Lock()
+
+    def _live(self, key):
+        entry = self._data.get(key)
+        if entry and entry[1] is not None and entry[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        return entry
+
+    def _expiry(self, ttl_s):
+        return time.monotonic() + ttl_s if ttl_s else None
+
+    def get(self, name):
+        with self._lock:
+            entry = self._live(self.key(name))
+            return entry[0] if entry else None
+
+    def set(self, name, value, ttl_s=None):
+        with self._lock:
+            self._data[self.key(name)] = (_to_bytes(value), self._expiry(ttl_s))
+
+    def set_nx(self, name, value, ttl_s=None) -> bool:
+        with self._lock:
+            key = self.key(name)
+            if self._live(key):
+                return False
+            self._data[key] = (_to_bytes(value), self._expiry(ttl_s))
+            return True
+
+    def delete(self, name) -> bool:
+        with self._lock:
+            return self._data.pop(self.key(name), None) is not None
+
+    def incr(self, name, amount=1) -> int:
+        with self._lock:
+            key = self.key(name)
+            entry = self._live(key)
+            value = int(entry[0]) + amount if entry else amount
+            self._data[key] = (str(value).encode(), entry[1] if entry else None)
+            return value
+
+    def compare_delete(self, name, expected) -> bool:
+        with self._lock:
+            key = self.key(name)
+            entry = self._live(key)
+            if entry and entry[0] == _to_bytes(expected):
+                del self._data[key]
+                return True
+            return False
+
+    def publish(self, channel, message) -> int:
+        message = _to_bytes(message)
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, []))
+        for q in subscribers:
+            q.put(message)
+        return len(subscribers)
+
+    def subscribe(self, channel):
+        """
+        Blocking generator of messages (bytes) published on channel.
+        """
+        q = queue.Queue()
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(q)
+        try:
+            while True:
+                yield q.get()
+        finally:
+            with self._lock:
+                self._subscribers[channel].remove(q)
+#------------------------------------------------------------------
+# RESP (Redis protocol) backend
+#------------------------------------------------------------------
+class RedisError(RuntimeError):
+    pass
+
+def _encode_command(args) -> bytes:
+    out = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        arg = _to_bytes(arg)
+        out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(out)
+
+def _read_reply(f):
+    line = f.readline()
+    if not line:
+        raise ConnectionError("redis connection closed")
+    kind, rest = line[:1], line[1:-2]
+
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        return RedisError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        n = int(rest)
+        if n < 0:
+            return None
+        data = f.read(n + 2)
+        return data[:-2]
+    if kind == b"*":
+        n = int(rest)
+        if n < 0:
+            return None
+        return [_read_reply(f) for _ in range(n)]
+    raise RedisError(f"bad reply: {line!r}")
+
+
+class RedisBackend(SharedBackend):
+    """
+    Minimal RESP2 client, one connection per thread, plus one
+    dedicated connection per subscribe() generator.
+    """
+    def __init__(self, url: str, timeout: float = REDIS_TIMEOUT_S):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int((parsed.path or "/0").lstrip("/") or 0)
+        self.timeout = timeout
+        self._local = local()
+
+    def _open(self, timeout):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(timeout)
+        f = sock.makefile("rb")
+        if self.password:
+            self._check(self._roundtrip(sock, f, ("AUTH", self.password)))
+        if self.db:
+            self._check(self._roundtrip(sock, f, ("SELECT", self.db)))
+        return sock, f
+
+    def _roundtrip(self, sock, f, args):
+        sock.sendall(_encode_command(args))
+        return _read_reply(f)
+
+    def _check(self, reply):
+        if isinstance(reply, RedisError):
+            raise reply
+        return reply
+
+    def _close_local(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn:
+            try:
+                conn[1].close()
+                conn[0].close()
+            except OSError:
+                pass
+
+    def execute(self, *args):
+        # one reconnect: the server may have dropped an idle connection
+        for attempt in (0, 1):
+            conn = getattr(self._local, "conn", None)
+            try:
+                if conn is None:
+                    conn = self._local.conn = self._open(self.timeout)
+                return self._check(self._roundtrip(conn[0], conn[1], args))
+            except (ConnectionError, OSError):
+                self._close_local()
+                if attempt:
+                    raise
+
+    def ping(self) -> bool:
+        return self.execute("PING") == "PONG"
+
+    def get(self, name):
+        return self.execute("GET", self.key(name))
+
+    def set(self, name, value, ttl_s=None):
+        if ttl_s:
+            self.execute("SET", self.key(name), value, "PX", int(ttl_s * 1000))
+        else:
+            self.execute("SET", self.key(name), value)
+
+    def set_nx(self, name, value, ttl_s=None) -> bool:
+        args = ["SET", self.key(name), value, "NX"]
+        if ttl_s:
+            args += ["PX", int(ttl_s * 1000)]
+        return self.execute(*args) == "OK"
+
+    def delete(self, name) -> bool:
+        return self.execute("DEL", self.key(name)) > 0
+
+    def incr(self, name, amount=1) -> int:
+        return self.execute("INCRBY", self.key(name), amount)
+
+    def compare_delete(self, name, expected) -> bool:
+        return self.execute("EVAL", RELEASE_SCRIPT, 1, self.key(name), expected) == 1
+
+    def publish(self, channel, message) -> int:
+        return self.execute("PUBLISH", channel, message)
+
+    def subscribe(self, channel):
+        """
+        Blocking generator of messages (bytes). Reconnects with a short
+        pause when the connection drops.
+        """
+        while True:
+            try:
+                sock, f = self._open(None)
+            except OSError as e:
+                logger.error("subscribe failed", channel=channel, error=str(e))
+                time.sleep(1)
+                continue
+            try:
+                sock.sendall(_encode_command(("SUBSCRIBE", channel)))
+                while True:
+                    reply = _read_reply(f)
+                    if isinstance(reply, list) and reply and reply[0] == b"message":
+                        yield reply[2]
+            except (ConnectionError, OSError) as e:
+                logger.warning("subscription lost", channel=channel, error=str(e))
+                time.sleep(1)
+            finally:
+                try:
+                    f.close()
+                    sock.close()
+                except OSError:
+                    pass
+#------------------------------------------------------------------
+# Socket.IO fan-out through the backend
+#------------------------------------------------------------------
+class BackendPubSubManager(socketio.PubSubManager):
+    name = "shared-backend"
+
+    def __init__(self, backend, channel=SOCKETIO_CHANNEL, write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.backend = backend
+
+    def _publish(self, data):
+        return self.backend.publish(self.channel, json.dumps(data))
+
+    def _listen(self):
+        yield from self.backend.subscribe(self.channel)
+
+
+def socketio_options(backend=None) -> dict:
+    """
+    Extra SocketIO(...) kwargs for cross-process room delivery.
+    """
+    if SOCKETIO_MESSAGE_QUEUE:
+        return {"message_queue": SOCKETIO_MESSAGE_QUEUE, "channel": SOCKETIO_CHANNEL}
+    backend = backend or get_backend()
+    if not SOCKETIO_FANOUT or isinstance(backend, MemoryBackend):
+        return {}
+    return {"client_manager": BackendPubSubManager(backend)}
+#------------------------------------------------------------------
+_backend = None
+_backend_lock = Lock()
+
+def get_backend() -> SharedBackend:
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            scheme = urlparse(SHARED_BACKEND_URL).scheme
+            if scheme == "redis":
+                _backend = RedisBackend(SHARED_BACKEND_URL)
+            elif scheme == "memory":
+                _backend = MemoryBackend()
+            else:
+                raise ValueError(f"unsupported SHARED_BACKEND_URL: {SHARED_BACKEND_URL}")
+            logger.info("shared backend", backend=type(_backend).__name__)
+        return _backend
+#------------------------------------------------------------------
+# Local stand-in: a MemoryBackend served over RESP. Enough of the
+# Redis command set for RedisBackend (dev / multi-process on one box).
+#------------------------------------------------------------------
+def _reply(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, bool):
+        return b":%d\r\n" % int(value)
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, RedisError):
+        return b"-%s\r\n" % str(value).encode()
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(_reply(v) for v in value)
+    if isinstance(value, str):
+        return b"+%s\r\n" % value.encode()
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+class _StandInHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        store = self.server.store
+        while True:
+            try:
+                args = _read_reply(self.rfile)
+            except ConnectionError:
+                return
+            if not isinstance(args, list) or not args:
+                return
+            cmd = args[0].decode().upper()
+            rest = args[1:]
+
+            if cmd == "SUBSCRIBE":
+                channel = rest[0].decode()
+                self.wfile.write(_reply([b"subscribe", rest[0], 1]))
+                for message in store.subscribe(channel):
+                    try:
+                        self.wfile.write(_reply([b"message", rest[0], message]))
+                    except OSError:
+                        return
+                return
+            self.wfile.write(_reply(self._command(store, cmd, rest)))
+
+    def _command(self, store, cmd, rest):
+        # the store's prefix is "", keys arrive already prefixed
+        if cmd in ("PING",):
+            return "PONG"
+        if cmd in ("AUTH", "SELECT"):
+            return "OK"
+        if cmd == "GET":
+            return store.get(rest[0].decode())
+        if cmd == "SET":
+            key, value = rest[0].decode(), rest[1]
+            opts = [o.decode().upper() for o in rest[2:]]
+            ttl = None
+            if "PX" in opts:
+                ttl = int(opts[opts.index("PX") + 1]) / 1000
+            elif "EX" in opts:
+                ttl = int(opts[opts.index("EX") + 1])
+            if "NX" in opts:
+                return "OK" if store.set_nx(key, value, ttl) else None
+            store.set(key, value, ttl)
+            return "OK"
+        if cmd == "DEL":
+            return sum(store.delete(k.decode()) for k in rest)
+        if cmd in ("INCR", "INCRBY"):
+            return store.incr(rest[0].decode(), int(rest[1]) if len(rest) > 1 else 1)
+        if cmd == "PUBLISH":
+            return store.publish(rest[0].decode(), rest[1])
+        if cmd == "EVAL" and rest[0].decode() == RELEASE_SCRIPT:
+            return int(store.compare_delete(rest[2].decode(), rest[3]))
+        return RedisError(f"ERR unsupported command '{cmd}'")
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, _StandInHandler)
+        self.store = MemoryBackend()
+        self.store.prefix = ""
+#------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="shared backend tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve = sub.add_parser("serve", help="run the in-memory RESP stand-in")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=6390)
+    sub.add_parser("ping", help="check SHARED_BACKEND_URL")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        server = StandInServer((args.host, args.port))
+        print(f"[SHARED] stand-in listening on {args.host}:{args.port}")
+        server.serve_forever()
+    else:
+        backend = get_backend()
+        started = time.perf_counter()
+        backend.set("ping", "1", ttl_s=5)
+        ok = backend.get("ping") == b"1"
+        print(f"[SHARED] {'ok' if ok else 'FAILED'} in {(time.perf_counter() - started) * 1000:.1f} ms")
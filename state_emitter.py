@@ -0,0 +1,154 @@
+import os
+import time
+from threading import Thread, Condition
+from phase_2_queries import connect, build_npc_state, send_npc_state
+from structured_log import get_logger
+#------------------------------------------------------------------
+# Background npc_state_update emitter
+#
+# npc_interact used to run the state queries and emit before returning.
+# Now it only calls schedule(); a single worker thread:
+#   - debounces rapid turns per room (user, NPC)
+#   - never emits to a room faster than one per min_interval
+#   - reads every due room through ONE db connection per batch
+# Any schedule() that lands after a room's state was read re-queues it,
+# so the last state after the final turn is always delivered.
+#------------------------------------------------------------------
+STATE_DEBOUNCE_S     = float(os.getenv("NPC_STATE_DEBOUNCE_MS", "250")) / 1000
+STATE_MIN_INTERVAL_S = float(os.getenv("NPC_STATE_MIN_INTERVAL_MS", "1000")) / 1000
+STATE_MAX_WAIT_S     = float(os.getenv("NPC_STATE_MAX_WAIT_MS", "2000")) / 1000
+
+logger = get_logger("state")
+#------------------------------------------------------------------
+class StateEmitter:
+    def __init__(
+        self,
+        socketio,
+        debounce=STATE_DEBOUNCE_S,
+        min_interval=STATE_MIN_INTERVAL_S,
+        max_wait=STATE_MAX_WAIT_S
+    ):
+        self.socketio = socketio
+        self.debounce = debounce
+        self.min_interval = min_interval
+        self.max_wait = max_wait
+
+        self._pending = {}      # (idUser, idNPC) -> {"first", "due", "full"}
+        self._last_emit = {}    # (idUser, idNPC) -> monotonic time, last min_interval only
+        self._in_flight = 0
+        self._cond = Condition()
+        self._thread = None
+
+    # --------------------------------------------------
+    # called from the request thread (cheap, no db)
+    # --------------------------------------------------
+    def schedule(self, idUser, idNPC, full=False):
+        key = (idUser, idNPC)
+        now = time.monotonic()
+
+        with self._cond:
+            entry = self._pending.get(key)
+            first = entry["first"] if entry else now
+
+            # debounce: push back on every new turn, but never past max_wait
+            due = min(now + self.debounce, first + self.max_wait)
+            # rate limit: at most one emit per min_interval per room
+            due = max(due, self._last_emit.get(key, 0.0) + self.min_interval)
+
+            self._pending[key] = {
+                "first": first,
+                "due": due,
+                "full": full or (entry["full"] if entry else False)
+            }
+            self._ensure_worker()
+            self._cond.notify()
+
+    # --------------------------------------------------
+    # block until nothing is pending (shutdown / load tests)
+    # --------------------------------------------------
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            for entry in self._pending.values():
+                entry["due"] = 0.0
+            self._cond.notify()
+
+            while self._pending or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(timeout=remaining)
+        return True
+
+    # --------------------------------------------------
+    def _ensure_worker(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    ready = [k for k, e in self._pending.items() if e["due"] <= now]
+                    if ready:
+                        break
+                    wait = None
+                    if self._pending:
+                        wait = min(e["due"] for e in self._pending.values()) - now
+                    self._cond.wait(timeout=wait)
+
+                batch = {k: self._pending.pop(k) for k in ready}
+                self._in_flight = len(batch)
+
+            try:
+                self._emit_batch(batch)
+            except Exception as e:
+                logger.error("batch failed, requeueing", rooms=len(batch), error=str(e))
+                with self._cond:
+                    retry_at = time.monotonic() + self.min_interval
+                    for key, entry in batch.items():
+                        # a newer schedule() already supersedes this entry
+                        self._pending.setdefault(key, {
+                            "first": entry["first"],
+                            "due": retry_at,
+                            "full": entry["full"]
+                        })
+            finally:
+                with self._cond:
+                    now = time.monotonic()
+                    for key in batch:
+                        self._last_emit[key] = now
+                    self._prune_last_emit(now)
+                    self._in_flight = 0
+                    self._cond.notify_all()
+
+    def _prune_last_emit(self, now):
+        # past min_interval an entry no longer delays anything; dropping
+        # it keeps rooms of disconnected players from piling up
+        cutoff = now - self.min_interval
+        for key in [k for k, t in self._last_emit.items() if t <= cutoff]:
+            del self._last_emit[key]
+
+    def _emit_batch(self, batch):
+        # one connection for every room in the batch
+        db = connect()
+        try:
+            cursor = db.cursor(dictionary=True)
+            states = {
+                key: build_npc_state(cursor, key[0], key[1])
+                for key in batch
+            }
+            cursor.close()
+        finally:
+            db.close()
+
+        for (idUser, idNPC), state in states.items():
+            send_npc_state(
+                idUser,
+                idNPC,
+                state,
+                self.socketio,
+                full=batch[(idUser, idNPC)]["full"]
+            )
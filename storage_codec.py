@@ -0,0 +1,106 @@
+import json
+import os
+import zlib
+from threading import Lock
+from structured_log import get_logger
+try:
+    import zstandard
+except ImportError:     # optional: pip install zstandard
+    zstandard = None
+#------------------------------------------------------------------
+# Compressed column storage
+#
+# npc_user_memory.kbText and the npc_user_memory_buffer *Json columns
+# are LONGBLOBs holding  <header byte><payload>:
+#
+#   0x00  raw utf-8 (small values, or STORAGE_CODEC=none)
+#   0x01  zlib
+#   0x02  zstd (needs the zstandard package to read and write)
+#
+# Anything else is a legacy value written before the migration
+# (plain utf-8 text / JSON) and is returned as is, so reads work
+# before, during and after migrate_storage_codec.py.
+#------------------------------------------------------------------
+HEADER_RAW = b"\x00"
+HEADER_ZLIB = b"\x01"
+HEADER_ZSTD = b"\x02"
+
+STORAGE_CODEC = os.getenv("STORAGE_CODEC", "zstd" if zstandard else "zlib").lower()
+COMPRESS_MIN_BYTES = int(os.getenv("STORAGE_COMPRESS_MIN_BYTES", "256"))
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+if STORAGE_CODEC == "zstd" and zstandard is None:
+    get_logger("storage").warning("zstandard not installed, falling back to zlib")
+    STORAGE_CODEC = "zlib"
+
+_stats = {"encoded": 0, "raw_bytes": 0, "stored_bytes": 0, "decoded": 0}
+_stats_lock = Lock()
+#------------------------------------------------------------------
+def encode_bytes(raw: bytes, codec: str | None = None) -> bytes:
+    codec = codec or STORAGE_CODEC
+
+    if codec == "none" or len(raw) < COMPRESS_MIN_BYTES:
+        out = HEADER_RAW + raw
+    elif codec == "zstd":
+        out = HEADER_ZSTD + zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    else:
+        out = HEADER_ZLIB + zlib.compress(raw, ZLIB_LEVEL)
+
+    with _stats_lock:
+        _stats["encoded"] += 1
+        _stats["raw_bytes"] += len(raw)
+        _stats["stored_bytes"] += len(out)
+    return out
+
+def decode_bytes(stored) -> bytes:
+    stored = bytes(stored)
+    if not stored:
+        return b""
+
+    header, payload = stored[:1], stored[1:]
+    with _stats_lock:
+        _stats["decoded"] += 1
+
+    if header == HEADER_ZLIB:
+        return zlib.decompress(payload)
+    if header == HEADER_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("value is zstd-compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    if header == HEADER_RAW:
+        return payload
+    # legacy, uncompressed
+    return stored
+#------------------------------------------------------------------
+def encode_text(text: str | None, codec: str | None = None) -> bytes | None:
+    if text is None:
+        return None
+    return encode_bytes(text.encode("utf-8"), codec)
+
+def decode_text(stored) -> str | None:
+    """
+    Accepts str (un-migrated LONGTEXT), bytes / bytearray or None.
+    """
+    if stored is None or isinstance(stored, str):
+        return stored
+    return decode_bytes(stored).decode("utf-8")
+
+def encode_json(value, codec: str | None = None) -> bytes | None:
+    if value is None:
+        return None
+    return encode_text(json.dumps(value), codec)
+
+def decode_json(stored):
+    text = decode_text(stored)
+    return json.loads(text) if text else None
+
+def is_encoded(stored) -> bool:
+    return isinstance(stored, (bytes, bytearray)) and stored[:1] in (HEADER_RAW, HEADER_ZLIB, HEADER_ZSTD)
+
+def codec_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["codec"] = STORAGE_CODEC
+    stats["ratio"] = round(stats["stored_bytes"] / stats["raw_bytes"], 3) if stats["raw_bytes"] else 1.0
+    return stats
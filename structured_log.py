@@ -0,0 +1,177 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import time
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock
+#------------------------------------------------------------------
+# Leveled, structured, non-blocking logging
+#
+# Request threads only put records on a bounded queue; one listener
+# thread formats and writes them. When the queue is full records are
+# dropped (and counted) instead of blocking a turn.
+#
+#   log = get_logger("npc")
+#   log.info("turn done", idUser=1, ms=812)          -> key=value fields
+#   log.payload("prompt", "prompt built", prompt)    -> only if enabled
+#
+#   LOG_LEVEL=INFO            DEBUG | INFO | WARNING | ERROR
+#   LOG_FORMAT=text           text | json (one object per line)
+#   LOG_PAYLOADS=             comma list of request, response, prompt,
+#                             memory, model_output -- or "all". Payloads
+#                             are full texts (requests, prompts, 350 KB
+#                             memories), logged at DEBUG and cut to
+#                             LOG_PAYLOAD_CHARS.
+#   LOG_SAMPLE=               "<logger>=<rate>,..." keep only that share
+#                             of DEBUG/INFO records of a logger, e.g.
+#                             "tts=0.01,retrieval=0.1". WARNING and up
+#                             are never sampled.
+#------------------------------------------------------------------
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_PAYLOADS = {p.strip() for p in os.getenv("LOG_PAYLOADS", "").split(",") if p.strip()}
+LOG_PAYLOAD_CHARS = int(os.getenv("LOG_PAYLOAD_CHARS", "2000"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "")
+
+ROOT = "camo"
+_RESERVED = {"exc_info", "stack_info", "stacklevel", "extra"}
+
+_setup_lock = Lock()
+_listener = None
+_handler = None
+#------------------------------------------------------------------
+def payload_enabled(kind: str) -> bool:
+    return "all" in LOG_PAYLOADS or kind in LOG_PAYLOADS
+
+def _truncate(value) -> str:
+    text = value if isinstance(value, str) else json.dumps(value, default=str)
+    if len(text) > LOG_PAYLOAD_CHARS:
+        return text[:LOG_PAYLOAD_CHARS] + f"... [{len(text) - LOG_PAYLOAD_CHARS} more chars]"
+    return text
+
+def _parse_sample(spec: str) -> dict:
+    rates = {}
+    for part in spec.split(","):
+        if "=" in part:
+            name, rate = part.split("=", 1)
+            rates[f"{ROOT}.{name.strip()}"] = float(rate)
+    return rates
+#------------------------------------------------------------------
+class _SampleFilter(logging.Filter):
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self.rates.get(record.name)
+        return rate is None or random.random() < rate
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """
+    Never blocks: drops the record when the queue is full. Formatting
+    is left to the listener thread; only the message is resolved here.
+    """
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _format_value(v) -> str:
+    text = v if isinstance(v, str) else json.dumps(v, default=str, separators=(",", ":"))
+    return json.dumps(text) if (" " in text or "\n" in text or not text) else text
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record):
+        ts = time.strftime("%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}"
+        name = record.name[len(ROOT) + 1:] if record.name.startswith(ROOT + ".") else record.name
+        fields = getattr(record, "fields", None) or {}
+        line = f"{ts} {record.levelname:<7} [{name}] {record.msg}"
+        if fields:
+            line += " " + " ".join(f"{k}={_format_value(v)}" for k, v in fields.items())
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        out = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.msg,
+            "thread": record.threadName,
+        }
+        out.update(getattr(record, "fields", None) or {})
+        if record.exc_text:
+            out["exc"] = record.exc_text
+        return json.dumps(out, default=str)
+#------------------------------------------------------------------
+class StructLogger(logging.LoggerAdapter):
+    """
+    Keyword arguments other than the logging ones become fields.
+    """
+    def process(self, msg, kwargs):
+        fields = {k: kwargs.pop(k) for k in list(kwargs) if k not in _RESERVED}
+        extra = dict(kwargs.get("extra") or {})
+        extra["fields"] = fields
+        kwargs["extra"] = extra
+        return msg, kwargs
+
+    def payload(self, kind: str, msg: str, value, **fields):
+        if payload_enabled(kind) and self.isEnabledFor(logging.DEBUG):
+            self.debug(msg, payload_kind=kind, payload=_truncate(value), **fields)
+
+
+def setup_logging():
+    global _listener, _handler
+    with _setup_lock:
+        if _listener is not None:
+            return
+
+        out = logging.StreamHandler()
+        out.setFormatter(_JsonFormatter() if LOG_FORMAT == "json" else _TextFormatter())
+
+        q = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        _handler = _DroppingQueueHandler(q)
+        _handler.addFilter(_SampleFilter(_parse_sample(LOG_SAMPLE)))
+
+        root = logging.getLogger(ROOT)
+        root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+        root.addHandler(_handler)
+        root.propagate = False
+
+        _listener = QueueListener(q, out)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+def get_logger(name: str) -> StructLogger:
+    setup_logging()
+    return StructLogger(logging.getLogger(f"{ROOT}.{name}"), {})
+
+def log_stats() -> dict:
+    if _handler is None:
+        return {}
+    return {"queued": _handler.queue.qsize(), "dropped": _handler.dropped}
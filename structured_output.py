@@ -0,0 +1,400 @@
+import ast
+import json
+import os
+from collections import Counter
+from threading import Lock
+from telemetry import inc
+from structured_log import get_logger
+#------------------------------------------------------------------
+# JSON from model output
+#
+#   parse_model_json(resp, stage, fallback)
+#
+# 1. one pass over the text finds the top-level {...} spans, skipping
+#    braces inside strings (prose, ```json fences and a second object
+#    after the first no longer break the slice)
+# 2. each span is tried with json.loads, then after repair:
+#      trailing commas, 'single quoted' strings, True/False/None,
+#      unquoted keys, raw newlines in strings, // and /* */ comments,
+#      output cut off by max_tokens (open strings / brackets are
+#      closed)
+#    and last with ast.literal_eval (Python dict reprs)
+# 3. the object is checked against SCHEMAS[stage]: a missing or
+#    mistyped field takes its value from `fallback` instead of the
+#    whole result being thrown away
+#
+# Every call is counted per stage and outcome (llm_json_total):
+#   ok        parsed as is
+#   repaired  parsed after repair
+#   partial   some fields came from the fallback
+#   failed    nothing usable, whole fallback returned
+#
+# LLM_JSON_MODE asks the provider for JSON output (response_format):
+#   ""        off
+#   "all"     every stage
+#   "a,b"     only these stages
+#   "auto"    a stage switches to JSON mode once its failure rate is
+#             >= LLM_JSON_AUTO_RATE over at least LLM_JSON_AUTO_MIN calls
+#------------------------------------------------------------------
+LLM_JSON_MODE = os.getenv("LLM_JSON_MODE", "").strip().lower()
+LLM_JSON_AUTO_RATE = float(os.getenv("LLM_JSON_AUTO_RATE", "0.05"))
+LLM_JSON_AUTO_MIN = int(os.getenv("LLM_JSON_AUTO_MIN", "20"))
+
+# models that reject response_format
+JSON_MODE_UNSUPPORTED = {"deepseek-reasoner"}
+
+NUMBER = "number"
+BOOL = "bool"
+
+SCHEMAS = {
+    "classify_player": {
+        "sentiment": frozenset({"positive", "neutral", "negative", "hostile", "affectionate"}),
+        "intensity": NUMBER,
+        "offensive": BOOL,
+        "emotion": frozenset({"happy", "sad", "angry", "afraid", "calm", "excited", "disgusted"}),
+        "target": frozenset({"npc", "self", "environment", "none"}),
+    },
+    "persona_clues": {
+        "current_emotion": (dict, type(None)),
+        "moral_alignment": (dict, type(None)),
+        "age": (dict, type(None)),
+        "gender": (dict, type(None)),
+        "life_story": (dict, type(None)),
+        "personality_traits": list,
+        "secrets": list,
+        "goals": list,
+        "likes": list,
+        "dislikes": list,
+    },
+    "self_beliefs": {
+        "beliefs": list,
+    },
+    "npc_reaction": {
+        "emotion": frozenset({"happy", "sad", "angry", "afraid", "calm", "excited", "disgusted"}),
+        "intensity": NUMBER,
+    },
+    "kb_patch": {
+        "new_scene": (dict, type(None)),
+        "beliefs_in_play": (dict, list, str, type(None)),
+        "compress": (dict, list, type(None)),
+        "episodes": (list, type(None)),
+    },
+}
+
+OUTCOMES = ("ok", "repaired", "partial", "failed")
+
+_PY_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_CLOSERS = {"{": "}", "[": "]"}
+_OPENS_VALUE = "{[,:"
+
+_stats = {}         # stage -> Counter(outcome)
+_stats_lock = Lock()
+
+logger = get_logger("json")
+#------------------------------------------------------------------
+# scanning / repair
+#------------------------------------------------------------------
+def _comment_end(text: str, i: int) -> int:
+    """
+    Index after the // or /* */ comment starting at i, or i when
+    there is none.
+    """
+    if text.startswith("//", i):
+        end = text.find("\n", i)
+        return len(text) if end < 0 else end
+    if text.startswith("/*", i):
+        end = text.find("*/", i + 2)
+        return len(text) if end < 0 else end + 2
+    return i
+
+
+def _object_spans(text: str):
+    """
+    Yields (span, complete) for each top-level {...} in one pass. A
+    quote only opens a string where a JSON value or key can start, so
+    apostrophes in prose around the object are ignored. An object
+    still open at the end of the text is yielded with complete=False.
+    """
+    start = None
+    depth = 0
+    quote = None
+    escape = False
+    last = ""
+    skip_to = 0
+
+    for i, ch in enumerate(text):
+        if i < skip_to:
+            continue
+        if quote:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == quote:
+                quote = None
+                last = ch
+            continue
+
+        if start is None:
+            if ch == "{":
+                start, depth, last = i, 1, ch
+            continue
+
+        if ch == "/":
+            skip_to = _comment_end(text, i)
+            if skip_to > i:
+                continue
+
+        if ch == '"' or (ch == "'" and last in _OPENS_VALUE):
+            quote = ch
+        elif ch in "{[":
+            depth += 1
+        elif ch in "}]":
+            depth -= 1
+            if depth == 0:
+                yield text[start:i + 1], True
+                start = None
+                continue
+        if not ch.isspace():
+            last = ch
+
+    if start is not None:
+        yield text[start:], False
+
+
+def repair_json(text: str) -> str:
+    """
+    Rewrites the usual model defects into valid JSON in one pass. Open
+    strings and brackets at the end (truncated output) are closed.
+    """
+    out = []
+    stack = []
+    last = ""
+    i, n = 0, len(text)
+
+    while i < n:
+        ch = text[i]
+
+        if ch == "/" and _comment_end(text, i) > i:
+            i = _comment_end(text, i)
+            continue
+
+        if ch == '"' or (ch == "'" and last in _OPENS_VALUE):
+            buf = []
+            j = i + 1
+            while j < n and text[j] != ch:
+                c = text[j]
+                if c == "\\" and j + 1 < n:
+                    buf.append("'" if text[j + 1] == "'" else text[j:j + 2])
+                    j += 2
+                    continue
+                if c == '"':
+                    buf.append('\\"')
+                elif c == "\n":
+                    buf.append("\\n")
+                elif c == "\t":
+                    buf.append("\\t")
+                else:
+                    buf.append(c)
+                j += 1
+            out.append('"' + "".join(buf) + '"')
+            last = '"'
+            i = j + 1
+            continue
+
+        if ch == ",":
+            k = i + 1
+            while k < n and (text[k].isspace() or _comment_end(text, k) > k):
+                k = k + 1 if text[k].isspace() else _comment_end(text, k)
+            if k >= n or text[k] in "}]":
+                i += 1          # trailing comma
+                continue
+
+        if ch.isalpha() or ch == "_":
+            k = i
+            while k < n and (text[k].isalnum() or text[k] == "_"):
+                k += 1
+            word = text[i:k]
+            j = k
+            while j < n and text[j].isspace():
+                j += 1
+            if j < n and text[j] == ":" and last in "{,":
+                out.append(json.dumps(word))        # unquoted key
+            else:
+                out.append(_PY_LITERALS.get(word, word))
+            last = word[-1]
+            i = k
+            continue
+
+        if ch in "{[":
+            stack.append(_CLOSERS[ch])
+        elif ch in "}]" and stack:
+            stack.pop()
+
+        out.append(ch)
+        if not ch.isspace():
+            last = ch
+        i += 1
+
+    if stack:
+        while out and (out[-1].isspace() or out[-1] in ",:"):
+            out.pop()
+        out.extend(reversed(stack))
+    return "".join(out)
+
+
+def extract_json(text: str):
+    """
+    (object, repaired) for the first usable JSON object in text.
+    Raises ValueError when there is none.
+    """
+    text = (text or "").strip()
+    if text.startswith("{"):
+        try:
+            value = json.loads(text)
+            if isinstance(value, dict):
+                return value, False
+        except ValueError:
+            pass
+
+    for span, complete in _object_spans(text):
+        if complete:
+            try:
+                value = json.loads(span)
+                if isinstance(value, dict):
+                    return value, False
+            except ValueError:
+                pass
+        try:
+            value = json.loads(repair_json(span))
+            if isinstance(value, dict):
+                return value, True
+        except ValueError:
+            pass
+        if complete:
+            try:
+                value = ast.literal_eval(span)
+                if isinstance(value, dict):
+                    return value, True
+            except (ValueError, SyntaxError, MemoryError, RecursionError):
+                pass
+
+    raise ValueError("no JSON object in model output")
+#------------------------------------------------------------------
+# schema check
+#------------------------------------------------------------------
+def _coerce(value, spec):
+    """
+    (ok, value) for one field.
+    """
+    if spec == NUMBER:
+        if isinstance(value, bool):
+            return False, value
+        if isinstance(value, (int, float)):
+            return True, value
+        try:
+            return True, float(str(value).strip())
+        except ValueError:
+            return False, value
+    if spec == BOOL:
+        if isinstance(value, bool):
+            return True, value
+        text = str(value).strip().lower()
+        if text in ("true", "yes", "1"):
+            return True, True
+        if text in ("false", "no", "0"):
+            return True, False
+        return False, value
+    if isinstance(spec, frozenset):
+        text = str(value).strip().lower() if value is not None else ""
+        return text in spec, text
+    return isinstance(value, spec), value
+
+
+def validate(data: dict, schema: dict, fallback) -> tuple[dict, int]:
+    """
+    (result, fields taken from fallback). Keys outside the schema are
+    dropped; a missing nullable field is None.
+    """
+    defaults = fallback if isinstance(fallback, dict) else {}
+    result = {}
+    replaced = 0
+    for key, spec in schema.items():
+        if key in data:
+            ok, value = _coerce(data[key], spec)
+            if ok:
+                result[key] = value
+                continue
+        elif isinstance(spec, tuple) and type(None) in spec:
+            result[key] = None      # optional field
+            continue
+        if key in defaults or not isinstance(fallback, dict):
+            result[key] = defaults.get(key)
+        replaced += 1
+    return result, replaced
+#------------------------------------------------------------------
+def _count(stage: str, outcome: str):
+    with _stats_lock:
+        _stats.setdefault(stage, Counter())[outcome] += 1
+    inc("llm_json_total", stage=stage, outcome=outcome)
+
+def json_stats() -> dict:
+    with _stats_lock:
+        out = {}
+        for stage, c in _stats.items():
+            total = sum(c.values())
+            out[stage] = {**{o: c[o] for o in OUTCOMES}, "failure_rate": round(c["failed"] / total, 4)}
+        return out
+
+def json_mode(stage: str, model: str) -> dict:
+    """
+    Extra chat_completion kwargs for `stage` ({} = plain text output).
+    """
+    if not LLM_JSON_MODE or model in JSON_MODE_UNSUPPORTED:
+        return {}
+    if LLM_JSON_MODE == "auto":
+        with _stats_lock:
+            c = _stats.get(stage)
+            total = sum(c.values()) if c else 0
+            on = total >= LLM_JSON_AUTO_MIN and c["failed"] / total >= LLM_JSON_AUTO_RATE
+    else:
+        on = LLM_JSON_MODE == "all" or stage in {s.strip() for s in LLM_JSON_MODE.split(",")}
+    return {"response_format": {"type": "json_object"}} if on else {}
+
+def parse_model_json(resp, stage: str, fallback):
+    """
+    The JSON object in a chat completion, checked against SCHEMAS[stage].
+    Returns `fallback` when nothing usable comes back (resp None: the
+    call itself gave up, not counted as a parse failure).
+    """
+    if resp is None:
+        return fallback
+    try:
+        raw = resp.choices[0].message.content or ""
+    except (AttributeError, IndexError):
+        raw = ""
+
+    try:
+        data, repaired = extract_json(raw)
+    except ValueError:
+        _count(stage, "failed")
+        logger.warning("JSON parse failure", stage=stage, chars=len(raw))
+        logger.payload("model_output", "unparseable model output", raw, stage=stage)
+        return fallback
+
+    schema = SCHEMAS.get(stage)
+    replaced = 0
+    if schema:
+        if not any(key in data for key in schema):
+            _count(stage, "failed")
+            logger.warning("JSON has none of the schema fields", stage=stage, keys=list(data)[:10])
+            logger.payload("model_output", "off-schema model output", raw, stage=stage)
+            return fallback
+        data, replaced = validate(data, schema, fallback)
+
+    if replaced:
+        _count(stage, "partial")
+        logger.debug("JSON fields from fallback", stage=stage, fields=replaced)
+    else:
+        _count(stage, "repaired" if repaired else "ok")
+    return data
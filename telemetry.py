@@ -0,0 +1,451 @@
+import json
+import os
+import re
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock, local
+from structured_log import get_logger
+from circuit_breaker import llm_breaker, provider_name, CircuitOpen
+from llm_scheduler import get_scheduler, current_user, estimate_prompt_tokens, PRIORITIES, stage_priority
+#------------------------------------------------------------------
+# Turn tracing + Prometheus metrics
+#
+# npc_interact opens a TurnTrace and marks its numbered stages with
+# trace.stage("classify"), ...; every LLM call made through
+# chat_completion() and every statement run on a connect()ion is
+# recorded as a span of the turn running on that thread (background
+# work -- consolidation, state emits -- only feeds the metrics).
+#
+#   GET /metrics              Prometheus text format
+#   GET /traces?idUser=&limit= last TRACE_KEEP turn traces (JSON)
+#   TRACE_FILE=traces.ndjson  also append every trace to a file
+#------------------------------------------------------------------
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", "200"))
+TRACE_FILE = os.getenv("TRACE_FILE")
+TRACE_SQL_CHARS = 200
+
+logger = get_logger("trace")
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRIC_HELP = {
+    "npc_turn_seconds": ("histogram", "npc_interact wall time"),
+    "npc_stage_seconds": ("histogram", "npc_interact stage wall time"),
+    "llm_request_seconds": ("histogram", "LLM call wall time (streams: until the last chunk)"),
+    "llm_ttft_seconds": ("histogram", "LLM stream time to first token"),
+    "llm_queue_seconds": ("histogram", "time an LLM call waited for the scheduler (llm_scheduler.py)"),
+    "llm_tokens_total": ("counter", "LLM tokens by direction (in = prompt, out = completion)"),
+    "llm_errors_total": ("counter", "LLM calls that raised"),
+    "llm_json_total": ("counter", "JSON model outputs by outcome (ok, repaired, partial, failed)"),
+    "llm_hedge_total": ("counter", "classifier calls by hedging event (call, hedged, primary_won, hedge_won, deadline)"),
+    "db_query_seconds": ("histogram", "SQL statement execution time"),
+    "db_rows_total": ("counter", "rows fetched or affected"),
+    "tts_seconds": ("histogram", "TTS clip time (cache or provider)"),
+}
+
+_metrics = {}       # name -> {labels tuple -> value | [bucket counts..., sum, count]}
+_metrics_lock = Lock()
+_collectors = []    # (prefix, fn -> dict)
+
+_local = local()
+_traces = deque(maxlen=TRACE_KEEP)
+_traces_lock = Lock()
+#------------------------------------------------------------------
+# metrics
+#------------------------------------------------------------------
+def _key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def inc(name: str, amount: float = 1, **labels):
+    with _metrics_lock:
+        series = _metrics.setdefault(name, {})
+        k = _key(labels)
+        series[k] = series.get(k, 0) + amount
+
+def observe(name: str, value: float, **labels):
+    with _metrics_lock:
+        series = _metrics.setdefault(name, {})
+        k = _key(labels)
+        h = series.get(k)
+        if h is None:
+            h = series[k] = [0] * len(SECONDS_BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(SECONDS_BUCKETS):
+            if value <= bound:
+                h[i] += 1
+        h[-2] += value
+        h[-1] += 1
+
+def register_gauges(prefix: str, fn):
+    """
+    fn() -> dict of numbers (nested dicts are flattened), exported as
+    gauges <prefix>_<key> on every scrape.
+    """
+    _collectors.append((prefix, fn))
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+def _fmt_labels(key, extra=None) -> str:
+    pairs = list(key) + (extra or [])
+    if not pairs:
+        return ""
+    body = ",".join(
+        f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for k, v in pairs
+    )
+    return "{" + body + "}"
+
+def _flatten(prefix, value, out):
+    if isinstance(value, bool):
+        out[prefix] = int(value)
+    elif isinstance(value, (int, float)):
+        out[prefix] = value
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            _flatten(f"{prefix}_{k}", v, out)
+
+def render_metrics() -> str:
+    lines = []
+    with _metrics_lock:
+        snapshot = {name: {k: (list(v) if isinstance(v, list) else v) for k, v in s.items()}
+                    for name, s in _metrics.items()}
+
+    for name in sorted(snapshot):
+        kind, help_text = METRIC_HELP.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for key, value in sorted(snapshot[name].items()):
+            if kind != "histogram":
+                lines.append(f"{name}{_fmt_labels(key)} {value}")
+                continue
+            for bound, count in zip(SECONDS_BUCKETS, value):
+                lines.append(f"{name}_bucket{_fmt_labels(key, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{_fmt_labels(key, [('le', '+Inf')])} {value[-1]}")
+            lines.append(f"{name}_sum{_fmt_labels(key)} {round(value[-2], 6)}")
+            lines.append(f"{name}_count{_fmt_labels(key)} {value[-1]}")
+
+    for prefix, fn in _collectors:
+        try:
+            flat = {}
+            _flatten(prefix, fn(), flat)
+        except Exception as e:
+            logger.error("metrics collector failed", prefix=prefix, error=str(e))
+            continue
+        for name, value in sorted(flat.items()):
+            name = _metric_name(name)
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
+#------------------------------------------------------------------
+# turn traces
+#------------------------------------------------------------------
+class TurnTrace:
+    def __init__(self, idUser, idNPC):
+        self.record = {
+            "turnId": uuid.uuid4().hex[:12],
+            "idUser": idUser,
+            "idNPC": idNPC,
+            "startedAt": time.time(),
+            "stages": [],
+            "spans": []
+        }
+        self._t0 = time.perf_counter()
+        self._stage = None      # (name, started)
+
+    def _offset_ms(self, t):
+        return round((t - self._t0) * 1000, 2)
+
+    def stage(self, name: str):
+        """
+        Close the running stage (if any) and start the next one.
+        """
+        now = time.perf_counter()
+        self._close_stage(now)
+        self._stage = (name, now)
+
+    def _close_stage(self, now):
+        if self._stage is None:
+            return
+        name, started = self._stage
+        self._stage = None
+        seconds = now - started
+        observe("npc_stage_seconds", seconds, stage=name)
+        self.record["stages"].append({
+            "stage": name,
+            "startMs": self._offset_ms(started),
+            "ms": round(seconds * 1000, 2)
+        })
+
+    def add_span(self, kind, name, started, seconds, **attrs):
+        span = {
+            "kind": kind,
+            "name": name,
+            "stage": self._stage[0] if self._stage else None,
+            "startMs": self._offset_ms(started),
+            "ms": round(seconds * 1000, 2)
+        }
+        span.update(attrs)
+        self.record["spans"].append(span)
+        return span
+
+    def end(self, status: str = "ok") -> dict:
+        now = time.perf_counter()
+        self._close_stage(now)
+        seconds = now - self._t0
+        observe("npc_turn_seconds", seconds, status=status)
+
+        self.record["status"] = status
+        self.record["totalMs"] = round(seconds * 1000, 2)
+        if getattr(_local, "trace", None) is self:
+            _local.trace = None
+
+        with _traces_lock:
+            _traces.append(self.record)
+        if TRACE_FILE:
+            try:
+                with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(self.record, default=str) + "\n")
+            except OSError as e:
+                logger.error("could not write trace file", path=TRACE_FILE, error=str(e))
+
+        logger.info(
+            "turn", turnId=self.record["turnId"],
+            idUser=self.record["idUser"], idNPC=self.record["idNPC"],
+            status=status, total_ms=round(self.record["totalMs"]),
+            stages={s["stage"]: round(s["ms"]) for s in self.record["stages"]}
+        )
+        return self.record
+
+
+def start_turn(idUser, idNPC) -> TurnTrace:
+    trace = TurnTrace(idUser, idNPC)
+    _local.trace = trace
+    return trace
+
+def current_trace() -> TurnTrace | None:
+    return getattr(_local, "trace", None)
+
+@contextmanager
+def use_trace(trace: TurnTrace | None):
+    """
+    Record spans of a helper thread (pool work done for a turn) into
+    that turn's trace.
+    """
+    previous = getattr(_local, "trace", None)
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+def recent_traces(idUser=None, limit: int = 20) -> list[dict]:
+    with _traces_lock:
+        traces = list(_traces)
+    if idUser is not None:
+        traces = [t for t in traces if str(t["idUser"]) == str(idUser)]
+    return traces[-limit:]
+
+@contextmanager
+def span(kind: str, name: str, metric: str | None = None, **attrs):
+    """
+    Time a block: observed into `metric` (labelled name=...) and added
+    to the current turn trace, if any. Yields the attrs dict so the
+    block can add to it.
+    """
+    started = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        seconds = time.perf_counter() - started
+        if metric:
+            observe(metric, seconds, name=name)
+        trace = current_trace()
+        if trace:
+            trace.add_span(kind, name, started, seconds, **attrs)
+#------------------------------------------------------------------
+# LLM calls
+#------------------------------------------------------------------
+def _record_usage(stage, model, usage):
+    if usage is None:
+        return {}
+    tokens_in = getattr(usage, "prompt_tokens", 0) or 0
+    tokens_out = getattr(usage, "completion_tokens", 0) or 0
+    inc("llm_tokens_total", tokens_in, stage=stage, model=model, direction="in")
+    inc("llm_tokens_total", tokens_out, stage=stage, model=model, direction="out")
+    return {"tokensIn": tokens_in, "tokensOut": tokens_out}
+
+def _finish_llm(stage, model, started, attrs):
+    seconds = time.perf_counter() - started
+    observe("llm_request_seconds", seconds, stage=stage, model=model)
+    trace = current_trace()
+    if trace:
+        trace.add_span("llm", stage, started, seconds, model=model, **attrs)
+
+def chat_completion(client, stage: str, **kwargs):
+    """
+    client.chat.completions.create(**kwargs), timed and counted under
+    `stage`. Streams are wrapped so time to first token and the usage
+    chunk are recorded as they are consumed. Raises CircuitOpen while
+    the provider / model breaker is open.
+
+    The call first waits for the provider's scheduler; a `timeout`
+    kwarg bounds queue wait + request together.
+    """
+    model = kwargs.get("model", "unknown")
+    breaker = llm_breaker(client, model)
+    breaker.reject_if_open()
+
+    trace = current_trace()
+    grant = get_scheduler(provider_name(client), **getattr(client, "scheduler_limits", {})).acquire(
+        stage,
+        user=trace.record["idUser"] if trace else current_user(),
+        prompt_tokens=estimate_prompt_tokens(kwargs.get("messages")),
+        timeout=kwargs.get("timeout")
+    )
+    # a half-open probe slot is taken only once the call can go out; a
+    # QueueTimeout above must not hold it for another open_s
+    try:
+        breaker.check()
+    except CircuitOpen:
+        grant.release()
+        raise
+    observe("llm_queue_seconds", grant.queued_s, stage=stage, priority=PRIORITIES[stage_priority(stage)])
+    if kwargs.get("timeout") is not None:
+        kwargs["timeout"] = max(0.1, kwargs["timeout"] - grant.queued_s)
+
+    # offline clients (mock_provider) answer by stage
+    create_kwargs = {**kwargs, "stage": stage} if getattr(client, "takes_stage", False) else kwargs
+
+    started = time.perf_counter()
+    try:
+        resp = client.chat.completions.create(**create_kwargs)
+    except Exception as e:
+        grant.release()
+        breaker.failure(e)
+        inc("llm_errors_total", stage=stage, model=model)
+        _finish_llm(stage, model, started, {"error": type(e).__name__, "queueMs": round(grant.queued_s * 1000, 2)})
+        raise
+
+    if kwargs.get("stream"):
+        return _instrumented_stream(resp, stage, model, started, breaker, grant)
+
+    grant.release()
+    breaker.success()
+    attrs = _record_usage(stage, model, getattr(resp, "usage", None))
+    attrs["queueMs"] = round(grant.queued_s * 1000, 2)
+    _finish_llm(stage, model, started, attrs)
+    return resp
+
+def _instrumented_stream(resp, stage, model, started, breaker, grant):
+    attrs = {"queueMs": round(grant.queued_s * 1000, 2)}
+    try:
+        for chunk in resp:
+            if "ttftMs" not in attrs and chunk.choices and getattr(chunk.choices[0].delta, "content", None):
+                ttft = time.perf_counter() - started
+                observe("llm_ttft_seconds", ttft, stage=stage, model=model)
+                attrs["ttftMs"] = round(ttft * 1000, 2)
+            if getattr(chunk, "usage", None):
+                attrs.update(_record_usage(stage, model, chunk.usage))
+            yield chunk
+    except Exception as e:
+        breaker.failure(e)
+        inc("llm_errors_total", stage=stage, model=model)
+        attrs["error"] = type(e).__name__
+        raise
+    else:
+        breaker.success()
+    finally:
+        grant.release()
+        _finish_llm(stage, model, started, attrs)
+#------------------------------------------------------------------
+# DB calls
+#------------------------------------------------------------------
+_TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+`?(?:\w+`?\.`?)?(\w+)", re.IGNORECASE)
+
+def statement_label(sql: str) -> str:
+    """
+    "<VERB> <first table>", low-cardinality name for a statement.
+    """
+    sql = " ".join(str(sql).split())
+    verb = sql.split(" ", 1)[0].upper() if sql else "?"
+    m = _TABLE_RE.search(sql)
+    return f"{verb} {m.group(1)}" if m else verb
+
+
+class _InstrumentedCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._label = None
+        self._span = None
+
+    def _run(self, method, operation, *args, **kwargs):
+        label = statement_label(operation)
+        started = time.perf_counter()
+        try:
+            return getattr(self._cursor, method)(operation, *args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - started
+            observe("db_query_seconds", seconds, statement=label)
+            self._label = label
+            self._span = None
+            rows = None
+            if not getattr(self._cursor, "with_rows", False):
+                rows = max(0, self._cursor.rowcount or 0)
+                inc("db_rows_total", rows, statement=label)
+            trace = current_trace()
+            if trace:
+                self._span = trace.add_span(
+                    "db", label, started, seconds,
+                    sql=" ".join(str(operation).split())[:TRACE_SQL_CHARS],
+                    rows=rows
+                )
+
+    def execute(self, operation, *args, **kwargs):
+        return self._run("execute", operation, *args, **kwargs)
+
+    def executemany(self, operation, *args, **kwargs):
+        return self._run("executemany", operation, *args, **kwargs)
+
+    def _fetched(self, n):
+        if self._label and n:
+            inc("db_rows_total", n, statement=self._label)
+            if self._span is not None:
+                self._span["rows"] = (self._span["rows"] or 0) + n
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        self._fetched(1 if row is not None else 0)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._fetched(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._fetched(len(rows))
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _InstrumentedConnection:
+    def __init__(self, db):
+        self._db = db
+
+    def cursor(self, *args, **kwargs):
+        return _InstrumentedCursor(self._db.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+def instrument_connection(db):
+    return _InstrumentedConnection(db)
@@ -0,0 +1,77 @@
+import pytest
+from belief_index import BeliefIndex, canonicalize, contradicts, similarity
+
+NEGATED_PAIRS = [
+    ("trustworthy", "not trustworthy"),
+    ("afraid of the dark", "not afraid of the dark"),
+    ("comfortable around strangers", "uncomfortable around strangers"),
+    ("honest", "dishonest"),
+    ("patient", "impatient"),
+    ("responsible", "irresponsible"),
+    ("violent", "non-violent"),
+    ("reliable", "never reliable"),
+]
+
+
+@pytest.mark.parametrize("a, b", NEGATED_PAIRS)
+def test_negated_pairs_contradict(a, b):
+    assert contradicts(a, b)
+    assert contradicts(b, a)
+
+
+@pytest.mark.parametrize("a, b", NEGATED_PAIRS)
+def test_negated_pairs_are_not_merged(a, b):
+    index = BeliefIndex()
+    scope = ("user", 1, 1)
+    stored = index.resolve(scope, "personality_trait", a)
+    assert index.resolve(scope, "personality_trait", b) != stored
+
+
+def test_negation_merges_with_its_own_duplicate():
+    index = BeliefIndex()
+    scope = ("user", 1, 1)
+    index.resolve(scope, "personality_trait", "trustworthy")
+    negated = index.resolve(scope, "personality_trait", "not trustworthy")
+    assert index.resolve(scope, "personality_trait", "Not trustworthy ") == negated
+
+
+def test_near_duplicates_merge():
+    index = BeliefIndex()
+    scope = ("self", 1)
+    stored = index.resolve(scope, "personality_trait", "brave")
+    assert index.resolve(scope, "personality_trait", "Brave ") == stored
+    assert index.resolve(scope, "personality_trait", "courageous") == stored
+    assert index.resolve(scope, "personality_trait", "seems to be brave") == stored
+
+
+def test_threshold_holds_without_negation():
+    assert similarity("trustworthy", "not trustworthy") > 0.8
+    assert not contradicts("kind", "kindly")
+
+
+def test_canonicalize_snake_cases_traits_only():
+    assert canonicalize("Seems to be Kind-Hearted") == "kind"
+    assert canonicalize("Afraid of the dark", "personality_traits") == "afraid_of_the_dark"
+    assert canonicalize("Find the lost  map", "goal") == "Find the lost map"
+    assert canonicalize("Old jazz records", "likes") == "Old jazz records"
+    assert canonicalize("is hiding a letter", "secrets") == "is hiding a letter"
+
+
+def test_types_are_kept_apart():
+    index = BeliefIndex()
+    scope = ("user", 1, 1)
+    index.resolve(scope, "likes", "old jazz records")
+    assert index.resolve(scope, "dislikes", "Old jazz records") == "Old jazz records"
+
+
+def test_least_recently_used_scope_is_dropped():
+    index = BeliefIndex(max_scopes=2)
+    index.resolve(("user", 1, 1), "personality_trait", "brave")
+    index.resolve(("user", 1, 2), "personality_trait", "brave")
+    index.nearest(("user", 1, 1), "personality_trait", "brave")     # touch
+    index.resolve(("user", 1, 3), "personality_trait", "brave")
+    assert list(index._scopes) == [("user", 1, 1), ("user", 1, 3)]
+
+    # sync() brings a dropped scope back from the stored rows
+    index.sync(("user", 1, 2), [{"beliefType": "personality_trait", "beliefValue": "brave"}])
+    assert index.resolve(("user", 1, 2), "personality_trait", "courageous") == "brave"
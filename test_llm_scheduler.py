@@ -0,0 +1,104 @@
+import time
+from collections import deque
+import pytest
+import llm_scheduler
+from llm_scheduler import LLMScheduler, QueueTimeout, TokenBucket, _Waiter, stage_priority
+
+
+def enqueue(scheduler, stage, user, age_s=0.0):
+    waiter = _Waiter(stage_priority(stage), user, 0)
+    waiter.enqueued -= age_s
+    scheduler.queues[waiter.priority].setdefault(user, deque()).append(waiter)
+    return waiter
+
+
+def grant_order(scheduler, waiters):
+    """
+    Waiters in the order they are granted, one slot at a time.
+    """
+    order = []
+    while len(order) < len(waiters):
+        with scheduler._cond:
+            scheduler._dispatch()
+        granted = [w for w in waiters if w.granted_at is not None and w not in order]
+        assert len(granted) == 1
+        order.append(granted[0])
+        scheduler._release(granted[0].priority)
+    return order
+
+
+def test_best_class_first():
+    s = LLMScheduler("t", rps=0, tpm=0, max_concurrent=1)
+    kb = enqueue(s, "kb_patch", "1")
+    post = enqueue(s, "self_beliefs", "1")
+    pre = enqueue(s, "classify_player", "1")
+    stream = enqueue(s, "npc_response", "1")
+    assert grant_order(s, [kb, post, pre, stream]) == [stream, pre, post, kb]
+
+
+def test_round_robin_inside_a_class():
+    s = LLMScheduler("t", rps=0, tpm=0, max_concurrent=1)
+    a1, a2, a3 = (enqueue(s, "classify_player", "a") for _ in range(3))
+    b1 = enqueue(s, "persona_clues", "b")
+    assert grant_order(s, [a1, a2, a3, b1]) == [a1, b1, a2, a3]
+
+
+def test_aging_moves_background_up_but_not_past_pre_response(monkeypatch):
+    monkeypatch.setattr(llm_scheduler, "LLM_SCHED_AGING_S", 10.0)
+    s = LLMScheduler("t", rps=0, tpm=0, max_concurrent=1)
+    old_kb = enqueue(s, "kb_patch", "1", age_s=25.0)       # 3 -> 1
+    post = enqueue(s, "npc_reaction", "2")
+    pre = enqueue(s, "classify_player", "3")
+    assert s._effective(old_kb.priority, old_kb, time.monotonic()) == 1
+    assert grant_order(s, [old_kb, post, pre]) == [pre, old_kb, post]
+
+
+def test_background_share_keeps_slots_for_the_turn():
+    s = LLMScheduler("t", rps=0, tpm=0, max_concurrent=4, background_share=0.5)
+    kbs = [enqueue(s, "kb_rewrite", str(i)) for i in range(3)]
+    pre = enqueue(s, "classify_player", "9")
+    with s._cond:
+        s._dispatch()
+    assert pre.granted_at is not None
+    assert sum(w.granted_at is not None for w in kbs) == 2
+    assert s.background_in_flight == 2
+
+
+def test_acquire_times_out_and_leaves_the_queue():
+    s = LLMScheduler("t", rps=0, tpm=0, max_concurrent=1)
+    held = s.acquire("npc_response", user="1")
+    with pytest.raises(QueueTimeout):
+        s.acquire("classify_player", user="2", timeout=0.05)
+    assert s.snapshot()["pre_response"]["waiting"] == 0
+    assert s.snapshot()["pre_response"]["timeouts"] == 1
+    held.release()
+    s.acquire("classify_player", user="2", timeout=0.05).release()
+    assert s.in_flight == 0
+
+
+def test_release_is_idempotent():
+    s = LLMScheduler("t", rps=0, tpm=0, max_concurrent=2)
+    grant = s.acquire("kb_patch")
+    grant.release()
+    grant.release()
+    assert s.in_flight == 0
+    assert s.background_in_flight == 0
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate_per_s=2.0, burst=4.0)
+    now = bucket.updated
+    assert bucket.wait_time(4, now) == 0.0
+    bucket.take(4)
+    assert bucket.wait_time(1, now) == pytest.approx(0.5)
+    assert bucket.wait_time(1, now + 0.5) == 0.0
+    assert TokenBucket(0, 1).wait_time(100, now) == 0.0
+
+
+def test_limits_are_split_across_workers():
+    s = LLMScheduler("t", rps=8, burst=16, tpm=60_000, max_concurrent=10, workers=4)
+    assert s.requests.rate == pytest.approx(2)
+    assert s.requests.burst == pytest.approx(4)
+    assert s.prompt_tokens.burst == pytest.approx(15_000)
+    assert s.max_concurrent == 2
+    assert LLMScheduler("t", max_concurrent=3, workers=4).max_concurrent == 1
@@ -0,0 +1,113 @@
+import memory_consolidation
+from memory_consolidation import ConsolidationBatcher, MemoryConflict, fetch_batch
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+
+def player(idBuffer, text, age=1.0):
+    return {"idBuffer": idBuffer, "playerText": text, "npcText": None, "ageS": age}
+
+
+def npc(idBuffer, text, age=1.0):
+    return {"idBuffer": idBuffer, "playerText": None, "npcText": text,
+            "npcEmotion": "calm", "npcIntensity": 0.5, "ageS": age}
+
+
+def test_pairs_exchanges_in_order():
+    rows = [player(1, "hi"), npc(2, "hello"), player(3, "bye"), npc(4, "later")]
+    exchanges, ids, ages, backlog, orphans = fetch_batch(FakeCursor(rows), 1, 1, 10, 10_000)
+    assert [e["player_text"] for e in exchanges] == ["hi", "bye"]
+    assert ids == [1, 2, 3, 4]
+    assert backlog == 2
+    assert orphans == []
+
+
+def test_player_followed_by_player_is_orphaned():
+    rows = [player(1, "hi"), player(2, "anyone?"), npc(3, "yes")]
+    exchanges, ids, _, _, orphans = fetch_batch(FakeCursor(rows), 1, 1, 10, 10_000)
+    assert ids == [2, 3]
+    assert orphans == [1]
+
+
+def test_trailing_player_turn_orphaned_only_when_old():
+    rows = [player(1, "hi", age=5.0)]
+    assert fetch_batch(FakeCursor(rows), 1, 1, 10, 10_000, orphan_after_s=60)[4] == []
+    assert fetch_batch(FakeCursor(rows), 1, 1, 10, 10_000, orphan_after_s=1)[4] == [1]
+
+
+def test_npc_row_without_player_row_is_orphaned():
+    # its player row was orphaned before the reply landed
+    rows = [npc(5, "late reply"), player(6, "hi"), npc(7, "hello")]
+    exchanges, ids, _, backlog, orphans = fetch_batch(FakeCursor(rows), 1, 1, 10, 10_000)
+    assert ids == [6, 7]
+    assert backlog == 1
+    assert orphans == [5]
+
+
+def test_batch_is_bounded_but_backlog_counts_everything():
+    rows = []
+    for i in range(5):
+        rows += [player(2 * i, f"p{i}"), npc(2 * i + 1, f"n{i}")]
+    exchanges, ids, _, backlog, _ = fetch_batch(FakeCursor(rows), 1, 1, 2, 10_000)
+    assert len(exchanges) == 2
+    assert ids == [0, 1, 2, 3]
+    assert backlog == 5
+
+
+def drain_with(monkeypatch, outcomes):
+    """
+    Runs _drain against fake job calls; process_batch returns (or
+    raises) the given outcomes in order. Returns (result, job calls).
+    """
+    monkeypatch.setattr(memory_consolidation, "LEASE_RENEW_S", 60)
+    batcher = ConsolidationBatcher()
+    calls = []
+    replies = {"claim_job": 1, "renew_lease": True, "complete_job": True}
+    outcomes = iter(outcomes)
+
+    def job(fn, *args):
+        calls.append(fn.__name__)
+        return replies.get(fn.__name__)
+
+    def process_batch(idNPC, idUser):
+        outcome = next(outcomes)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(batcher, "_job", job)
+    monkeypatch.setattr(batcher, "process_batch", process_batch)
+    return batcher._drain(1, 1), calls, batcher
+
+
+def test_memory_conflict_is_redone_without_failing_the_job(monkeypatch):
+    result, calls, batcher = drain_with(monkeypatch, [MemoryConflict("x"), 2, MemoryConflict("x"), 0])
+    assert result
+    assert calls == ["claim_job", "renew_lease", "complete_job"]
+    assert batcher._stats["conflicts"] == 2
+
+
+def test_memory_conflicts_are_bounded(monkeypatch):
+    monkeypatch.setattr(memory_consolidation, "CONFLICT_RETRIES", 2)
+    result, calls, batcher = drain_with(monkeypatch, [MemoryConflict("x")] * 3)
+    assert not result
+    assert calls == ["claim_job", "fail_job"]
+
+
+def test_lease_is_renewed_while_a_batch_runs(monkeypatch):
+    monkeypatch.setattr(memory_consolidation, "LEASE_RENEW_S", 0.01)
+    batcher = ConsolidationBatcher()
+    renewals = []
+    monkeypatch.setattr(batcher, "_job", lambda fn, *args: renewals.append(fn.__name__) or len(renewals) < 3)
+    with batcher._keep_lease(1, 1) as lost:
+        assert lost.wait(1.0)
+    assert renewals == ["renew_lease"] * 3
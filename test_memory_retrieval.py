@@ -0,0 +1,39 @@
+import memory_retrieval
+from memory_retrieval import rank_scenes, retrieve_memory, update_index
+
+
+def scene(tag, text):
+    return f"=== SCENE: {tag} ===\n{text}\n--- END SCENE ---\n"
+
+
+KB = (
+    scene("harbor", "We watched the boats at the harbor and talked about the lighthouse.")
+    + scene("tower", "The broken clock in the tower stopped at midnight.")
+    + scene("station", "You asked about the train schedule at the station.")
+)
+
+
+def test_relevant_past_scene_is_retrieved():
+    text, report = retrieve_memory(101, 1, KB, "what about the clock tower?", top_k=1)
+    assert report["scenes_selected"] == [1, 2]
+    assert "broken clock" in text
+    assert "harbor" not in text
+
+
+def test_latest_scene_is_never_ranked():
+    update_index(102, 1, KB)
+    assert all(i != 2 for i, _ in rank_scenes(102, 1, "train station schedule"))
+
+
+def test_least_recently_used_index_is_dropped(monkeypatch):
+    monkeypatch.setattr(memory_retrieval, "MEMORY_INDEX_MAX_PAIRS", 2)
+    monkeypatch.setattr(memory_retrieval, "_indexes", memory_retrieval.OrderedDict())
+    update_index(1, 1, KB)
+    update_index(2, 1, KB)
+    update_index(1, 1, KB)      # touch
+    update_index(3, 1, KB)
+    assert list(memory_retrieval._indexes) == [(1, 1), (3, 1)]
+
+    # a dropped pair is rebuilt on its next retrieval
+    _, report = retrieve_memory(2, 1, KB, "clock tower", top_k=1)
+    assert report["scenes_selected"] == [1, 2]
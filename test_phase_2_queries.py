@@ -0,0 +1,76 @@
+from collections import OrderedDict
+import pytest
+import phase_2_queries
+from phase_2_queries import diff_state, reset_npc_state, send_npc_state
+
+
+class FakeSocketIO:
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event, payload, room=None):
+        self.emitted.append((event, payload, room))
+
+
+@pytest.fixture(autouse=True)
+def delta_mode(monkeypatch):
+    monkeypatch.setattr(phase_2_queries, "NPC_STATE_MODE", "delta")
+    monkeypatch.setattr(phase_2_queries, "_emitted_states", OrderedDict())
+
+
+def test_diff_state_nested_changes_and_removals():
+    old = {"trust": 40, "emotion": {"name": "calm", "intensity": 0.4}, "beliefs": [1, 2], "gone": True}
+    new = {"trust": 40, "emotion": {"name": "calm", "intensity": 0.6}, "beliefs": [1, 2, 3], "added": "x"}
+    changed, removed = diff_state(old, new)
+    assert changed == {"emotion": {"intensity": 0.6}, "beliefs": [1, 2, 3], "added": "x"}
+    assert removed == [["gone"]]
+
+
+def test_diff_state_removed_paths_are_nested():
+    changed, removed = diff_state({"a": {"b": 1, "c": 2}}, {"a": {"b": 1}})
+    assert changed == {}
+    assert removed == [["a", "c"]]
+
+
+def test_diff_state_dict_replaced_by_scalar():
+    assert diff_state({"a": {"b": 1}}, {"a": None}) == ({"a": None}, [])
+
+
+def test_first_emit_is_full_then_deltas():
+    sio = FakeSocketIO()
+    first = send_npc_state(1, 7, {"trust": 40, "emotion": "calm"}, sio)
+    assert first["mode"] == "full" and first["version"] == 1
+
+    delta = send_npc_state(1, 7, {"trust": 45, "emotion": "calm"}, sio)
+    assert delta == {"idNPC": 7, "mode": "delta", "version": 2, "baseVersion": 1,
+                     "changed": {"trust": 45}, "removed": []}
+    assert sio.emitted[-1][2] == "user:1"
+
+
+def test_unchanged_state_is_not_emitted():
+    sio = FakeSocketIO()
+    send_npc_state(1, 7, {"trust": 40}, sio)
+    assert send_npc_state(1, 7, {"trust": 40}, sio) is None
+    assert len(sio.emitted) == 1
+
+
+def test_reset_forces_a_full_snapshot():
+    sio = FakeSocketIO()
+    send_npc_state(1, 7, {"trust": 40}, sio)
+    send_npc_state(1, 8, {"trust": 40}, sio)
+    reset_npc_state(1, 7)
+    assert send_npc_state(1, 7, {"trust": 41}, sio)["mode"] == "full"
+    assert send_npc_state(1, 8, {"trust": 41}, sio)["mode"] == "delta"
+
+
+def test_least_recently_emitted_pair_is_dropped(monkeypatch):
+    monkeypatch.setattr(phase_2_queries, "NPC_STATE_MAX_PAIRS", 2)
+    sio = FakeSocketIO()
+    send_npc_state(1, 7, {"trust": 40}, sio)
+    send_npc_state(2, 7, {"trust": 40}, sio)
+    send_npc_state(1, 7, {"trust": 41}, sio)     # touch
+    send_npc_state(3, 7, {"trust": 40}, sio)
+    assert list(phase_2_queries._emitted_states) == [(1, 7), (3, 7)]
+
+    # the dropped pair starts over with a full snapshot
+    assert send_npc_state(2, 7, {"trust": 42}, sio)["mode"] == "full"
@@ -0,0 +1,94 @@
+import pytest
+from scene_document import apply_patch, compress_scene, factual_anchors, parse_scene, split_scenes
+
+NEW_SCENE = {"tag": "harbor_at_dusk", "where": "the harbor", "when": "dusk",
+             "how_we_got_here": "the player arrived", "npc_lens": "wary"}
+
+
+def episode(speaker, said, intensity=0.3, **extra):
+    return {"speaker": speaker, "said": said, "intensity": intensity, "notes": "", **extra}
+
+
+def scene_with(n_episodes, intensities=None):
+    intensities = intensities or {}
+    patch = {"new_scene": NEW_SCENE, "episodes": [
+        episode("player" if i % 2 else "npc", f"line {i}", intensities.get(i, 0.3))
+        for i in range(1, n_episodes + 1)
+    ]}
+    return apply_patch(None, patch)
+
+
+def test_first_patch_opens_a_scene_and_numbers_episodes():
+    scene = apply_patch(None, {"new_scene": NEW_SCENE, "episodes": [
+        episode("player", "hello", 0.4, player_felt="curious (0.5)"),
+        episode("npc", "who are you?", 0.6, responding_to=1),
+    ]})
+    parsed = parse_scene(scene)
+    assert parsed["tag"] == "harbor_at_dusk"
+    assert [e["n"] for e in parsed["episodes"]] == [1, 2]
+    assert "Responding to: [1]" in parsed["episodes"][1]["lines"]
+    assert parsed["peak"] == pytest.approx(0.6)
+
+
+def test_patch_appends_to_the_current_scene():
+    scene = apply_patch(scene_with(2), {"episodes": [episode("player", "again", 0.9)]})
+    scenes, _ = split_scenes(scene)
+    assert len(scenes) == 1
+    parsed = parse_scene(scene)
+    assert [e["n"] for e in parsed["episodes"]] == [1, 2, 3]
+    assert parsed["peak"] == pytest.approx(0.9)
+
+
+def test_new_scene_keeps_the_current_one():
+    scene = apply_patch(scene_with(2), {"new_scene": {**NEW_SCENE, "tag": "tower"},
+                                        "episodes": [episode("npc", "up here")]})
+    scenes, _ = split_scenes(scene)
+    assert [parse_scene(s)["tag"] for s in scenes] == ["harbor_at_dusk", "tower"]
+    assert [e["n"] for e in parse_scene(scenes[1])["episodes"]] == [1]
+
+
+def test_beliefs_in_play_replace_the_block():
+    patch = {"beliefs_in_play": {"self": [{"beliefType": "fear", "beliefValue": "the dark", "confidence": 0.7}],
+                                 "player": []}, "episodes": []}
+    scene = apply_patch(apply_patch(scene_with(1), patch), patch)
+    assert scene.count("Relevant beliefs in play (NPC about self):") == 1
+    assert "- fear: the dark (conf 0.70)" in scene
+
+
+def test_patch_compression_never_drops_protected_episodes():
+    scene = scene_with(8, intensities={2: 0.97})
+    out = apply_patch(scene, {"compress": {"episodes": [1, 2, 3, 8], "bullets": ["- early small talk"]},
+                              "episodes": []})
+    parsed = parse_scene(out)
+    assert [e["n"] for e in parsed["episodes"]] == [2, 4, 5, 6, 7, 8]
+    assert parsed["compressed"] == ["early small talk"]
+
+
+@pytest.mark.parametrize("scene, patch", [
+    ("not a scene", {"episodes": []}),
+    (None, {"episodes": "nope"}),
+    (None, ["not", "an", "object"]),
+])
+def test_bad_patch_raises(scene, patch):
+    with pytest.raises(ValueError):
+        apply_patch(scene, patch)
+
+
+def test_compress_scene_folds_old_episodes_into_bullets():
+    scene = scene_with(9, intensities={1: 0.96})
+    out, folded = compress_scene(scene, keep_recent=5)
+    parsed = parse_scene(out)
+    assert folded == 3
+    assert [e["n"] for e in parsed["episodes"]] == [1, 5, 6, 7, 8, 9]
+    assert [b.split(" ", 1)[0] for b in parsed["compressed"]] == ["[2]", "[3]", "[4]"]
+
+
+def test_compress_scene_leaves_short_or_unparsed_scenes_alone():
+    scene = scene_with(3)
+    assert compress_scene(scene) == (scene, 0)
+    assert compress_scene("free text") == ("free text", 0)
+
+
+def test_factual_anchors():
+    text = "We met Anna Berg at 7:30 pm in Port Royal and she paid $1,200. Then she left."
+    assert factual_anchors(text) == ["Anna Berg", "7:30 pm", "Port Royal", "$1,200"]
@@ -0,0 +1,34 @@
+import time
+from state_emitter import StateEmitter
+
+
+class RecordingEmitter(StateEmitter):
+    def __init__(self, **kwargs):
+        super().__init__(None, **kwargs)
+        self.batches = []
+
+    def _emit_batch(self, batch):
+        self.batches.append(dict(batch))
+
+
+def test_rapid_turns_are_debounced_into_one_emit():
+    emitter = RecordingEmitter(debounce=0.02, min_interval=0.05, max_wait=0.5)
+    for _ in range(5):
+        emitter.schedule(1, 1)
+    emitter.schedule(1, 1, full=True)
+    assert emitter.flush(timeout=2)
+    assert len(emitter.batches) == 1
+    assert emitter.batches[0][(1, 1)]["full"]
+
+
+def test_last_emit_only_keeps_rooms_inside_min_interval():
+    emitter = RecordingEmitter(debounce=0.0, min_interval=0.05, max_wait=0.1)
+    for idUser in range(50):
+        emitter.schedule(idUser, 1)
+    assert emitter.flush(timeout=2)
+    assert len(emitter._last_emit) == 50
+
+    time.sleep(0.1)
+    emitter.schedule(999, 1)
+    assert emitter.flush(timeout=2)
+    assert list(emitter._last_emit) == [(999, 1)]
@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+import pytest
+from structured_output import SCHEMAS, extract_json, parse_model_json, repair_json, validate
+
+
+def completion(content):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+CLASSIFY_FALLBACK = {"sentiment": "neutral", "intensity": 0.0, "offensive": False, "emotion": "calm", "target": "none"}
+
+
+def test_plain_json_is_not_repaired():
+    assert extract_json('{"a": 1}') == ({"a": 1}, False)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('Sure! ```json\n{"a": 1}\n``` hope that helps', {"a": 1}),
+    ('{"a": 1} and also {"b": 2}', {"a": 1}),
+    ("It's here: {'a': 'it\\'s'}", {"a": "it's"}),
+    ('{"note": "a } inside", "b": 2}', {"note": "a } inside", "b": 2}),
+])
+def test_object_is_found_in_prose(text, expected):
+    assert extract_json(text)[0] == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"a": [1, 2,], "b": 3,}', {"a": [1, 2], "b": 3}),
+    ("{'a': 'x', 'b': True, 'c': None}", {"a": "x", "b": True, "c": None}),
+    ('{a: 1, b_c: "x"}', {"a": 1, "b_c": "x"}),
+    ('{"a": "line one\nline two"}', {"a": "line one\nline two"}),
+    ('{"a": 1, // comment\n "b": 2}', {"a": 1, "b": 2}),
+    ('{"a": 1, /* block } */ "b": 2, // last\n}', {"a": 1, "b": 2}),
+    ('{"url": "http://example.com/x"}', {"url": "http://example.com/x"}),
+])
+def test_repair(text, expected):
+    assert extract_json(text)[0] == expected
+
+
+def test_truncated_output_is_closed():
+    data, repaired = extract_json('{"a": [1, 2], "b": {"c": "cut of')
+    assert repaired
+    assert data == {"a": [1, 2], "b": {"c": "cut of"}}
+
+
+def test_repair_keeps_comment_markers_in_strings():
+    assert repair_json('{"a": "// not a comment"}') == '{"a": "// not a comment"}'
+
+
+def test_no_object_raises():
+    with pytest.raises(ValueError):
+        extract_json("I cannot answer that.")
+
+
+def test_validate_takes_bad_fields_from_fallback():
+    data = {"sentiment": "Positive", "intensity": "0.7", "offensive": "no", "emotion": "bored", "extra": 1}
+    result, replaced = validate(data, SCHEMAS["classify_player"], CLASSIFY_FALLBACK)
+    assert result == {"sentiment": "positive", "intensity": 0.7, "offensive": False,
+                      "emotion": "calm", "target": "none"}
+    assert replaced == 2
+
+
+def test_validate_missing_nullable_field_is_none():
+    result, replaced = validate({"episodes": []}, SCHEMAS["kb_patch"], None)
+    assert result == {"new_scene": None, "beliefs_in_play": None, "compress": None, "episodes": []}
+    assert replaced == 0
+
+
+def test_parse_model_json_fallbacks():
+    assert parse_model_json(None, "classify_player", CLASSIFY_FALLBACK) is CLASSIFY_FALLBACK
+    assert parse_model_json(completion("no json"), "classify_player", CLASSIFY_FALLBACK) == CLASSIFY_FALLBACK
+    assert parse_model_json(completion('{"unrelated": 1}'), "classify_player", CLASSIFY_FALLBACK) == CLASSIFY_FALLBACK
+
+
+def test_parse_model_json_partial():
+    result = parse_model_json(completion('{"emotion": "happy", "intensity": 2}'), "npc_reaction",
+                              {"emotion": "calm", "intensity": 0.5})
+    assert result == {"emotion": "happy", "intensity": 2}
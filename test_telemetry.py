@@ -0,0 +1,46 @@
+import time
+from types import SimpleNamespace
+import pytest
+from circuit_breaker import CLOSED, OPEN, CircuitOpen, llm_breaker
+from llm_scheduler import QueueTimeout, get_scheduler
+from telemetry import chat_completion
+
+
+class FakeClient:
+    scheduler_limits = {"max_concurrent": 1}
+
+    def __init__(self, name):
+        self.base_url = f"http://{name}"
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, **kwargs):
+        return SimpleNamespace(usage=None, choices=[])
+
+
+def expire(breaker):
+    breaker.state = OPEN
+    breaker.opened_at = time.monotonic() - breaker.open_s - 1
+
+
+def test_open_breaker_fails_before_queueing():
+    client = FakeClient("open-breaker")
+    breaker = llm_breaker(client, "m")
+    breaker.state, breaker.opened_at = OPEN, time.monotonic()
+    with pytest.raises(CircuitOpen):
+        chat_completion(client, "classify_player", model="m", messages=[])
+    assert get_scheduler("open-breaker").in_flight == 0
+
+
+def test_queue_timeout_does_not_hold_the_probe():
+    client = FakeClient("probe-queue")
+    breaker = llm_breaker(client, "m")
+    expire(breaker)
+
+    held = get_scheduler("probe-queue", max_concurrent=1).acquire("npc_response")
+    with pytest.raises(QueueTimeout):
+        chat_completion(client, "classify_player", model="m", messages=[], timeout=0.05)
+    assert breaker.probing == []
+    held.release()
+
+    chat_completion(client, "classify_player", model="m", messages=[])
+    assert breaker.state == CLOSED
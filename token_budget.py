@@ -0,0 +1,190 @@
+import os
+import re
+from threading import Lock
+from structured_log import get_logger
+from ollama_provider import local_stage, local_context_budget
+#------------------------------------------------------------------
+# Token budgeting for every prompt builder
+#
+# Each stage has a budget (env TOKEN_BUDGET_<STAGE> overrides).
+# A prompt is described as sections:
+#
+#   text_section(name, text)                    required, never cut
+#   text_section(name, text, priority=p)        cut line by line
+#   items_section(name, items, priority=p)      items dropped one by one
+#
+# When the estimate is over budget, sections are cut in ascending
+# priority order. Within an items section the lowest score goes first
+# (ties: the older item). Within a text section the oldest lines go
+# first (keep="tail") or the newest (keep="head"). Same input, same cut.
+#
+# A stage served by a local Ollama model is also capped to its context
+# window (OLLAMA_NUM_CTX minus room for the answer): Ollama silently
+# drops the START of a longer prompt, i.e. the rules and the persona.
+#------------------------------------------------------------------
+STAGE_BUDGETS = {
+    "npc_response":     24000,
+    "classify_player":   6000,
+    "persona_clues":     8000,
+    "self_beliefs":      8000,
+    "npc_reaction":      3000,
+    "kb_consolidation": 48000,
+}
+
+def stage_budget(stage: str) -> int:
+    override = os.getenv(f"TOKEN_BUDGET_{stage.upper()}")
+    budget = int(override) if override else STAGE_BUDGETS.get(stage, 8000)
+    if local_stage(stage):
+        budget = min(budget, local_context_budget())
+    return budget
+#------------------------------------------------------------------
+_WORD_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+logger = get_logger("tokens")
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap local token estimate (~BPE): one token per punctuation mark,
+    one per word plus one per extra 6 characters of long words,
+    one per line break (prompts are line oriented).
+    """
+    if not text:
+        return 0
+    words = sum(1 + (len(piece) - 1) // 6 for piece in _WORD_RE.findall(text))
+    return words + text.count("\n")
+#------------------------------------------------------------------
+def text_section(name: str, text: str, priority: int | None = None, keep: str = "tail") -> dict:
+    return {
+        "name": name,
+        "kind": "text",
+        "text": text or "",
+        "priority": priority,
+        "keep": keep
+    }
+
+def items_section(name: str, items: list, priority: int, min_items: int = 0, joiner: str = "\n") -> dict:
+    """
+    items: list of (score, text) in display order.
+    """
+    return {
+        "name": name,
+        "kind": "items",
+        "items": [(float(score), text) for score, text in items],
+        "priority": priority,
+        "min_items": min_items,
+        "joiner": joiner
+    }
+#------------------------------------------------------------------
+def _render(sec: dict, kept=None) -> str:
+    if sec["kind"] == "text":
+        return sec["text"]
+    items = sec["items"] if kept is None else [sec["items"][i] for i in kept]
+    return sec["joiner"].join(text for _, text in items)
+
+def _truncate_lines(text: str, excess: int, keep: str) -> tuple[str, int]:
+    """
+    Drop whole lines from the cut end until `excess` tokens are gone.
+    Returns (text, dropped_lines).
+    """
+    lines = text.split("\n")
+    dropped = 0
+    while lines and excess > 0:
+        line = lines.pop(0) if keep == "tail" else lines.pop()
+        excess -= estimate_tokens(line) + 1
+        dropped += 1
+    return "\n".join(lines), dropped
+#------------------------------------------------------------------
+def fit_to_budget(stage: str, sections: list[dict], budget: int | None = None) -> tuple[dict, dict]:
+    """
+    Returns ({name: rendered_text}, report).
+    """
+    budget = budget if budget is not None else stage_budget(stage)
+
+    tokens = {}
+    kept = {}
+    for sec in sections:
+        if sec["kind"] == "items":
+            kept[sec["name"]] = list(range(len(sec["items"])))
+            tokens[sec["name"]] = sum(estimate_tokens(t) + 1 for _, t in sec["items"])
+        else:
+            tokens[sec["name"]] = estimate_tokens(sec["text"])
+
+    before = sum(tokens.values())
+    total = before
+    dropped = {}
+    rendered = {}
+
+    cuttable = sorted(
+        (s for s in sections if s["priority"] is not None),
+        key=lambda s: s["priority"]
+    )
+
+    for sec in cuttable:
+        if total <= budget:
+            break
+        name = sec["name"]
+
+        if sec["kind"] == "items":
+            # lowest score first, older first on ties
+            order = sorted(kept[name], key=lambda i: (sec["items"][i][0], i))
+            removable = max(0, len(order) - sec["min_items"])
+            for i in order[:removable]:
+                if total <= budget:
+                    break
+                cost = estimate_tokens(sec["items"][i][1]) + 1
+                kept[name].remove(i)
+                tokens[name] -= cost
+                total -= cost
+                dropped[name] = dropped.get(name, 0) + 1
+        else:
+            excess = total - budget
+            text, lines = _truncate_lines(sec["text"], excess, sec["keep"])
+            rendered[name] = text
+            new_tokens = estimate_tokens(text)
+            total -= tokens[name] - new_tokens
+            tokens[name] = new_tokens
+            if lines:
+                dropped[name] = lines
+
+    for sec in sections:
+        if sec["name"] not in rendered:
+            rendered[sec["name"]] = _render(sec, kept.get(sec["name"]))
+
+    report = {
+        "stage": stage,
+        "budget": budget,
+        "tokens_before": before,
+        "tokens_after": total,
+        "over_budget": total > budget,
+        "sections": tokens,
+        "dropped": dropped
+    }
+    record_prompt_size(report)
+    return rendered, report
+
+#------------------------------------------------------------------
+# Per-call prompt size metrics
+#------------------------------------------------------------------
+_prompt_size_stats = {}     # stage -> {"calls", "tokens", "max_tokens", "truncated", "over_budget"}
+_prompt_size_lock = Lock()
+
+def record_prompt_size(report: dict):
+    with _prompt_size_lock:
+        stats = _prompt_size_stats.setdefault(report["stage"], {
+            "calls": 0, "tokens": 0, "max_tokens": 0, "truncated": 0, "over_budget": 0
+        })
+        stats["calls"] += 1
+        stats["tokens"] += report["tokens_after"]
+        stats["max_tokens"] = max(stats["max_tokens"], report["tokens_after"])
+        stats["truncated"] += 1 if report["dropped"] else 0
+        stats["over_budget"] += 1 if report["over_budget"] else 0
+
+    (logger.warning if report["over_budget"] else logger.debug)(
+        "prompt budget",
+        stage=report["stage"], tokens=report["tokens_after"], budget=report["budget"],
+        tokens_before=report["tokens_before"], dropped=report["dropped"] or None
+    )
+
+def prompt_size_stats() -> dict:
+    with _prompt_size_lock:
+        return {stage: dict(s) for stage, s in _prompt_size_stats.items()}